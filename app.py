@@ -1,17 +1,25 @@
 from flask import Flask, request, jsonify, send_from_directory
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager, create_access_token, create_refresh_token, jwt_required, get_jwt_identity
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
 import os
 import yaml
 import logging
 from logging.handlers import RotatingFileHandler
 from werkzeug.security import generate_password_hash, check_password_hash
 from models import db, User, Repository, Backup, SecurityLog
+from repomirror.retry import RetryPolicy
 from services.github_service import GitHubService
 from services.storage_service import StorageService
 from services.security_service import SecurityService
 from services.notification_service import NotificationService
+from services.backup_queue import BackupQueue
+from services.job_control import stage_timeouts
+from services.maintenance_service import MaintenanceService
+from services.forecast import QueueForecast
+from services.schedule import parse_schedule
+from services.compression import get_codec
+from services.scheduler_service import SchedulerService
 
 # Configuración de la aplicación
 app = Flask(__name__, static_folder='web/static', template_folder='web/templates')
@@ -52,10 +60,24 @@ app.logger.setLevel(logging.INFO)
 app.logger.info('RepoMirror startup')
 
 # Inicialización de servicios
-github_service = GitHubService(config.get('github', {}))
+github_service = GitHubService(
+    config.get('github', {}),
+    RetryPolicy(config.get('general', {}).get('max_retries', 3))
+)
 storage_service = StorageService(config.get('storage', {}))
 security_service = SecurityService()
 notification_service = NotificationService()
+backup_queue = BackupQueue(
+    app,
+    github_service,
+    storage_service,
+    notification_service,
+    config.get('workers', {}),
+    stage_timeouts(config.get('general', {}))
+)
+maintenance_service = MaintenanceService(app, storage_service, config.get('maintenance', {}))
+scheduler_service = SchedulerService(app, backup_queue, config.get('scheduler', {}))
+queue_forecast = QueueForecast(backup_queue.estimator)
 
 # Rutas de autenticación
 @app.route('/api/auth/login', methods=['POST'])
@@ -106,13 +128,51 @@ def add_repository():
     data = request.get_json()
     
     try:
+        # Uno o varios destinos: lista o texto separado por comas
+        storage_types = data['storage_type']
+        if isinstance(storage_types, str):
+            storage_types = storage_types.split(',')
+        storage_types = [t.strip() for t in storage_types if t.strip()]
+        if not storage_types:
+            return jsonify({'error': 'Se requiere al menos un destino'}), 400
+        # Solo destinos soportados (s3, gdrive, ftp) y configurados
+        unknown = [t for t in storage_types if t not in storage_service.backends]
+        if unknown:
+            return jsonify({'error': f'Destinos no soportados o no configurados: {", ".join(unknown)}'}), 400
+        
+        # 'manual', 'hourly', 'daily', 'weekly', 'monthly' o una expresión cron
+        schedule = data.get('schedule', 'manual')
+        try:
+            parse_schedule(schedule)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        # 'full' (archivo completo) o 'incremental' (cadena de git bundles)
+        backup_mode = data.get('backup_mode', 'full')
+        if backup_mode not in ('full', 'incremental'):
+            return jsonify({'error': f'Modo de backup no soportado: {backup_mode}'}), 400
+        
+        # 'codec[:nivel]'; sin valor se usa la compresión de la configuración
+        compression = data.get('compression') or None
+        if compression is not None:
+            name, _, level = str(compression).partition(':')
+            try:
+                get_codec(name, level)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        
         repo = Repository(
             user_id=user_id,
             url=data['url'],
-            storage_type=data['storage_type'],
-            schedule=data.get('schedule', 'manual')
+            storage_type=','.join(storage_types),
+            schedule=schedule,
+            backup_mode=backup_mode,
+            compression=compression
         )
         db.session.add(repo)
+        # El reparto de las ejecuciones depende del ID del repositorio
+        db.session.flush()
+        scheduler_service.schedule(repo)
         db.session.commit()
         
         notification_service.send_notification(
@@ -135,13 +195,8 @@ def start_backup(repo_id):
     repo = Repository.query.filter_by(id=repo_id, user_id=user_id).first_or_404()
     
     try:
-        backup = Backup(repository_id=repo.id)
-        db.session.add(backup)
-        db.session.commit()
-        
-        # Iniciar backup en segundo plano
-        github_service.clone_repository(repo.url, backup.id)
-        storage_service.upload_backup(backup.id, repo.storage_type)
+        # El backup se procesa en segundo plano por la cola de workers
+        backup = backup_queue.enqueue(repo)
         
         notification_service.send_notification(
             user_id,
@@ -150,12 +205,134 @@ def start_backup(repo_id):
             f'Se ha iniciado el backup del repositorio {repo.url}'
         )
         
-        return jsonify({'message': 'Backup iniciado'})
+        return jsonify({
+            'message': 'Backup iniciado',
+            'backup_id': backup.id,
+            'status': backup.status
+        }), 202
     except Exception as e:
         db.session.rollback()
         app.logger.error(f'Error starting backup: {str(e)}')
         return jsonify({'error': 'Error al iniciar el backup'}), 500
 
+# Rutas de backups
+@app.route('/api/backups/<int:backup_id>', methods=['GET'])
+@jwt_required()
+def get_backup(backup_id):
+    user_id = get_jwt_identity()
+    backup = Backup.query.join(Repository).filter(
+        Backup.id == backup_id,
+        Repository.user_id == user_id
+    ).first_or_404()
+    return jsonify(backup.to_dict())
+
+@app.route('/api/backups/<int:backup_id>', methods=['DELETE'])
+@jwt_required()
+def cancel_backup(backup_id):
+    user_id = get_jwt_identity()
+    backup = Backup.query.join(Repository).filter(
+        Backup.id == backup_id,
+        Repository.user_id == user_id
+    ).first_or_404()
+    
+    # El worker interrumpe el backup y limpia sus archivos y subidas a medias
+    if not backup_queue.cancel(backup.id):
+        return jsonify({'error': 'El backup no está pendiente ni en curso'}), 409
+    
+    return jsonify({'message': 'Backup cancelado', 'backup_id': backup.id}), 202
+
+@app.route('/api/backups/<int:backup_id>/chain', methods=['GET'])
+@jwt_required()
+def get_backup_chain(backup_id):
+    user_id = get_jwt_identity()
+    backup = Backup.query.join(Repository).filter(
+        Backup.id == backup_id,
+        Repository.user_id == user_id
+    ).first_or_404()
+    # Bundles a descargar y aplicar, en orden, para restaurar el backup
+    return jsonify([b.to_dict() for b in backup.get_chain()])
+
+# Rutas de retención
+@app.route('/api/retention/plan', methods=['GET'])
+@jwt_required()
+def get_retention_plan():
+    user = User.query.get(get_jwt_identity())
+    if not user or not user.is_admin:
+        return jsonify({'error': 'No autorizado'}), 403
+    
+    return jsonify(storage_service.apply_retention(dry_run=True))
+
+@app.route('/api/retention/apply', methods=['POST'])
+@jwt_required()
+def apply_retention():
+    user = User.query.get(get_jwt_identity())
+    if not user or not user.is_admin:
+        return jsonify({'error': 'No autorizado'}), 403
+    
+    return jsonify(storage_service.apply_retention())
+
+# Rutas de transferencias
+@app.route('/api/transfers', methods=['GET'])
+@jwt_required()
+def get_transfer_limits():
+    user = User.query.get(get_jwt_identity())
+    if not user or not user.is_admin:
+        return jsonify({'error': 'No autorizado'}), 403
+    
+    return jsonify(storage_service.get_transfer_limits())
+
+@app.route('/api/transfers', methods=['PUT'])
+@jwt_required()
+def set_transfer_limits():
+    user = User.query.get(get_jwt_identity())
+    if not user or not user.is_admin:
+        return jsonify({'error': 'No autorizado'}), 403
+    
+    try:
+        return jsonify(storage_service.set_transfer_limits(request.get_json() or {}))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+
+# Rutas de la cola
+@app.route('/api/queue', methods=['GET'])
+@jwt_required()
+def get_queue_status():
+    user = User.query.get(get_jwt_identity())
+    if not user:
+        return jsonify({'error': 'No autorizado'}), 403
+    
+    # Cada usuario ve su propia cola; los administradores, la de todos
+    return jsonify(backup_queue.tenants(None if user.is_admin else user.id))
+
+def parse_utc(value):
+    # Fecha ISO 8601 en UTC sin zona horaria, como las de la base de datos
+    date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if date.tzinfo:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+@app.route('/api/queue/forecast', methods=['GET'])
+@jwt_required()
+def get_queue_forecast():
+    user = User.query.get(get_jwt_identity())
+    if not user or not user.is_admin:
+        return jsonify({'error': 'No autorizado'}), 403
+    
+    try:
+        # Backups simultáneos entre todos los workers (por defecto, los de este proceso)
+        workers = request.args.get('workers', backup_queue.pool_size, type=int)
+        # Incluir los backups programados hasta `until` y comparar con `deadline`
+        until = request.args.get('until')
+        deadline = request.args.get('deadline')
+        return jsonify(queue_forecast.forecast(
+            workers,
+            until=parse_utc(until) if until else None,
+            jitter=scheduler_service.jitter,
+            deadline=parse_utc(deadline) if deadline else None
+        ))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
 # Rutas de seguridad
 @app.route('/api/security/status', methods=['GET'])
 @jwt_required()
@@ -221,7 +398,7 @@ def internal_error(error):
     return jsonify({'error': 'Error interno del servidor'}), 500
 
 # Inicialización de la base de datos
-def init_app():
+def init_db():
     with app.app_context():
         db.create_all()
         
@@ -237,8 +414,18 @@ def init_app():
             db.session.commit()
             app.logger.info('Usuario administrador creado')
 
-# Inicializar la app
-init_app()
+def init_app():
+    init_db()
+    
+    # Sin workers embebidos los backups los procesan los `repomirror worker`
+    if config.get('workers', {}).get('embedded', True):
+        backup_queue.start()
+    maintenance_service.start()
+    scheduler_service.start()
+
+# Inicializar la app (`repomirror worker` solo usa la base de datos y la cola)
+if os.getenv('REPOMIRROR_WORKER') != '1':
+    init_app()
 
 if __name__ == '__main__':
     app.run(debug=True) 
\ No newline at end of file
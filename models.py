@@ -37,10 +37,24 @@ class Repository(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     url = db.Column(db.String(255), nullable=False)
-    storage_type = db.Column(db.String(20), nullable=False)
-    schedule = db.Column(db.String(20), default='manual')
+    # Destinos separados por comas (p. ej. 's3,ftp'): el artefacto se genera
+    # una vez y se sube a todos
+    storage_type = db.Column(db.String(50), nullable=False)
+    # 'manual', 'hourly', 'daily', 'weekly', 'monthly' o una expresión cron
+    schedule = db.Column(db.String(100), default='manual')
+    # 'full' (archivo completo) o 'incremental' (cadena de git bundles)
+    backup_mode = db.Column(db.String(20), default='full')
+    # Codec de compresión propio ('codec[:nivel]', p. ej. 'zstd:19')
+    compression = db.Column(db.String(20))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_backup = db.Column(db.DateTime)
+    # Siguiente backup programado (NULL si el repositorio no se programa)
+    next_run_at = db.Column(db.DateTime, index=True)
+    # Último push conocido y tamaño en KB según GitHub
+    pushed_at = db.Column(db.DateTime)
+    size = db.Column(db.BigInteger)
+    # Pico de disco de trabajo de sus backups (bytes, ver ScratchSpace)
+    scratch_peak = db.Column(db.BigInteger)
     status = db.Column(db.String(20), default='active')
     
     # Relaciones
@@ -51,38 +65,211 @@ class Repository(db.Model):
             'id': self.id,
             'url': self.url,
             'storage_type': self.storage_type,
+            'storage_types': self.get_storage_types(),
             'schedule': self.schedule,
+            'backup_mode': self.backup_mode,
+            'compression': self.compression,
             'created_at': self.created_at.isoformat(),
             'last_backup': self.last_backup.isoformat() if self.last_backup else None,
+            'next_run_at': self.next_run_at.isoformat() if self.next_run_at else None,
+            'pushed_at': self.pushed_at.isoformat() if self.pushed_at else None,
+            'size': self.size,
             'status': self.status
         }
 
+    def get_storage_types(self):
+        """
+        Devuelve la lista de destinos del repositorio.
+        """
+        return [t.strip() for t in (self.storage_type or '').split(',') if t.strip()]
+
+    def get_owner(self):
+        """
+        Devuelve el propietario del repositorio en GitHub (usuario u organización).
+        """
+        parts = (self.url or '').rstrip('/').split('/')
+        return parts[-2] if len(parts) >= 2 else None
+
 class Backup(db.Model):
     __tablename__ = 'backups'
+    __table_args__ = (
+        db.Index('ix_backups_repository_created', 'repository_id', 'created_at'),
+        # Ventanas por repositorio y fecha de la política de retención: en el
+        # orden en que las recorre y solo con los backups correctos
+        db.Index(
+            'ix_backups_retention',
+            'repository_id', db.text('created_at DESC'), db.text('id DESC'),
+            postgresql_where=db.text("status IN ('completed', 'unchanged')"),
+            sqlite_where=db.text("status IN ('completed', 'unchanged')")
+        ),
+        # Reclamación de trabajos por los workers
+        db.Index('ix_backups_status_priority', 'status', 'priority', 'created_at'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     repository_id = db.Column(db.Integer, db.ForeignKey('repositories.id'), nullable=False)
     local_path = db.Column(db.String(255))
     storage_path = db.Column(db.String(255))
     status = db.Column(db.String(20), default='pending')
+    # Orden en la cola: los valores menores se procesan antes y, a igual
+    # prioridad, los backups más largos (estimados al encolar)
+    priority = db.Column(db.Integer, default=0, nullable=False)
+    estimated_duration = db.Column(db.Float, default=0, nullable=False)
+    estimated_size = db.Column(db.BigInteger)
+    # Organización de GitHub del repositorio (reparto justo por organización)
+    organization = db.Column(db.String(100))
+    # Disco de trabajo reservado al reclamarlo y pico medido (bytes)
+    scratch_reserved = db.Column(db.BigInteger)
+    scratch_peak = db.Column(db.BigInteger)
     error_message = db.Column(db.Text)
     repo_info = db.Column(db.Text)
+    ref_fingerprint = db.Column(db.String(64))
+    # Backup que contiene el artefacto (si este backup no generó uno propio)
+    artifact_backup_id = db.Column(db.Integer, db.ForeignKey('backups.id'))
+    # 'archive', 'full_bundle' o 'incremental_bundle'
+    artifact_type = db.Column(db.String(20), default='archive')
+    # Cadena de bundles: bundle anterior y bundle completo que inicia la cadena
+    parent_backup_id = db.Column(db.Integer, db.ForeignKey('backups.id'))
+    chain_base_id = db.Column(db.Integer, db.ForeignKey('backups.id'))
+    refs = db.Column(db.Text)
+    # Codec con el que se comprimió el artefacto (para elegir el descompresor)
+    compression = db.Column(db.String(20))
+    # Almacenamiento de la copia principal del artefacto (s3, gdrive, ftp);
+    # todas las copias están en `destinations`
+    storage_type = db.Column(db.String(20))
+    # Última vez que la conciliación encontró el artefacto en el almacenamiento
+    verified_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
     completed_at = db.Column(db.DateTime)
     size = db.Column(db.BigInteger)
+    # Worker que procesa el backup y caducidad de su lease (la renueva
+    # mientras trabaja; si caduca, otro worker puede reclamar el backup)
+    lease_owner = db.Column(db.String(64))
+    lease_expires_at = db.Column(db.DateTime)
+    # Veces que un worker reclamó el backup
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # Cancelación pedida para un backup en curso en cualquier worker
+    cancel_requested = db.Column(db.Boolean, default=False, nullable=False)
+    # Su worker debe cederlo a un backup manual que espera (vuelve a la cola)
+    preempt_requested = db.Column(db.Boolean, default=False, nullable=False)
+    
+    # Relaciones
+    destinations = db.relationship(
+        'BackupDestination',
+        backref='backup',
+        lazy=True,
+        cascade='all, delete-orphan',
+        order_by='BackupDestination.id'
+    )
     
     def to_dict(self):
         return {
             'id': self.id,
             'repository_id': self.repository_id,
             'status': self.status,
+            'priority': self.priority,
+            'estimated_duration': self.estimated_duration,
+            'estimated_size': self.estimated_size,
+            'organization': self.organization,
+            'scratch_reserved': self.scratch_reserved,
+            'scratch_peak': self.scratch_peak,
             'error_message': self.error_message,
             'repo_info': json.loads(self.repo_info) if self.repo_info else None,
+            'ref_fingerprint': self.ref_fingerprint,
+            'artifact_backup_id': self.artifact_backup_id,
+            'artifact_type': self.artifact_type,
+            'parent_backup_id': self.parent_backup_id,
+            'chain_base_id': self.chain_base_id,
+            'compression': self.compression,
+            'storage_type': self.storage_type,
             'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
             'completed_at': self.completed_at.isoformat() if self.completed_at else None,
-            'size': self.size
+            'size': self.size,
+            'verified_at': self.verified_at.isoformat() if self.verified_at else None,
+            'lease_owner': self.lease_owner,
+            'attempts': self.attempts,
+            'destinations': [destination.to_dict() for destination in self.destinations]
         }
 
+    def get_chain(self):
+        """
+        Devuelve los backups que hay que restaurar, en orden de aplicación,
+        para reconstruir este backup.
+        """
+        backup = Backup.query.get(self.artifact_backup_id) if self.artifact_backup_id else self
+        chain = [backup]
+        while backup.parent_backup_id:
+            backup = Backup.query.get(backup.parent_backup_id)
+            chain.append(backup)
+        return list(reversed(chain))
+
+class BackupDestination(db.Model):
+    __tablename__ = 'backup_destinations'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    backup_id = db.Column(db.Integer, db.ForeignKey('backups.id'), nullable=False, index=True)
+    storage_type = db.Column(db.String(20), nullable=False)
+    # pending, uploading, completed o error
+    status = db.Column(db.String(20), default='pending')
+    storage_path = db.Column(db.String(255), index=True)
+    size = db.Column(db.BigInteger)
+    # Codec de esta copia (cada almacenamiento puede usar el suyo)
+    compression = db.Column(db.String(20))
+    # Duración de la subida en segundos
+    duration = db.Column(db.Float)
+    # SHA-256 del artefacto subido
+    sha256 = db.Column(db.String(64))
+    error_message = db.Column(db.Text)
+    started_at = db.Column(db.DateTime)
+    completed_at = db.Column(db.DateTime)
+    # Última vez que la conciliación encontró la copia en el almacenamiento
+    verified_at = db.Column(db.DateTime)
+    
+    # Relaciones
+    upload_session = db.relationship(
+        'UploadSession',
+        backref='destination',
+        uselist=False,
+        cascade='all, delete-orphan'
+    )
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'storage_type': self.storage_type,
+            'status': self.status,
+            'storage_path': self.storage_path,
+            'size': self.size,
+            'compression': self.compression,
+            'duration': self.duration,
+            'sha256': self.sha256,
+            'error_message': self.error_message,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None,
+            'verified_at': self.verified_at.isoformat() if self.verified_at else None
+        }
+
+# Punto de control de la subida en curso de una copia, para poder reanudarla
+# desde otro proceso
+class UploadSession(db.Model):
+    __tablename__ = 'upload_sessions'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    destination_id = db.Column(db.Integer, db.ForeignKey('backup_destinations.id'), nullable=False, unique=True)
+    storage_type = db.Column(db.String(20), nullable=False)
+    # Ruta de destino en el almacenamiento
+    remote_path = db.Column(db.String(255), nullable=False)
+    # Estado del backend (JSON): id de la subida multipart, URI de la sesión...
+    state = db.Column(db.Text)
+    # Bytes confirmados por el servidor y SHA-256 de esos bytes (o del
+    # artefacto completo si se generó en disco, ver StagedReader)
+    offset = db.Column(db.BigInteger, default=0)
+    sha256 = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
 class Notification(db.Model):
     __tablename__ = 'notifications'
     
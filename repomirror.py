@@ -5,10 +5,12 @@ RepoMirror - Herramienta para clonar y respaldar repositorios de GitHub
 
 import os
 import sys
+import time
 import logging
 from typing import Optional, List, Dict, Any
 import click
 from rich.console import Console
+from rich.table import Table
 from rich.logging import RichHandler
 
 # Configuración de logging
@@ -77,5 +79,79 @@ def backup(repo_url: str, storage: str):
     else:
         console.print(f"[red]✗[/red] Error al realizar el respaldo")
 
+@cli.command('benchmark-compression')
+@click.argument('path', type=click.Path(exists=True, file_okay=False))
+@click.option('--codec', '-c', 'codecs', multiple=True, help='Codec a medir (zstd, lz4, gzip, none); por defecto todos')
+@click.option('--level', '-l', type=int, help='Nivel de compresión')
+@click.option('--threads', '-t', type=int, default=-1, help='Hilos de zstd (-1 = uno por núcleo)')
+def benchmark_compression(path: str, codecs: List[str], level: Optional[int], threads: int):
+    """Mide la velocidad y el ratio de cada codec empaquetando un directorio."""
+    from services.compression import CODECS, get_codec
+    from services.archive_stream import ArchiveStream
+
+    table = Table(title=f"Compresión de {path}")
+    for column in ('Codec', 'Original (MB)', 'Comprimido (MB)', 'Ratio', 'MB/s'):
+        table.add_column(column)
+
+    for name in codecs or CODECS:
+        try:
+            codec = get_codec(name, level, threads)
+        except ValueError as e:
+            console.print(f"[yellow]![/yellow] {e}")
+            continue
+
+        started = time.monotonic()
+        with ArchiveStream.from_directory(path, os.path.basename(path.rstrip('/')), codec) as stream:
+            while stream.read(1024 * 1024):
+                pass
+        elapsed = time.monotonic() - started
+
+        table.add_row(
+            name,
+            f"{stream.bytes_in / 1024 / 1024:.1f}",
+            f"{stream.bytes_read / 1024 / 1024:.1f}",
+            f"{stream.bytes_read / stream.bytes_in:.2f}" if stream.bytes_in else "-",
+            f"{stream.bytes_in / 1024 / 1024 / elapsed:.1f}" if elapsed else "-"
+        )
+
+    console.print(table)
+
+@cli.command()
+@click.option('--config', '-c', 'config_path', type=click.Path(exists=True, dir_okay=False), help='Archivo de configuración (por defecto CONFIG_PATH o config.yaml)')
+@click.option('--concurrency', '-n', type=int, help='Backups procesados a la vez (por defecto workers.pool_size)')
+def worker(config_path: Optional[str], concurrency: Optional[int]):
+    """Procesa backups de la cola compartida en la base de datos.
+
+    Se pueden ejecutar varios workers, en la misma o en distintas máquinas,
+    contra la misma base de datos: cada backup lo procesa un solo worker y
+    los de un worker caído los reclama otro al caducar su lease.
+    """
+    import signal
+    import threading
+
+    if config_path:
+        os.environ['CONFIG_PATH'] = config_path
+    # La aplicación se importa sin arrancar sus servicios (ver app.py)
+    os.environ['REPOMIRROR_WORKER'] = '1'
+    import app as application
+
+    application.init_db()
+    queue = application.backup_queue
+    if concurrency is not None:
+        queue.pool_size = concurrency
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stop.set())
+    queue.start()
+    console.print(f"[green]✓[/green] Worker {queue.worker_id} procesando hasta {queue.pool_size} backups a la vez")
+    try:
+        while not stop.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+
+    console.print("Deteniendo el worker cuando terminen los backups en curso...")
+    queue.stop()
+
 if __name__ == '__main__':
     cli() 
\ No newline at end of file
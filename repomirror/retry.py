@@ -0,0 +1,206 @@
+from typing import Any, Awaitable, Callable, Dict, Optional
+import asyncio
+import errno
+import logging
+import random
+import socket
+import threading
+import time
+
+# Errores de red del sistema que suelen ser pasajeros
+TRANSIENT_ERRNOS = {
+    errno.ECONNRESET, errno.ECONNREFUSED, errno.ECONNABORTED, errno.EPIPE,
+    errno.ETIMEDOUT, errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ENETDOWN
+}
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(Exception):
+    """El destino falló demasiadas veces seguidas y se rechazan las llamadas."""
+    pass
+
+def is_transient(error: BaseException, classify: Optional[Callable[[BaseException], Optional[bool]]] = None) -> bool:
+    """Indica si un error es pasajero y merece la pena reintentar la operación.
+
+    Se recorre la cadena de excepciones (los backends envuelven los errores
+    de sus librerías en un Exception genérico) hasta encontrar una que se
+    sepa clasificar. Lo que no se reconoce se considera definitivo.
+
+    Args:
+        error: Excepción a clasificar
+        classify: Clasificador específico (p. ej. el del backend) que devuelve
+            True/False o None si no reconoce la excepción
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        result = classify(error) if classify else None
+        if result is None:
+            result = _classify_builtin(error)
+        if result is not None:
+            return result
+        error = error.__cause__ or error.__context__
+    return False
+
+def _classify_builtin(error: BaseException) -> Optional[bool]:
+    if isinstance(error, CircuitOpenError):
+        return False
+    if isinstance(error, (TimeoutError, ConnectionError, EOFError, socket.gaierror)):
+        # EOFError: ftplib cuando el servidor cierra la conexión de control
+        return True
+    if isinstance(error, OSError) and error.errno is not None:
+        return error.errno in TRANSIENT_ERRNOS
+    return None
+
+class RetryPolicy:
+    """Reintentos con espera exponencial y jitter completo.
+    
+    Antes del reintento n se espera un tiempo aleatorio entre 0 y
+    min(max_delay, base_delay * 2^n), de modo que los workers que fallaron a
+    la vez no vuelven a llamar al servicio a la vez.
+    """
+    
+    def __init__(self, max_retries: int = 3, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.max_retries = max(int(max_retries or 0), 0)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def backoff(self, attempt: int) -> float:
+        """Segundos de espera antes del reintento `attempt` (empezando en 0)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+    
+    def should_retry(self, error: BaseException, attempt: int,
+                     classify: Optional[Callable[[BaseException], Optional[bool]]] = None) -> bool:
+        """Indica si se reintenta una operación que falló en el intento `attempt`."""
+        return attempt < self.max_retries and is_transient(error, classify)
+    
+    def call(self, func: Callable[[], Any], description: str = 'operation',
+             breaker: Optional['CircuitBreaker'] = None,
+             classify: Optional[Callable[[BaseException], Optional[bool]]] = None) -> Any:
+        """Ejecuta una función síncrona con reintentos.
+    
+        Args:
+            func: Función sin argumentos a ejecutar
+            description: Descripción de la operación para los logs
+            breaker: Circuit breaker del servicio llamado
+            classify: Clasificador específico de errores
+    
+        Returns:
+            Resultado de la función
+        """
+        attempt = 0
+        while True:
+            if breaker:
+                breaker.allow()
+            try:
+                result = func()
+            except Exception as e:
+                time.sleep(self._failed(e, attempt, description, breaker, classify))
+                attempt += 1
+                continue
+            if breaker:
+                breaker.record_success()
+            return result
+    
+    async def run(self, func: Callable[[], Awaitable[Any]], description: str = 'operation',
+                  breaker: Optional['CircuitBreaker'] = None,
+                  classify: Optional[Callable[[BaseException], Optional[bool]]] = None) -> Any:
+        """Ejecuta una corrutina con reintentos (ver `call`).
+    
+        Args:
+            func: Función sin argumentos que devuelve la corrutina a ejecutar
+            description: Descripción de la operación para los logs
+            breaker: Circuit breaker del servicio llamado
+            classify: Clasificador específico de errores
+        """
+        attempt = 0
+        while True:
+            if breaker:
+                breaker.allow()
+            try:
+                result = await func()
+            except Exception as e:
+                await asyncio.sleep(self._failed(e, attempt, description, breaker, classify))
+                attempt += 1
+                continue
+            if breaker:
+                breaker.record_success()
+            return result
+    
+    def _failed(self, error, attempt, description, breaker, classify):
+        """Registra un intento fallido y devuelve la espera hasta el siguiente, o relanza el error."""
+        transient = is_transient(error, classify)
+        if breaker:
+            breaker.record_failure() if transient else breaker.record_success()
+        if not transient or attempt >= self.max_retries:
+            raise error
+        delay = self.backoff(attempt)
+        logger.warning(f'{description} failed ({str(error)}), retrying in {delay:.1f}s '
+                       f'({attempt + 1}/{self.max_retries})')
+        return delay
+
+class CircuitBreaker:
+    """Circuit breaker de un servicio remoto.
+    
+    Tras `failure_threshold` errores pasajeros seguidos el circuito se abre y
+    las llamadas fallan al momento con CircuitOpenError, sin esperar a los
+    timeouts del servicio caído. Pasados `reset_timeout` segundos se deja
+    pasar una única llamada de prueba: si funciona el circuito se cierra y si
+    falla vuelve a abrirse. Los errores definitivos (p. ej. un archivo que no
+    existe) demuestran que el servicio responde y no cuentan como fallos.
+    """
+    
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 60.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+    
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if self._trial or time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half_open'
+            return 'open'
+    
+    def allow(self) -> None:
+        """Comprueba si se puede llamar al servicio; si no, lanza CircuitOpenError."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                # Llamada de prueba; si no llega a informar del resultado se
+                # permite otra pasado otro `reset_timeout`
+                self._opened_at = time.monotonic()
+                self._trial = True
+                return
+            retry_in = max(self.reset_timeout - (time.monotonic() - self._opened_at), 0)
+        raise CircuitOpenError(
+            f'{self.name} no disponible tras {self.failures} errores seguidos '
+            f'(próximo intento en {retry_in:.0f}s)'
+        )
+    
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f'Circuit {self.name} closed')
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+    
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self._opened_at is None and self.failures >= self.failure_threshold):
+                logger.warning(f'Circuit {self.name} open after {self.failures} consecutive failures')
+                self._opened_at = time.monotonic()
+            self._trial = False
+    
+    def stats(self) -> Dict[str, Any]:
+        """Estado del circuito y errores seguidos."""
+        return {'state': self.state, 'failures': self.failures}
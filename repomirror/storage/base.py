@@ -1,6 +1,41 @@
 from abc import ABC, abstractmethod
-from typing import BinaryIO, Optional, Dict, Any
+from typing import AsyncIterator, BinaryIO, Callable, Optional, Dict, Any, List, Tuple
 from pathlib import Path
+from datetime import datetime
+import asyncio
+
+class UploadResumeError(Exception):
+    """La subida interrumpida no se puede continuar y hay que empezarla de nuevo."""
+    pass
+
+class UploadCheckpoint:
+    """Punto de control de una subida reanudable.
+    
+    El backend guarda en `state` lo que necesita para continuar la subida
+    desde otro proceso (id de la subida multipart, URI de la sesión...) y
+    llama a `save` cada vez que el servidor confirma más datos. Al reanudar,
+    el flujo se entrega ya posicionado en `offset`, el último byte confirmado.
+    """
+    
+    def __init__(self, state: Optional[Dict[str, Any]] = None,
+                 on_save: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.state = dict(state or {})
+        self._on_save = on_save
+    
+    @property
+    def offset(self) -> int:
+        """Bytes confirmados por el servidor."""
+        return int(self.state.get('offset', 0))
+    
+    def save(self, offset: int, **state: Any) -> None:
+        """Registra los bytes confirmados y el estado necesario para continuar."""
+        self.state.update(state, offset=offset)
+        if self._on_save:
+            self._on_save(dict(self.state))
+    
+    def reset(self) -> None:
+        """Descarta el estado para empezar la subida desde el principio."""
+        self.state = {}
 
 class StorageBackend(ABC):
     """Clase base abstracta para todos los backends de almacenamiento."""
@@ -28,6 +63,75 @@ class StorageBackend(ABC):
         pass
     
     @abstractmethod
+    async def upload_stream(self, stream: BinaryIO, destination: str,
+                            checkpoint: Optional[UploadCheckpoint] = None) -> str:
+        """Sube al almacenamiento el contenido de un flujo de tamaño desconocido.
+        
+        El flujo se lee por fragmentos, sin cargarlo entero en memoria ni
+        volcarlo antes a disco. Con un `checkpoint` la subida es reanudable:
+        su estado se guarda a medida que el servidor confirma datos y, si ya
+        tiene estado (ver resume_upload), se continúa desde `checkpoint.offset`.
+        
+        Args:
+            stream: Objeto con un método read(n) del que leer los datos
+            destination: Ruta de destino en el almacenamiento
+            checkpoint: Punto de control de una subida reanudable
+            
+        Returns:
+            str: URL o identificador del archivo subido
+        """
+        pass
+    
+    async def resume_upload(self, checkpoint: UploadCheckpoint) -> bool:
+        """Comprueba si una subida interrumpida puede continuar desde su punto de control.
+        
+        Los backends sin subidas reanudables devuelven siempre False.
+        
+        Args:
+            checkpoint: Punto de control guardado por upload_stream
+            
+        Returns:
+            bool: True si el servidor conserva lo confirmado hasta `checkpoint.offset`
+        """
+        return False
+    
+    async def abort_upload(self, state: Dict[str, Any]) -> None:
+        """Descarta una subida reanudable y los datos parciales que dejó.
+        
+        Args:
+            state: Estado de un punto de control (UploadCheckpoint.state)
+        """
+        pass
+    
+    async def abort_stale_uploads(self, prefix: Optional[str], before: datetime,
+                                  keep: List[Dict[str, Any]]) -> int:
+        """Descarta las subidas incompletas huérfanas que el almacenamiento conserva.
+        
+        Cubre las subidas de las que no llegó a guardarse ningún punto de control.
+        
+        Args:
+            prefix: Prefijo de los artefactos
+            before: Solo se descartan las subidas iniciadas antes de esta fecha
+            keep: Estados de los puntos de control que siguen guardados
+            
+        Returns:
+            int: Número de subidas descartadas
+        """
+        return 0
+    
+    @abstractmethod
+    def classify_error(self, error: BaseException) -> Optional[bool]:
+        """Clasifica un error de la librería del backend para decidir si se reintenta.
+        
+        Args:
+            error: Excepción (o una de las de su cadena) a clasificar
+            
+        Returns:
+            True si es pasajero, False si es definitivo o None si no se reconoce
+            (ver repomirror.retry.is_transient)
+        """
+        return None
+    
     async def download_file(self, file_id: str, destination: Path) -> Path:
         """Descarga un archivo del almacenamiento.
         
@@ -52,17 +156,83 @@ class StorageBackend(ABC):
         """
         pass
     
-    @abstractmethod
+    async def delete_files(self, file_ids: List[str]) -> Dict[str, str]:
+        """Elimina varios archivos del almacenamiento.
+        
+        La implementación por defecto lanza hasta `delete_concurrency` llamadas
+        a delete_file en paralelo; los backends con borrado por lotes la
+        sobreescriben. Un archivo que ya no existe se considera eliminado,
+        para que un borrado interrumpido pueda repetirse.
+        
+        Args:
+            file_ids: Identificadores de los archivos a eliminar
+            
+        Returns:
+            Dict[str, str]: Mensaje de error de cada archivo que no se pudo eliminar
+        """
+        semaphore = asyncio.Semaphore(int(self.config.get('delete_concurrency', 8)))
+        errors = {}
+        
+        async def delete(file_id):
+            async with semaphore:
+                try:
+                    await self.delete_file(file_id)
+                except Exception as e:
+                    errors[file_id] = str(e)
+        
+        await asyncio.gather(*(delete(file_id) for file_id in file_ids))
+        return errors
+    
     async def list_files(self, prefix: Optional[str] = None) -> list:
         """Lista los archivos en el almacenamiento.
         
+        Carga el listado completo en memoria; para almacenamientos grandes es
+        preferible recorrerlo con iter_files.
+        
         Args:
             prefix: Prefijo opcional para filtrar archivos
             
         Returns:
             list: Lista de archivos encontrados
         """
-        pass
+        return [item async for item in self.iter_files(prefix)]
+    
+    async def iter_files(self, prefix: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Recorre los archivos del almacenamiento página a página.
+        
+        La siguiente página se pide mientras el llamador procesa la actual, y
+        nunca hay más de dos páginas en memoria. Cada elemento incluye
+        'file_id', el identificador que aceptan delete_file y get_file_info.
+        
+        Args:
+            prefix: Prefijo opcional para filtrar archivos
+            
+        Yields:
+            Dict[str, Any]: Información de cada archivo
+        """
+        next_page = asyncio.ensure_future(self._list_page(prefix, None))
+        try:
+            while next_page is not None:
+                files, page_token = await next_page
+                next_page = asyncio.ensure_future(self._list_page(prefix, page_token)) if page_token else None
+                for item in files:
+                    yield item
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+    
+    async def _list_page(self, prefix: Optional[str],
+                         page_token: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Obtiene una página del listado de archivos.
+        
+        Args:
+            prefix: Prefijo opcional para filtrar archivos
+            page_token: Token de la página a pedir (None para la primera)
+            
+        Returns:
+            Tuple: Archivos de la página y token de la siguiente (None si es la última)
+        """
+        raise NotImplementedError
     
     @abstractmethod
     async def get_file_info(self, file_id: str) -> Dict[str, Any]:
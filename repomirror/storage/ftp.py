@@ -1,12 +1,100 @@
-from ftplib import FTP
+from ftplib import FTP, error_perm, error_proto, error_reply, error_temp
 from pathlib import Path
-from typing import Dict, Any, Optional, List
-import aiofiles
+from typing import AsyncIterator, BinaryIO, Callable, Dict, Any, Optional, List
+from collections import deque
+from contextlib import contextmanager
 import asyncio
-from datetime import datetime
+import queue
+import threading
+import time
 import os
 
-from .base import StorageBackend
+from .base import StorageBackend, UploadCheckpoint, UploadResumeError
+
+class FTPConnectionPool:
+    """Pool acotado de conexiones FTP autenticadas.
+    
+    Las conexiones se reutilizan entre llamadas para no repetir la conexión
+    TCP y el login en cada operación. Antes de reutilizar una conexión ociosa
+    se comprueba con un NOOP; las que llevan demasiado tiempo sin usarse o no
+    responden se descartan.
+    """
+    
+    def __init__(self, factory: Callable[[], FTP], max_size: int = 4, max_idle: float = 60):
+        self._factory = factory
+        self._idle = deque()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self.max_idle = max_idle
+    
+    def acquire(self) -> FTP:
+        """Obtiene una conexión del pool (bloquea si están todas en uso)."""
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    return self._factory()
+                
+                ftp, last_used = item
+                if self._is_healthy(ftp, last_used):
+                    return ftp
+                self._close(ftp)
+        except BaseException:
+            self._slots.release()
+            raise
+    
+    def release(self, ftp: FTP, discard: bool = False) -> None:
+        """Devuelve una conexión al pool o la cierra si quedó inutilizable."""
+        if discard:
+            self._close(ftp)
+        else:
+            with self._lock:
+                self._idle.append((ftp, time.monotonic()))
+        self._slots.release()
+    
+    @contextmanager
+    def connection(self):
+        """Reserva una conexión mientras dura el bloque `with`."""
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except error_perm:
+            # Error del servidor sobre el comando (p. ej. archivo inexistente):
+            # la conexión sigue siendo válida
+            self.release(ftp)
+            raise
+        except BaseException:
+            self.release(ftp, discard=True)
+            raise
+        else:
+            self.release(ftp)
+    
+    def close(self) -> None:
+        """Cierra las conexiones ociosas."""
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for ftp, _ in idle:
+            self._close(ftp)
+    
+    def _is_healthy(self, ftp: FTP, last_used: float) -> bool:
+        if time.monotonic() - last_used > self.max_idle:
+            return False
+        try:
+            ftp.voidcmd('NOOP')
+            return True
+        except Exception:
+            return False
+    
+    def _close(self, ftp: FTP) -> None:
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+class _ListingCancelled(Exception):
+    pass
 
 class FTPStorage(StorageBackend):
     """Implementación del backend de almacenamiento para FTP."""
@@ -23,6 +111,16 @@ class FTPStorage(StorageBackend):
         self.password = self.config['password']
         self.port = self.config['port']
         self.base_path = self.config['path']
+        self.block_size = int(self.config.get('block_size_kb', 64)) * 1024
+        # Cada cuántos bytes enviados se guarda el punto de control de una subida
+        self.checkpoint_interval = int(self.config.get('checkpoint_mb', 16)) * 1024 * 1024
+        self.list_page_size = int(self.config.get('list_page_size', 1000))
+        self.pool_size = int(self.config.get('pool_size', 4))
+        self.pool = FTPConnectionPool(
+            self._get_ftp_connection,
+            max_size=self.pool_size,
+            max_idle=float(self.config.get('max_idle', 60))
+        )
     
     def _get_ftp_connection(self) -> FTP:
         """Obtiene una conexión FTP."""
@@ -31,6 +129,19 @@ class FTPStorage(StorageBackend):
         ftp.login(self.username, self.password)
         return ftp
     
+    async def _run(self, operation: Callable[[FTP], Any]) -> Any:
+        """Ejecuta una operación con una conexión del pool en el thread pool.
+        
+        Las operaciones usan rutas absolutas en lugar de `cwd` para que las
+        conexiones reutilizadas no dependan del directorio de una llamada anterior.
+        """
+        def run():
+            with self.pool.connection() as ftp:
+                return operation(ftp)
+        
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, run)
+    
     async def upload_file(self, file_path: Path, destination: str) -> str:
         """Sube un archivo al servidor FTP."""
         try:
@@ -38,56 +149,120 @@ class FTPStorage(StorageBackend):
             remote_path = os.path.join(self.base_path, destination)
             remote_dir = os.path.dirname(remote_path)
             
-            loop = asyncio.get_event_loop()
-            ftp = await loop.run_in_executor(None, self._get_ftp_connection)
+            def upload(ftp: FTP):
+                # Crear directorios si no existen
+                try:
+                    ftp.mkd(remote_dir)
+                except error_perm:
+                    pass  # El directorio ya existe
+                
+                # Subir el archivo por bloques, sin cargarlo en memoria
+                with open(file_path, 'rb') as f:
+                    ftp.storbinary(f'STOR {remote_path}', f, self.block_size)
             
-            # Crear directorios si no existen
-            try:
-                await loop.run_in_executor(None, lambda: ftp.mkd(remote_dir))
-            except:
-                pass  # El directorio ya existe
+            await self._run(upload)
             
-            # Cambiar al directorio
-            await loop.run_in_executor(None, lambda: ftp.cwd(remote_dir))
+            return remote_path
+        except Exception as e:
+            raise Exception(f"Error al subir archivo a FTP: {str(e)}")
+    
+    async def upload_stream(self, stream: BinaryIO, destination: str,
+                            checkpoint: Optional[UploadCheckpoint] = None) -> str:
+        """Sube un flujo al servidor FTP.
+        
+        El punto de control guarda los bytes enviados cada `checkpoint_mb` MB;
+        una subida reanudada continúa desde ahí con REST.
+        """
+        try:
+            remote_path = os.path.join(self.base_path, destination)
+            offset = checkpoint.offset if checkpoint is not None and 'path' in checkpoint.state else 0
             
-            # Subir el archivo
-            async with aiofiles.open(file_path, 'rb') as f:
-                content = await f.read()
+            def upload(ftp: FTP):
+                sent = saved = offset
+                
+                def on_block(block):
+                    nonlocal sent, saved
+                    sent += len(block)
+                    if sent - saved >= self.checkpoint_interval:
+                        checkpoint.save(sent, path=remote_path)
+                        saved = sent
+                
+                if checkpoint is not None and not offset:
+                    checkpoint.save(0, path=remote_path)
+                
+                # storbinary lee el flujo por bloques y los envía por el socket de datos
+                ftp.storbinary(
+                    f'STOR {remote_path}',
+                    stream,
+                    self.block_size,
+                    callback=on_block if checkpoint is not None else None,
+                    rest=offset or None
+                )
                 
-            await loop.run_in_executor(
-                None,
-                lambda: ftp.storbinary(f'STOR {os.path.basename(remote_path)}', io.BytesIO(content))
-            )
+                if offset:
+                    # Con REST el servidor no trunca el archivo: si ya tenía más
+                    # bytes que el artefacto, el final sería basura
+                    ftp.voidcmd('TYPE I')
+                    if ftp.size(remote_path) != sent:
+                        raise UploadResumeError(f"El tamaño de {remote_path} no coincide tras reanudar la subida")
             
-            # Cerrar la conexión
-            await loop.run_in_executor(None, ftp.quit)
+            await self._run(upload)
             
             return remote_path
+        except UploadResumeError:
+            raise
         except Exception as e:
             raise Exception(f"Error al subir archivo a FTP: {str(e)}")
     
+    async def resume_upload(self, checkpoint: UploadCheckpoint) -> bool:
+        """Comprueba que el archivo parcial tiene al menos los bytes del punto de control."""
+        if 'path' not in checkpoint.state:
+            return False
+        
+        def remote_size(ftp: FTP):
+            try:
+                ftp.voidcmd('TYPE I')
+                return ftp.size(checkpoint.state['path'])
+            except error_perm:
+                return None
+        
+        size = await self._run(remote_size)
+        return size is not None and size >= checkpoint.offset
+    
+    async def abort_upload(self, state: Dict[str, Any]) -> None:
+        """Elimina el archivo parcial de una subida interrumpida."""
+        if 'path' not in state:
+            return
+        
+        def delete(ftp: FTP):
+            try:
+                ftp.delete(state['path'])
+            except error_perm as e:
+                if not str(e).startswith('550'):
+                    raise
+        
+        await self._run(delete)
+    
+    def classify_error(self, error: BaseException) -> Optional[bool]:
+        """Respuestas 4xx y respuestas inesperadas: pasajeras; respuestas 5xx: definitivas."""
+        if isinstance(error, (error_temp, error_reply, error_proto)):
+            return True
+        if isinstance(error, error_perm):
+            return False
+        return None
+    
     async def download_file(self, file_id: str, destination: Path) -> Path:
         """Descarga un archivo del servidor FTP."""
         try:
             # Crear el directorio de destino si no existe
             destination.parent.mkdir(parents=True, exist_ok=True)
             
-            loop = asyncio.get_event_loop()
-            ftp = await loop.run_in_executor(None, self._get_ftp_connection)
-            
-            # Cambiar al directorio del archivo
-            remote_dir = os.path.dirname(file_id)
-            await loop.run_in_executor(None, lambda: ftp.cwd(remote_dir))
-            
-            # Descargar el archivo
-            with open(destination, 'wb') as f:
-                await loop.run_in_executor(
-                    None,
-                    lambda: ftp.retrbinary(f'RETR {os.path.basename(file_id)}', f.write)
-                )
+            def download(ftp: FTP):
+                # Escribir cada bloque en disco según llega
+                with open(destination, 'wb') as f:
+                    ftp.retrbinary(f'RETR {file_id}', f.write, self.block_size)
             
-            # Cerrar la conexión
-            await loop.run_in_executor(None, ftp.quit)
+            await self._run(download)
             
             return destination
         except Exception as e:
@@ -96,93 +271,142 @@ class FTPStorage(StorageBackend):
     async def delete_file(self, file_id: str) -> bool:
         """Elimina un archivo del servidor FTP."""
         try:
-            loop = asyncio.get_event_loop()
-            ftp = await loop.run_in_executor(None, self._get_ftp_connection)
-            
-            # Cambiar al directorio del archivo
-            remote_dir = os.path.dirname(file_id)
-            await loop.run_in_executor(None, lambda: ftp.cwd(remote_dir))
-            
-            # Eliminar el archivo
-            await loop.run_in_executor(
-                None,
-                lambda: ftp.delete(os.path.basename(file_id))
-            )
-            
-            # Cerrar la conexión
-            await loop.run_in_executor(None, ftp.quit)
-            
+            await self._run(lambda ftp: ftp.delete(file_id))
             return True
         except Exception as e:
             raise Exception(f"Error al eliminar archivo de FTP: {str(e)}")
     
-    async def list_files(self, prefix: Optional[str] = None) -> List[Dict[str, Any]]:
-        """Lista los archivos en el servidor FTP."""
+    async def delete_files(self, file_ids: List[str]) -> Dict[str, str]:
+        """Elimina varios archivos del servidor FTP.
+        
+        Los borrados se reparten entre tantas conexiones del pool como admite,
+        y cada una envía sus DELE seguidos sin volver a conectarse.
+        """
+        errors = {}
+        
+        def delete_share(share):
+            with self.pool.connection() as ftp:
+                for file_id in share:
+                    try:
+                        ftp.delete(file_id)
+                    except error_perm as e:
+                        # 550: el archivo no existe (p. ej. borrado en una ejecución anterior)
+                        if not str(e).startswith('550') or self._exists(ftp, file_id):
+                            errors[file_id] = str(e)
+        
+        workers = max(min(self.pool_size, len(file_ids)), 1)
+        shares = [file_ids[i::workers] for i in range(workers)]
+        
+        loop = asyncio.get_event_loop()
+        results = await asyncio.gather(
+            *(loop.run_in_executor(None, delete_share, share) for share in shares),
+            return_exceptions=True
+        )
+        for share, result in zip(shares, results):
+            if isinstance(result, Exception):
+                for file_id in share:
+                    errors.setdefault(file_id, f"Error al eliminar archivo de FTP: {str(result)}")
+        return errors
+    
+    def _exists(self, ftp: FTP, path: str) -> bool:
+        """Comprueba si existe un archivo en el servidor FTP."""
         try:
-            loop = asyncio.get_event_loop()
-            ftp = await loop.run_in_executor(None, self._get_ftp_connection)
-            
-            # Cambiar al directorio base
-            await loop.run_in_executor(None, lambda: ftp.cwd(self.base_path))
+            ftp.voidcmd('TYPE I')
+            ftp.size(path)
+            return True
+        except error_perm:
+            return False
+    
+    async def iter_files(self, prefix: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Recorre los archivos del servidor FTP.
+        
+        FTP no pagina los listados: un hilo lee la respuesta de LIST según llega
+        y la entrega en páginas a una cola acotada, de modo que el servidor
+        se lee por delante del llamador sin acumular el listado en memoria.
+        """
+        pages = queue.Queue(maxsize=2)
+        cancelled = threading.Event()
+        
+        def put(item):
+            # Espera con timeout para poder abandonar si el llamador deja de leer
+            while not cancelled.is_set():
+                try:
+                    pages.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+            raise _ListingCancelled()
+        
+        def produce():
+            page = []
             
-            # Obtener lista de archivos
-            files = []
             def process_line(line):
                 parts = line.split()
                 if len(parts) >= 9:
                     filename = ' '.join(parts[8:])
                     if not prefix or filename.startswith(prefix):
-                        files.append({
+                        remote_path = os.path.join(self.base_path, filename)
+                        page.append({
+                            'file_id': remote_path,
                             'name': filename,
                             'size': int(parts[4]),
                             'modified_time': f"{parts[5]} {parts[6]} {parts[7]}",
-                            'url': f"ftp://{self.host}{os.path.join(self.base_path, filename)}"
+                            'url': f"ftp://{self.host}{remote_path}"
                         })
+                        if len(page) >= self.list_page_size:
+                            put(page[:])
+                            page.clear()
             
-            await loop.run_in_executor(
-                None,
-                lambda: ftp.retrlines('LIST', process_line)
-            )
-            
-            # Cerrar la conexión
-            await loop.run_in_executor(None, ftp.quit)
-            
-            return files
-        except Exception as e:
-            raise Exception(f"Error al listar archivos de FTP: {str(e)}")
+            try:
+                with self.pool.connection() as ftp:
+                    ftp.retrlines(f'LIST {self.base_path}', process_line)
+                put(page)
+                put(None)
+            except _ListingCancelled:
+                pass
+            except Exception as e:
+                try:
+                    put(e)
+                except _ListingCancelled:
+                    pass
+        
+        loop = asyncio.get_event_loop()
+        producer = loop.run_in_executor(None, produce)
+        try:
+            while True:
+                page = await loop.run_in_executor(None, pages.get)
+                if page is None:
+                    break
+                if isinstance(page, Exception):
+                    raise Exception(f"Error al listar archivos de FTP: {str(page)}")
+                for item in page:
+                    yield item
+        finally:
+            cancelled.set()
+            await producer
+            # Desbloquea una lectura de la cola que hubiera quedado pendiente
+            try:
+                pages.put_nowait(None)
+            except queue.Full:
+                pass
     
     async def get_file_info(self, file_id: str) -> Dict[str, Any]:
         """Obtiene información de un archivo en el servidor FTP."""
         try:
-            loop = asyncio.get_event_loop()
-            ftp = await loop.run_in_executor(None, self._get_ftp_connection)
-            
-            # Cambiar al directorio del archivo
-            remote_dir = os.path.dirname(file_id)
-            await loop.run_in_executor(None, lambda: ftp.cwd(remote_dir))
-            
-            # Obtener información del archivo
-            filename = os.path.basename(file_id)
-            size = await loop.run_in_executor(
-                None,
-                lambda: ftp.size(filename)
-            )
-            
-            # Obtener fecha de modificación
-            mdtm = await loop.run_in_executor(
-                None,
-                lambda: ftp.sendcmd(f'MDTM {filename}')
-            )
-            modified_time = mdtm.split()[1]
+            def file_info(ftp: FTP):
+                # Obtener tamaño y fecha de modificación
+                ftp.voidcmd('TYPE I')
+                size = ftp.size(file_id)
+                mdtm = ftp.sendcmd(f'MDTM {file_id}')
+                return size, mdtm.split()[1]
             
-            # Cerrar la conexión
-            await loop.run_in_executor(None, ftp.quit)
+            size, modified_time = await self._run(file_info)
             
             return {
-                'name': filename,
+                'name': os.path.basename(file_id),
                 'size': size,
                 'modified_time': modified_time,
                 'url': f"ftp://{self.host}{file_id}"
             }
         except Exception as e:
-            raise Exception(f"Error al obtener información del archivo de FTP: {str(e)}") 
\ No newline at end of file
+            raise Exception(f"Error al obtener información del archivo de FTP: {str(e)}")
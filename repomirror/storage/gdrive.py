@@ -2,16 +2,17 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaUpload
 from pathlib import Path
-from typing import Dict, Any, Optional, List
-import io
+from typing import BinaryIO, Callable, Dict, Any, Optional, List, Tuple
+import httplib2
 import os
 import pickle
-import aiofiles
+import socket
 import asyncio
 
-from .base import StorageBackend
+from .base import StorageBackend, UploadCheckpoint
 
 class GoogleDriveStorage(StorageBackend):
     """Implementación del backend de almacenamiento para Google Drive."""
@@ -27,6 +28,11 @@ class GoogleDriveStorage(StorageBackend):
         
         self.credentials_file = self.config['credentials_file']
         self.token_file = self.config['token_file']
+        # Drive exige fragmentos múltiplos de 256 KB
+        self.chunk_size = max(int(self.config.get('chunk_size_mb', 8)), 1) * 1024 * 1024
+        # Reintentos internos de la API por fragmento y reanudaciones de una descarga
+        self.num_retries = int(self.config.get('num_retries', 3))
+        self.max_resume_attempts = int(self.config.get('max_resume_attempts', 5))
         self.service = self._get_service()
     
     def _get_service(self):
@@ -43,6 +49,8 @@ class GoogleDriveStorage(StorageBackend):
             if creds and creds.expired and creds.refresh_token:
                 creds.refresh(Request())
             else:
+                if not os.path.exists(self.credentials_file):
+                    raise ValueError(f"Archivo de credenciales no encontrado: {self.credentials_file}")
                 flow = InstalledAppFlow.from_client_secrets_file(
                     self.credentials_file, self.SCOPES)
                 creds = flow.run_local_server(port=0)
@@ -81,34 +89,165 @@ class GoogleDriveStorage(StorageBackend):
         except Exception as e:
             raise Exception(f"Error al subir archivo a Google Drive: {str(e)}")
     
-    async def download_file(self, file_id: str, destination: Path) -> Path:
-        """Descarga un archivo de Google Drive."""
+    async def upload_stream(self, stream: BinaryIO, destination: str,
+                            checkpoint: Optional[UploadCheckpoint] = None) -> str:
+        """Sube un flujo a Google Drive mediante una subida reanudable.
+        
+        El punto de control guarda la URI de la sesión de subida y los bytes
+        que Drive confirmó tras cada fragmento.
+        """
         try:
-            request = self.service.files().get_media(fileId=file_id)
-            
-            # Crear el directorio de destino si no existe
-            destination.parent.mkdir(parents=True, exist_ok=True)
+            file_metadata = {
+                'name': destination,
+                'mimeType': 'application/octet-stream'
+            }
             
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
+            resumed = checkpoint is not None and 'session_uri' in checkpoint.state
+            offset = checkpoint.offset if resumed else 0
+            media = _StreamMediaUpload(stream, 'application/octet-stream', self.chunk_size, offset)
+            request = self.service.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields='id'
+            )
+            if resumed:
+                request.resumable_uri = checkpoint.state['session_uri']
+                request.resumable_progress = offset
+                # Con _in_error_state el cliente pregunta primero a Drive cuántos
+                # bytes tiene y continúa desde ahí; no hay otra forma de
+                # reanudar una sesión existente
+                request._in_error_state = True
             
             loop = asyncio.get_event_loop()
-            done = False
-            while not done:
-                status, done = await loop.run_in_executor(
+            response = None
+            while response is None:
+                _, response = await loop.run_in_executor(
                     None,
-                    lambda: downloader.next_chunk()
+                    lambda: request.next_chunk(num_retries=self.num_retries)
                 )
+                if checkpoint is not None and response is None:
+                    checkpoint.save(request.resumable_progress, session_uri=request.resumable_uri)
             
-            # Guardar el archivo
-            fh.seek(0)
-            async with aiofiles.open(destination, 'wb') as f:
-                await f.write(fh.read())
+            return response.get('id')
+        except Exception as e:
+            raise Exception(f"Error al subir archivo a Google Drive: {str(e)}")
+    
+    async def resume_upload(self, checkpoint: UploadCheckpoint) -> bool:
+        """Comprueba que la sesión de subida sigue abierta en Drive."""
+        if 'session_uri' not in checkpoint.state:
+            return False
+        
+        def query():
+            # Consulta de estado del protocolo de subidas reanudables (sin
+            # datos), con el cliente HTTP autenticado del servicio
+            return self.service._http.request(
+                checkpoint.state['session_uri'],
+                method='PUT',
+                headers={'Content-Range': 'bytes */*', 'Content-Length': '0'}
+            )
+        
+        loop = asyncio.get_event_loop()
+        resp, _ = await loop.run_in_executor(None, query)
+        if resp.status == 308:
+            # Drive puede tener más bytes que el punto de control, nunca menos
+            confirmed = int(resp['range'].split('-')[1]) + 1 if 'range' in resp else 0
+            return confirmed >= checkpoint.offset
+        return resp.status in (200, 201)
+    
+    async def abort_upload(self, state: Dict[str, Any]) -> None:
+        """Cancela una sesión de subida reanudable de Drive."""
+        if 'session_uri' not in state:
+            return
+        loop = asyncio.get_event_loop()
+        # Drive responde 499 a la cancelación; las sesiones caducan igualmente en una semana
+        await loop.run_in_executor(
+            None,
+            lambda: self.service._http.request(state['session_uri'], method='DELETE')
+        )
+    
+    async def download_file(self, file_id: str, destination: Path,
+                            progress_callback: Optional[Callable[[int, int], None]] = None) -> Path:
+        """Descarga un archivo de Google Drive por fragmentos directamente a disco.
+        
+        Si `destination` ya contiene una descarga parcial, se continúa desde su
+        tamaño actual. Ante un fallo transitorio se reintenta el fragmento en
+        curso sin volver a descargar lo ya escrito. `progress_callback` recibe
+        los bytes descargados y el tamaño total tras cada fragmento.
+        """
+        try:
+            # Crear el directorio de destino si no existe
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            
+            loop = asyncio.get_event_loop()
+            metadata = await loop.run_in_executor(
+                None,
+                lambda: self.service.files().get(fileId=file_id, fields='size').execute()
+            )
+            total_size = int(metadata.get('size', 0))
+            
+            offset = destination.stat().st_size if destination.exists() else 0
+            if offset > total_size:
+                # No es una descarga parcial de este archivo
+                offset = 0
+            
+            with open(destination, 'r+b' if offset else 'wb') as fh:
+                fh.truncate(offset)
+                fh.seek(offset)
+                if offset == total_size:
+                    # Descarga ya completa (o archivo vacío): Drive rechazaría el rango
+                    return destination
+                
+                request = self.service.files().get_media(fileId=file_id)
+                downloader = MediaIoBaseDownload(fh, request, chunksize=self.chunk_size)
+                # MediaIoBaseDownload pide cada fragmento con la cabecera Range a
+                # partir de _progress; no ofrece otra forma de empezar en un offset
+                downloader._progress = offset
+                
+                done = False
+                failures = 0
+                while not done:
+                    try:
+                        _, done = await loop.run_in_executor(
+                            None,
+                            lambda: downloader.next_chunk(num_retries=self.num_retries)
+                        )
+                        failures = 0
+                    except Exception as e:
+                        failures += 1
+                        if not self._is_transient(e) or failures > self.max_resume_attempts:
+                            raise
+                        # Se repite el mismo fragmento: el archivo solo contiene
+                        # los fragmentos que llegaron completos
+                        fh.truncate(downloader._progress)
+                        fh.seek(downloader._progress)
+                        await asyncio.sleep(min(2 ** failures, 30))
+                        continue
+                    
+                    if progress_callback:
+                        progress_callback(downloader._progress, total_size)
             
             return destination
         except Exception as e:
             raise Exception(f"Error al descargar archivo de Google Drive: {str(e)}")
     
+    @staticmethod
+    def _is_transient(error: Exception) -> bool:
+        """Indica si un error de la API o de red puede resolverse reintentando."""
+        if isinstance(error, HttpError):
+            return error.resp.status in (408, 429) or error.resp.status >= 500
+        return isinstance(error, (ConnectionError, TimeoutError, socket.error, httplib2.HttpLib2Error))
+    
+    def classify_error(self, error: BaseException) -> Optional[bool]:
+        """Clasifica los errores de la API y de httplib2 (ver _is_transient)."""
+        if isinstance(error, HttpError):
+            # Drive responde 403 cuando se supera la cuota de peticiones
+            content = error.content or b''
+            rate_limited = error.resp.status == 403 and (b'rateLimitExceeded' in content or b'userRateLimitExceeded' in content)
+            return self._is_transient(error) or rate_limited
+        if isinstance(error, httplib2.HttpLib2Error):
+            return True
+        return None
+    
     async def delete_file(self, file_id: str) -> bool:
         """Elimina un archivo de Google Drive."""
         try:
@@ -121,8 +260,41 @@ class GoogleDriveStorage(StorageBackend):
         except Exception as e:
             raise Exception(f"Error al eliminar archivo de Google Drive: {str(e)}")
     
-    async def list_files(self, prefix: Optional[str] = None) -> List[Dict[str, Any]]:
-        """Lista los archivos en Google Drive."""
+    async def delete_files(self, file_ids: List[str]) -> Dict[str, str]:
+        """Elimina varios archivos de Google Drive con peticiones por lotes.
+        
+        Cada lote agrupa hasta 100 borrados en una sola petición HTTP. Los lotes
+        se envían uno tras otro porque el cliente HTTP del servicio no admite
+        uso concurrente desde varios hilos.
+        """
+        errors = {}
+        
+        def callback(request_id, response, exception):
+            if exception is None:
+                return
+            if isinstance(exception, HttpError) and exception.resp.status == 404:
+                return  # Ya eliminado
+            errors[request_id] = str(exception)
+        
+        def delete_batch(batch):
+            request = self.service.new_batch_http_request(callback=callback)
+            for file_id in batch:
+                request.add(self.service.files().delete(fileId=file_id), request_id=file_id)
+            request.execute()
+        
+        loop = asyncio.get_event_loop()
+        for i in range(0, len(file_ids), 100):
+            batch = file_ids[i:i + 100]
+            try:
+                await loop.run_in_executor(None, delete_batch, batch)
+            except Exception as e:
+                for file_id in batch:
+                    errors.setdefault(file_id, f"Error al eliminar archivo de Google Drive: {str(e)}")
+        return errors
+    
+    async def _list_page(self, prefix: Optional[str],
+                         page_token: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Obtiene una página (hasta 1000 archivos) del listado de Google Drive."""
         try:
             query = f"name contains '{prefix}'" if prefix else None
             
@@ -131,7 +303,8 @@ class GoogleDriveStorage(StorageBackend):
                 None,
                 lambda: self.service.files().list(
                     q=query,
-                    pageSize=100,
+                    pageSize=1000,
+                    pageToken=page_token,
                     fields="nextPageToken, files(id, name, size, modifiedTime)"
                 ).execute()
             )
@@ -139,6 +312,7 @@ class GoogleDriveStorage(StorageBackend):
             files = []
             for item in results.get('files', []):
                 files.append({
+                    'file_id': item['id'],
                     'id': item['id'],
                     'name': item['name'],
                     'size': item.get('size', 0),
@@ -146,7 +320,7 @@ class GoogleDriveStorage(StorageBackend):
                     'url': f"https://drive.google.com/file/d/{item['id']}/view"
                 })
             
-            return files
+            return files, results.get('nextPageToken')
         except Exception as e:
             raise Exception(f"Error al listar archivos de Google Drive: {str(e)}")
     
@@ -171,4 +345,56 @@ class GoogleDriveStorage(StorageBackend):
                 'url': f"https://drive.google.com/file/d/{file['id']}/view"
             }
         except Exception as e:
-            raise Exception(f"Error al obtener información del archivo de Google Drive: {str(e)}") 
\ No newline at end of file
+            raise Exception(f"Error al obtener información del archivo de Google Drive: {str(e)}") 
+
+class _StreamMediaUpload(MediaUpload):
+    """MediaUpload reanudable para flujos de solo lectura de tamaño desconocido.
+    
+    Solo se conserva en memoria el fragmento en curso, que es lo que Drive
+    puede pedir de nuevo si confirma menos bytes de los enviados. Al reanudar
+    una sesión el flujo empieza en `offset`; si Drive confirmó más bytes, los
+    que faltan se leen del flujo y se descartan.
+    """
+    
+    def __init__(self, stream: BinaryIO, mimetype: str, chunksize: int, offset: int = 0):
+        self._stream = stream
+        self._mimetype = mimetype
+        self._chunksize = chunksize
+        self._offset = offset
+        self._buffer = b''
+    
+    def chunksize(self):
+        return self._chunksize
+    
+    def mimetype(self):
+        return self._mimetype
+    
+    def size(self):
+        return None
+    
+    def resumable(self):
+        return True
+    
+    def has_stream(self):
+        return False
+    
+    def getbytes(self, begin, length):
+        if begin < self._offset:
+            raise ValueError(f"No se puede volver a leer el offset {begin} de un flujo")
+        
+        # Descartar lo ya confirmado y leer hasta completar el fragmento
+        while self._offset < begin:
+            if not self._buffer:
+                self._buffer = self._stream.read(min(begin - self._offset, self._chunksize))
+                if not self._buffer:
+                    break
+            skipped = min(begin - self._offset, len(self._buffer))
+            self._buffer = self._buffer[skipped:]
+            self._offset += skipped
+        while len(self._buffer) < length:
+            data = self._stream.read(length - len(self._buffer))
+            if not data:
+                break
+            self._buffer += data
+        
+        return self._buffer[:length]
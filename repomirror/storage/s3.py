@@ -1,12 +1,21 @@
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import Awaitable, BinaryIO, Callable, Dict, Any, Optional, List, Tuple
+from functools import partial
 import aiofiles
 import asyncio
-from datetime import datetime
+from datetime import datetime, timezone
 
-from .base import StorageBackend
+from .base import StorageBackend, UploadCheckpoint
+from ..retry import RetryPolicy
+
+# Códigos de error de S3 que indican un problema pasajero del servicio
+TRANSIENT_ERROR_CODES = (
+    'SlowDown', 'RequestTimeout', 'InternalError', 'ServiceUnavailable',
+    'Throttling', 'ThrottlingException', 'RequestLimitExceeded'
+)
 
 class S3Storage(StorageBackend):
     """Implementación del backend de almacenamiento para Amazon S3."""
@@ -18,35 +27,276 @@ class S3Storage(StorageBackend):
             if key not in self.config:
                 raise ValueError(f"Falta la configuración requerida: {key}")
         
+        self.bucket = self.config['bucket']
+        # S3 exige partes de al menos 5 MB (salvo la última)
+        self.part_size = max(int(self.config.get('part_size_mb', 8)), 5) * 1024 * 1024
+        self.concurrency = max(int(self.config.get('concurrency', 4)), 1)
+        self.max_part_retries = int(self.config.get('max_part_retries', 3))
+        self.part_retry_policy = RetryPolicy(self.max_part_retries)
+        
         self.s3_client = boto3.client(
             's3',
             aws_access_key_id=self.config['access_key'],
             aws_secret_access_key=self.config['secret_key'],
-            region_name=self.config['region']
+            region_name=self.config['region'],
+            # Permite usar un servicio compatible con S3 (MinIO, LocalStack...)
+            endpoint_url=self.config.get('endpoint_url'),
+            config=Config(max_pool_connections=max(10, self.concurrency))
         )
-        self.bucket = self.config['bucket']
     
     async def upload_file(self, file_path: Path, destination: str) -> str:
-        """Sube un archivo a S3."""
+        """Sube un archivo a S3 mediante una subida multipart en paralelo."""
         try:
             async with aiofiles.open(file_path, 'rb') as f:
-                content = await f.read()
-                
-            # Ejecutar la subida en un thread pool para no bloquear
+                await self._multipart_upload(destination, lambda: f.read(self.part_size))
+            
+            return f"s3://{self.bucket}/{destination}"
+        except Exception as e:
+            raise Exception(f"Error al subir archivo a S3: {str(e)}")
+    
+    async def upload_stream(self, stream: BinaryIO, destination: str,
+                            checkpoint: Optional[UploadCheckpoint] = None) -> str:
+        """Sube un flujo a S3 mediante una subida multipart en paralelo.
+        
+        El punto de control guarda el id de la subida multipart y el ETag de
+        las partes confirmadas sin huecos desde la primera.
+        """
+        try:
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None,
-                lambda: self.s3_client.put_object(
-                    Bucket=self.bucket,
-                    Key=destination,
-                    Body=content
-                )
+            await self._multipart_upload(
+                destination,
+                lambda: loop.run_in_executor(None, self._read_part, stream),
+                checkpoint
             )
             
             return f"s3://{self.bucket}/{destination}"
         except Exception as e:
             raise Exception(f"Error al subir archivo a S3: {str(e)}")
     
+    async def _multipart_upload(self, key: str, read_part: Callable[[], Awaitable[bytes]],
+                                checkpoint: Optional[UploadCheckpoint] = None) -> None:
+        """Sube los datos devueltos por `read_part` como una subida multipart.
+        
+        Se suben hasta `concurrency` partes a la vez y solo se lee una parte
+        nueva cuando queda un hueco libre, por lo que la memoria usada está
+        acotada a part_size × concurrency. Cada parte se reintenta por
+        separado y, si alguna falla definitivamente, la subida se aborta (con
+        un punto de control se conserva para poder reanudarla). Los datos que
+        caben en una sola parte se suben con un put_object.
+        
+        Args:
+            key: Clave de destino en el bucket
+            read_part: Corrutina que devuelve la siguiente parte (b'' al final)
+            checkpoint: Punto de control de la subida (ver upload_stream)
+        """
+        loop = asyncio.get_event_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        
+        await slots.acquire()
+        data = await read_part()
+        if checkpoint is not None and 'upload_id' in checkpoint.state:
+            upload_id = checkpoint.state['upload_id']
+            confirmed = list(checkpoint.state['parts'])
+        else:
+            if len(data) < self.part_size:
+                await self._with_retries(partial(
+                    self.s3_client.put_object,
+                    Bucket=self.bucket,
+                    Key=key,
+                    Body=data
+                ))
+                return
+            
+            upload = await self._with_retries(partial(
+                self.s3_client.create_multipart_upload,
+                Bucket=self.bucket,
+                Key=key
+            ))
+            upload_id = upload['UploadId']
+            confirmed = []
+            if checkpoint is not None:
+                checkpoint.save(0, upload_id=upload_id, key=key, part_size=self.part_size, parts=[])
+        
+        # Partes terminadas fuera de orden que aún no forman un prefijo sin huecos
+        finished = {}
+        
+        def on_part_done(task):
+            if task.cancelled() or task.exception():
+                return
+            part = task.result()
+            finished[part['PartNumber']] = part
+            advanced = False
+            while len(confirmed) + 1 in finished:
+                confirmed.append(finished.pop(len(confirmed) + 1))
+                advanced = True
+            if advanced and checkpoint is not None:
+                checkpoint.save(len(confirmed) * self.part_size, parts=list(confirmed))
+        
+        tasks = []
+        previous_parts = list(confirmed)
+        first_part = len(previous_parts) + 1
+        try:
+            while data:
+                part_number = first_part + len(tasks)
+                task = asyncio.ensure_future(
+                    self._upload_part(key, upload_id, part_number, data, slots)
+                )
+                task.add_done_callback(on_part_done)
+                tasks.append(task)
+                if len(data) < self.part_size:
+                    break
+                
+                await slots.acquire()
+                # Dejar de leer en cuanto una parte falle definitivamente
+                for task in tasks:
+                    if task.done() and task.exception():
+                        slots.release()
+                        raise task.exception()
+                
+                data = await read_part()
+            else:
+                # El flujo terminó en un límite de parte: el hueco reservado sobra
+                slots.release()
+            
+            parts = await asyncio.gather(*tasks)
+            await self._with_retries(partial(
+                self.s3_client.complete_multipart_upload,
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': previous_parts + parts}
+            ))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if checkpoint is not None:
+                # Las partes confirmadas se conservan para reanudar la subida
+                raise
+            
+            # No dejar partes huérfanas ocupando espacio en el bucket
+            await loop.run_in_executor(
+                None,
+                lambda: self.s3_client.abort_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id
+                )
+            )
+            raise
+    
+    async def resume_upload(self, checkpoint: UploadCheckpoint) -> bool:
+        """Comprueba que la subida multipart sigue abierta y conserva las partes confirmadas."""
+        state = checkpoint.state
+        if 'upload_id' not in state or state.get('part_size') != self.part_size:
+            return False
+        
+        expected = {part['PartNumber']: part['ETag'] for part in state['parts']}
+        uploaded = {}
+        params = {'Bucket': self.bucket, 'Key': state['key'], 'UploadId': state['upload_id']}
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                response = await loop.run_in_executor(None, lambda: self.s3_client.list_parts(**params))
+                for part in response.get('Parts', []):
+                    uploaded[part['PartNumber']] = part['ETag']
+                if not response.get('IsTruncated'):
+                    break
+                params['PartNumberMarker'] = response['NextPartNumberMarker']
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchUpload':
+                return False
+            raise
+        
+        return all(uploaded.get(number) == etag for number, etag in expected.items())
+    
+    async def abort_upload(self, state: Dict[str, Any]) -> None:
+        """Aborta una subida multipart y libera sus partes."""
+        if 'upload_id' not in state:
+            return
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(
+                None,
+                lambda: self.s3_client.abort_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=state['key'],
+                    UploadId=state['upload_id']
+                )
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':
+                raise
+    
+    async def abort_stale_uploads(self, prefix: Optional[str], before: datetime,
+                                  keep: List[Dict[str, Any]]) -> int:
+        """Aborta las subidas multipart incompletas iniciadas antes de `before`."""
+        keep_ids = {state.get('upload_id') for state in keep}
+        if before.tzinfo is None:
+            before = before.replace(tzinfo=timezone.utc)
+        
+        params = {'Bucket': self.bucket, 'Prefix': prefix or ''}
+        loop = asyncio.get_event_loop()
+        aborted = 0
+        while True:
+            response = await loop.run_in_executor(None, lambda: self.s3_client.list_multipart_uploads(**params))
+            for upload in response.get('Uploads', []):
+                if upload['UploadId'] in keep_ids or upload['Initiated'] >= before:
+                    continue
+                await self.abort_upload({'key': upload['Key'], 'upload_id': upload['UploadId']})
+                aborted += 1
+            if not response.get('IsTruncated'):
+                return aborted
+            params['KeyMarker'] = response['NextKeyMarker']
+            params['UploadIdMarker'] = response['NextUploadIdMarker']
+    
+    async def _upload_part(self, key: str, upload_id: str, part_number: int,
+                           data: bytes, slots: asyncio.Semaphore) -> Dict[str, Any]:
+        """Sube una parte de una subida multipart y libera su hueco al terminar."""
+        try:
+            response = await self._with_retries(partial(
+                self.s3_client.upload_part,
+                Bucket=self.bucket,
+                Key=key,
+                PartNumber=part_number,
+                UploadId=upload_id,
+                Body=data
+            ))
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            slots.release()
+    
+    async def _with_retries(self, call: Callable[[], Any]) -> Any:
+        """Ejecuta una llamada a S3 en el thread pool reintentándola si falla por un error pasajero."""
+        loop = asyncio.get_event_loop()
+        return await self.part_retry_policy.run(
+            lambda: loop.run_in_executor(None, call),
+            f'S3 {getattr(call, "func", call).__name__}',
+            classify=self.classify_error
+        )
+    
+    def _read_part(self, stream: BinaryIO) -> bytes:
+        """Lee del flujo una parte completa (o lo que quede hasta el final)."""
+        chunks = []
+        remaining = self.part_size
+        while remaining > 0:
+            data = stream.read(remaining)
+            if not data:
+                break
+            chunks.append(data)
+            remaining -= len(data)
+        return b''.join(chunks)
+    
+    def classify_error(self, error: BaseException) -> Optional[bool]:
+        """Errores 5xx, de limitación de peticiones y de conexión: pasajeros; el resto de ClientError: definitivos."""
+        if isinstance(error, ClientError):
+            status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+            code = error.response.get('Error', {}).get('Code')
+            return code in TRANSIENT_ERROR_CODES or status in (408, 429) or status >= 500
+        if isinstance(error, (BotoConnectionError, HTTPClientError)):
+            return True
+        return None
+    
     async def download_file(self, file_id: str, destination: Path) -> Path:
         """Descarga un archivo de S3."""
         try:
@@ -87,28 +337,62 @@ class S3Storage(StorageBackend):
         except Exception as e:
             raise Exception(f"Error al eliminar archivo de S3: {str(e)}")
     
-    async def list_files(self, prefix: Optional[str] = None) -> List[Dict[str, Any]]:
-        """Lista los archivos en S3."""
+    async def delete_files(self, file_ids: List[str]) -> Dict[str, str]:
+        """Elimina varios archivos de S3 con delete_objects (hasta 1000 claves por llamada)."""
+        keys = {file_id.replace(f"s3://{self.bucket}/", ""): file_id for file_id in file_ids}
+        key_list = list(keys)
+        errors = {}
+        loop = asyncio.get_event_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        
+        async def delete_batch(batch):
+            try:
+                async with semaphore:
+                    response = await loop.run_in_executor(
+                        None,
+                        lambda: self.s3_client.delete_objects(
+                            Bucket=self.bucket,
+                            Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+                        )
+                    )
+                # En modo Quiet solo se devuelven las claves que fallaron
+                for error in response.get('Errors', []):
+                    errors[keys[error['Key']]] = f"{error.get('Code')}: {error.get('Message')}"
+            except Exception as e:
+                for key in batch:
+                    errors[keys[key]] = f"Error al eliminar archivo de S3: {str(e)}"
+        
+        await asyncio.gather(*(
+            delete_batch(key_list[i:i + 1000]) for i in range(0, len(key_list), 1000)
+        ))
+        return errors
+    
+    async def _list_page(self, prefix: Optional[str],
+                         page_token: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Obtiene una página (hasta 1000 objetos) del listado de S3."""
         try:
+            params = {'Bucket': self.bucket, 'Prefix': prefix or ''}
+            if page_token:
+                params['ContinuationToken'] = page_token
+            
             loop = asyncio.get_event_loop()
             response = await loop.run_in_executor(
                 None,
-                lambda: self.s3_client.list_objects_v2(
-                    Bucket=self.bucket,
-                    Prefix=prefix
-                )
+                lambda: self.s3_client.list_objects_v2(**params)
             )
             
             files = []
             for obj in response.get('Contents', []):
+                url = f"s3://{self.bucket}/{obj['Key']}"
                 files.append({
+                    'file_id': url,
                     'key': obj['Key'],
                     'size': obj['Size'],
                     'last_modified': obj['LastModified'].isoformat(),
-                    'url': f"s3://{self.bucket}/{obj['Key']}"
+                    'url': url
                 })
             
-            return files
+            return files, response.get('NextContinuationToken') if response.get('IsTruncated') else None
         except Exception as e:
             raise Exception(f"Error al listar archivos de S3: {str(e)}")
     
@@ -0,0 +1,220 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, BinaryIO, Dict, Iterable, Optional
+import asyncio
+import threading
+import time
+
+class TransferSlots:
+    """Límite de transferencias simultáneas compartido por varios hilos.
+    
+    Cada worker de la cola ejecuta su propio bucle de eventos, así que un
+    asyncio.Semaphore no sirve: los huecos se conceden en orden de llegada a
+    través de `call_soon_threadsafe` en el bucle de quien espera. Un límite
+    de 0 significa sin límite.
+    """
+    
+    def __init__(self, limit: int = 0):
+        self.limit = limit
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+    
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+    
+    def set_limit(self, limit: int) -> None:
+        """Cambia el límite; si aumenta, se conceden los huecos nuevos a quien espera."""
+        with self._lock:
+            self.limit = limit
+            self._grant_waiters()
+    
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if not self._waiters and self._has_room():
+                self.active += 1
+                return
+            # [bucle, futuro, concedido]
+            waiter = [loop, loop.create_future(), False]
+            self._waiters.append(waiter)
+    
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter[2]
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted:
+                self.release()
+            raise
+    
+    def release(self) -> None:
+        with self._lock:
+            self.active -= 1
+            self._grant_waiters()
+    
+    def _has_room(self) -> bool:
+        return not self.limit or self.active < self.limit
+    
+    def _grant_waiters(self) -> None:
+        # Se llama con el lock tomado
+        while self._waiters and self._has_room():
+            waiter = self._waiters.popleft()
+            loop, future, _ = waiter
+            waiter[2] = True
+            self.active += 1
+            try:
+                loop.call_soon_threadsafe(_resolve, future)
+            except RuntimeError:
+                # El bucle del que esperaba ya se cerró
+                self.active -= 1
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+class TokenBucket:
+    """Cubo de tokens para limitar el ancho de banda en bytes por segundo.
+    
+    Quien consume más tokens de los disponibles queda en deuda y espera el
+    tiempo necesario para saldarla, de modo que varios hilos comparten el
+    límite en el orden en que piden. Un ritmo de 0 significa sin límite.
+    """
+    
+    def __init__(self, rate: int = 0, burst: Optional[int] = None):
+        self._lock = threading.Lock()
+        self.set_rate(rate, burst)
+    
+    def set_rate(self, rate: int, burst: Optional[int] = None) -> None:
+        """Cambia el ritmo; la ráfaga por defecto es un segundo de transferencia."""
+        with self._lock:
+            self.rate = max(int(rate or 0), 0)
+            self.burst = int(burst) if burst else self.rate
+            self._tokens = self.burst
+            self._last = time.monotonic()
+    
+    def reserve(self, amount: int) -> float:
+        """Reserva `amount` bytes y devuelve los segundos que hay que esperar antes de enviarlos."""
+        with self._lock:
+            if not self.rate:
+                return 0.0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+class ThrottledReader:
+    """Flujo de lectura que respeta uno o varios cubos de tokens.
+    
+    Se lee en bloques de `block_size` como mucho para que el ritmo sea
+    uniforme aunque el consumidor pida fragmentos grandes.
+    """
+    
+    def __init__(self, source: BinaryIO, buckets: Iterable[TokenBucket], block_size: int = 64 * 1024):
+        self.source = source
+        self.buckets = list(buckets)
+        self.block_size = block_size
+    
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self.block_size:
+            size = self.block_size
+        data = self.source.read(size)
+        if data:
+            wait = max(bucket.reserve(len(data)) for bucket in self.buckets)
+            if wait:
+                time.sleep(wait)
+        return data
+    
+    def close(self) -> None:
+        self.source.close()
+
+class TransferScheduler:
+    """Planificador de las transferencias hacia los backends de almacenamiento.
+    
+    Limita por backend las transferencias simultáneas (`max_transfers`) y el
+    ancho de banda (`bandwidth_limit`, en bytes por segundo), y el ancho de
+    banda total de todas las transferencias. Los límites se pueden cambiar
+    en caliente con `configure` y afectan también a las transferencias en curso.
+    """
+    
+    def __init__(self, limits: Optional[Dict[str, Dict[str, Any]]] = None, bandwidth_limit: int = 0):
+        self._slots = {}
+        self._buckets = {}
+        self._global = TokenBucket(bandwidth_limit)
+        self._lock = threading.Lock()
+        for storage_type, backend_limits in (limits or {}).items():
+            self.configure(storage_type, **backend_limits)
+    
+    def configure(self, storage_type: Optional[str] = None, max_transfers: Optional[int] = None,
+                  bandwidth_limit: Optional[int] = None) -> None:
+        """Cambia los límites de un backend (o el ancho de banda total si no se indica backend).
+    
+        Args:
+            storage_type: Tipo de almacenamiento o None para el límite global
+            max_transfers: Transferencias simultáneas (0 = sin límite)
+            bandwidth_limit: Bytes por segundo (0 = sin límite)
+        """
+        if storage_type is None:
+            if bandwidth_limit is not None:
+                self._global.set_rate(bandwidth_limit)
+            return
+    
+        if max_transfers is not None:
+            self._get_slots(storage_type).set_limit(max(int(max_transfers), 0))
+        if bandwidth_limit is not None:
+            self._get_bucket(storage_type).set_rate(bandwidth_limit)
+    
+    @asynccontextmanager
+    async def transfers(self, storage_types: Iterable[str]):
+        """Reserva una transferencia en cada backend mientras dura el bloque `async with`.
+    
+        Los huecos se piden siempre en el mismo orden para que dos trabajos
+        con varios destinos no se bloqueen mutuamente.
+        """
+        acquired = []
+        try:
+            for storage_type in sorted(set(storage_types)):
+                slots = self._get_slots(storage_type)
+                await slots.acquire()
+                acquired.append(slots)
+            yield
+        finally:
+            for slots in acquired:
+                slots.release()
+    
+    def throttle(self, stream: BinaryIO, storage_type: str) -> ThrottledReader:
+        """Envuelve el flujo de una subida con los límites de ancho de banda de su backend."""
+        return ThrottledReader(stream, [self._get_bucket(storage_type), self._global])
+    
+    def stats(self) -> Dict[str, Any]:
+        """Límites y transferencias activas y en espera de cada backend."""
+        with self._lock:
+            storage_types = sorted(set(self._slots) | set(self._buckets))
+        return {
+            'bandwidth_limit': self._global.rate,
+            'backends': {
+                storage_type: {
+                    'max_transfers': self._get_slots(storage_type).limit,
+                    'bandwidth_limit': self._get_bucket(storage_type).rate,
+                    'active': self._get_slots(storage_type).active,
+                    'waiting': self._get_slots(storage_type).waiting
+                }
+                for storage_type in storage_types
+            }
+        }
+    
+    def _get_slots(self, storage_type: str) -> TransferSlots:
+        with self._lock:
+            if storage_type not in self._slots:
+                self._slots[storage_type] = TransferSlots()
+            return self._slots[storage_type]
+    
+    def _get_bucket(self, storage_type: str) -> TokenBucket:
+        with self._lock:
+            if storage_type not in self._buckets:
+                self._buckets[storage_type] = TokenBucket()
+            return self._buckets[storage_type]
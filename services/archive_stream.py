@@ -0,0 +1,459 @@
+import io
+import os
+import queue
+import shutil
+import tarfile
+import hashlib
+import threading
+from collections import deque
+
+# Archivos de un clon recién hecho que cambian en cada clon (marcas de tiempo
+# del índice y reflogs); van al final del tar para que el resto del artefacto
+# sea idéntico byte a byte entre dos generaciones del mismo contenido
+VOLATILE_PATHS = ('.git/index', '.git/logs')
+
+class ArchiveStream(io.RawIOBase):
+    """
+    Flujo de lectura con un artefacto comprimido que se genera en segundo plano.
+
+    Un hilo productor escribe el artefacto a través del codec en una cola
+    acotada de fragmentos y el consumidor (la subida al almacenamiento) los lee
+    a medida que se generan, de modo que compresión y transferencia se solapan
+    y nunca hay más de `max_chunks` fragmentos en memoria ni un archivo
+    temporal en disco.
+    """
+
+    def __init__(self, write_source, codec, chunk_size=1024 * 1024, max_chunks=8):
+        super().__init__()
+        self.write_source = write_source
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.bytes_in = 0
+        self.bytes_read = 0
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = b''
+        self._eof = False
+        self._error = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+
+    @classmethod
+    def from_directory(cls, source_dir, arcname, codec, mtime=None, **kwargs):
+        """
+        Crea un flujo con un tar de un directorio.
+
+        El tar es determinista: las entradas van en orden alfabético (con
+        VOLATILE_PATHS al final), sin propietario y, si se indica `mtime`,
+        todas con esa fecha. Así una subida interrumpida puede reanudarse
+        generando de nuevo el artefacto.
+
+        Args:
+            source_dir: Directorio a empaquetar
+            arcname: Nombre del directorio dentro del tar
+            codec: Codec de compresión
+            mtime: Fecha de modificación (timestamp) de todas las entradas
+        """
+        def write_source(fileobj):
+            write_tar(fileobj, source_dir, arcname, mtime)
+
+        return cls(write_source, codec, **kwargs).start()
+
+    @classmethod
+    def from_file(cls, path, codec, **kwargs):
+        """
+        Crea un flujo con el contenido comprimido de un archivo.
+
+        Args:
+            path: Archivo a comprimir
+            codec: Codec de compresión
+        """
+        def write_source(fileobj):
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, fileobj, 1024 * 1024)
+
+        return cls(write_source, codec, **kwargs).start()
+
+    def start(self):
+        """
+        Arranca el hilo productor.
+        """
+        self._thread.start()
+        return self
+
+    def _produce(self):
+        writer = _QueueWriter(self._put, self.chunk_size)
+        counter = _CountingWriter(None)
+        try:
+            compressor = self.codec.open_writer(writer)
+            counter = _CountingWriter(compressor)
+            self.write_source(counter)
+            compressor.close()
+            writer.flush()
+        except Exception as e:
+            self._error = e
+        finally:
+            self.bytes_in = counter.bytes_written
+            try:
+                self._put(None)
+            except _StreamCancelled:
+                pass
+
+    def _put(self, chunk):
+        # Espera con timeout para poder abandonar si el consumidor cierra el flujo
+        while True:
+            if self._cancelled.is_set():
+                raise _StreamCancelled()
+            try:
+                self._queue.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self):
+        # Espera con timeout para no quedar bloqueado si otro hilo cierra el flujo
+        while True:
+            if self._cancelled.is_set():
+                raise _StreamCancelled()
+            try:
+                return self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._eof:
+            chunk = self._get()
+            if chunk is None:
+                self._eof = True
+                if self._error:
+                    raise self._error
+            else:
+                self._buffer = chunk
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self.bytes_read += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._cancelled.set()
+            self._thread.join()
+        super().close()
+
+class TeeStream:
+    """
+    Reparte un flujo de lectura entre varios consumidores.
+
+    Un hilo lee el flujo original por fragmentos y entrega cada fragmento a
+    la cola acotada de cada rama, de modo que el flujo se genera una sola vez
+    y el consumidor más lento marca el ritmo. Cerrar una rama (p. ej. porque
+    su subida falló) la desconecta sin detener a las demás.
+    """
+
+    def __init__(self, source, count, chunk_size=1024 * 1024, max_chunks=8):
+        self.source = source
+        self.chunk_size = chunk_size
+        self.branches = [_Branch(max_chunks) for _ in range(count)]
+        self._thread = threading.Thread(target=self._pump, daemon=True)
+
+    def start(self):
+        """
+        Arranca el hilo que reparte el flujo.
+        """
+        self._thread.start()
+        return self
+
+    def _pump(self):
+        error = None
+        try:
+            while not all(branch.detached for branch in self.branches):
+                chunk = self.source.read(self.chunk_size)
+                if not chunk:
+                    break
+                for branch in self.branches:
+                    branch.put(chunk)
+        except Exception as e:
+            error = e
+        finally:
+            for branch in self.branches:
+                branch.finish(error)
+
+    def close(self):
+        """
+        Desconecta todas las ramas y espera al hilo.
+        """
+        for branch in self.branches:
+            branch.close()
+        self._thread.join()
+
+class _Branch(io.RawIOBase):
+    """
+    Rama de lectura de un TeeStream.
+    """
+
+    def __init__(self, max_chunks):
+        super().__init__()
+        self.bytes_read = 0
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._buffer = b''
+        self._eof = False
+        self._error = None
+        self._detached = threading.Event()
+
+    @property
+    def detached(self):
+        return self._detached.is_set()
+
+    def put(self, chunk):
+        # Una rama desconectada deja de recibir datos sin bloquear a las demás
+        while not self._detached.is_set():
+            try:
+                self._queue.put(chunk, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def finish(self, error=None):
+        self._error = error
+        self.put(None)
+
+    def _get(self):
+        # Una rama desconectada mientras se lee deja de esperar datos
+        while True:
+            if self._detached.is_set():
+                raise _StreamCancelled()
+            try:
+                return self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._eof:
+            chunk = self._get()
+            if chunk is None:
+                self._eof = True
+                if self._error:
+                    raise self._error
+            else:
+                self._buffer = chunk
+
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        self.bytes_read += size
+        return size
+
+    def close(self):
+        self._detached.set()
+        super().close()
+
+class CheckpointReader(io.RawIOBase):
+    """
+    Flujo de lectura que calcula el SHA-256 de los bytes leídos.
+
+    Guarda el hash acumulado en cada posición en la que termina una lectura,
+    de modo que al registrar un punto de control se obtiene el hash de los
+    bytes confirmados aunque la subida ya haya leído más allá. Al reanudar,
+    `skip` descarta el prefijo ya subido y devuelve su hash para comprobar
+    que el artefacto generado de nuevo es el mismo.
+    """
+
+    def __init__(self, source, max_snapshots=4096):
+        super().__init__()
+        self.source = source
+        self.position = 0
+        self._hash = hashlib.sha256()
+        self._snapshots = deque([(0, self._hash.copy())], maxlen=max_snapshots)
+        # La subida lee y registra puntos de control desde hilos distintos
+        self._lock = threading.Lock()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.source.read(len(b))
+        if not data:
+            return 0
+
+        size = len(data)
+        b[:size] = data
+        with self._lock:
+            self._hash.update(data)
+            self.position += size
+            self._snapshots.append((self.position, self._hash.copy()))
+        return size
+
+    def skip(self, size):
+        """
+        Lee y descarta `size` bytes.
+
+        Returns:
+            SHA-256 de los bytes leídos hasta ahora, o None si el flujo
+            terminó antes
+        """
+        while self.position < size:
+            if not self.read(min(size - self.position, 1024 * 1024)):
+                return None
+        return self.digest_at(size)
+
+    def digest_at(self, position):
+        """
+        Obtiene el SHA-256 de los primeros `position` bytes.
+
+        Se descartan los hashes de posiciones anteriores, así que las
+        posiciones deben pedirse en orden creciente.
+
+        Returns:
+            Hash en hexadecimal o None si no hay una lectura que termine en
+            esa posición
+        """
+        with self._lock:
+            while self._snapshots and self._snapshots[0][0] < position:
+                self._snapshots.popleft()
+            if self._snapshots and self._snapshots[0][0] == position:
+                return self._snapshots[0][1].hexdigest()
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.source.close()
+        super().close()
+
+class StagedReader(io.RawIOBase):
+    """
+    Flujo de lectura de un artefacto ya generado en disco (ver ArtifactPool).
+
+    Tiene la interfaz de CheckpointReader sin calcular hashes: el SHA-256
+    del artefacto completo lo calculó el proceso que lo generó e identifica
+    el contenido de cualquiera de sus prefijos, y `skip` avanza sin leer.
+    """
+
+    def __init__(self, path, sha256):
+        super().__init__()
+        self.sha256 = sha256
+        self.position = 0
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = self._file.readinto(b)
+        self.position += size
+        return size
+
+    def skip(self, size):
+        """
+        Avanza hasta la posición `size`.
+
+        Returns:
+            SHA-256 del artefacto, o None si es más corto que `size`
+        """
+        if size > self._size:
+            return None
+        self._file.seek(size)
+        self.position = size
+        return self.sha256
+
+    def digest_at(self, position):
+        return self.sha256
+
+    def close(self):
+        if not self.closed:
+            self._file.close()
+        super().close()
+
+def write_tar(fileobj, source_dir, arcname, mtime=None):
+    """
+    Escribe un tar determinista de un directorio.
+
+    Las entradas van en orden alfabético (con VOLATILE_PATHS al final), sin
+    propietario y, si se indica `mtime`, todas con esa fecha.
+
+    Args:
+        fileobj: Objeto de escritura
+        source_dir: Directorio a empaquetar
+        arcname: Nombre del directorio dentro del tar
+        mtime: Fecha de modificación (timestamp) de todas las entradas
+    """
+    def normalize(tarinfo):
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        if mtime is not None:
+            tarinfo.mtime = int(mtime)
+        return tarinfo
+
+    with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+        for path, name in _sorted_entries(source_dir, arcname):
+            tar.add(path, arcname=name, recursive=False, filter=normalize)
+
+def _sorted_entries(source_dir, arcname):
+    """
+    Recorre un directorio en orden alfabético con VOLATILE_PATHS al final.
+
+    Returns:
+        Lista de (ruta, nombre dentro del tar)
+    """
+    entries = []
+    volatile = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        relative = os.path.relpath(root, source_dir)
+        # os.walk no entra en los enlaces a directorios: se guardan como enlaces
+        links = [d for d in dirs if os.path.islink(os.path.join(root, d))]
+        for name in [None] + sorted(files + links):
+            path = os.path.join(root, name) if name else root
+            relpath = os.path.normpath(os.path.join(relative, name or ''))
+            is_volatile = any(relpath == v or relpath.startswith(v + '/') for v in VOLATILE_PATHS)
+            (volatile if is_volatile else entries).append(
+                (path, arcname if relpath == '.' else os.path.join(arcname, relpath))
+            )
+    return entries + volatile
+
+class _StreamCancelled(Exception):
+    pass
+
+class _CountingWriter:
+    """
+    Objeto de escritura que cuenta los bytes sin comprimir.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return self._fileobj.write(data)
+
+class _QueueWriter:
+    """
+    Objeto de escritura que agrupa los datos en fragmentos y los entrega a la cola.
+    """
+
+    def __init__(self, put, chunk_size):
+        self._put = put
+        self._chunk_size = chunk_size
+        self._pending = []
+        self._pending_size = 0
+
+    def write(self, data):
+        self._pending.append(bytes(data))
+        self._pending_size += len(data)
+        if self._pending_size >= self._chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._pending:
+            self._put(b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
@@ -0,0 +1,186 @@
+from repomirror.storage.scheduler import TransferSlots
+from services.archive_stream import _CountingWriter, write_tar
+from services.compression import get_codec
+from services.job_control import kill_process_group
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+# Raíz del proyecto, para que los procesos del pool importen este módulo
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def host_cpus():
+    """
+    Núcleos disponibles para el proceso (respeta la afinidad de CPU del contenedor).
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def build_artifact(output_path, codec_name, level, threads, source_dir=None, source_file=None,
+                   arcname=None, mtime=None):
+    """
+    Genera un artefacto comprimido en disco y calcula su SHA-256.
+
+    Args:
+        output_path: Archivo a generar
+        codec_name: Nombre del codec de compresión
+        level: Nivel de compresión
+        threads: Hilos de compresión (zstd)
+        source_dir: Directorio a empaquetar en un tar
+        source_file: Archivo a comprimir (p. ej. un git bundle)
+        arcname: Nombre del directorio dentro del tar
+        mtime: Fecha de todas las entradas del tar
+
+    Returns:
+        Diccionario con path, size, sha256, bytes_in y seconds
+    """
+    started = time.monotonic()
+    codec = get_codec(codec_name, level, threads)
+
+    if source_file and codec.name == 'none':
+        # Sin compresión el artefacto es el propio archivo: solo se calcula el hash
+        digest = hashlib.sha256()
+        with open(source_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        size = os.path.getsize(source_file)
+        return {
+            'path': source_file,
+            'size': size,
+            'sha256': digest.hexdigest(),
+            'bytes_in': size,
+            'seconds': time.monotonic() - started
+        }
+
+    with open(output_path, 'wb') as f:
+        output = _HashingWriter(f)
+        compressor = codec.open_writer(output)
+        counter = _CountingWriter(compressor)
+        if source_dir:
+            write_tar(counter, source_dir, arcname, mtime)
+        else:
+            with open(source_file, 'rb') as source:
+                shutil.copyfileobj(source, counter, 1024 * 1024)
+        compressor.close()
+
+    return {
+        'path': output_path,
+        'size': output.bytes_written,
+        'sha256': output.digest.hexdigest(),
+        'bytes_in': counter.bytes_written,
+        'seconds': time.monotonic() - started
+    }
+
+class ArtifactPool:
+    """
+    Pool de procesos para la compresión y el hash de los artefactos.
+
+    Comprimir y calcular hashes consume CPU y, en el proceso de la
+    aplicación, compite por el GIL con la API y con las subidas. Cada
+    artefacto se genera en un proceso aparte (`python -m
+    services.artifact_pool`) que lee y escribe sus propios archivos: solo
+    la descripción del trabajo y el resultado pasan entre procesos. Hay como
+    mucho `processes` a la vez entre todos los workers, y el resto del
+    backup (git, subidas) sigue en el bucle de eventos de cada worker.
+
+    Los procesos se lanzan por artefacto en lugar de reutilizarse (como en
+    ProcessPoolExecutor): multiprocessing volvería a importar el script
+    principal en cada proceso, y cancelar un artefacto es matar su proceso.
+    Por defecto (`processes` = None) hay un proceso por núcleo, y cada uno
+    comprime con un solo hilo: el paralelismo lo dan los procesos. Con
+    `processes` = 0 no hay pool y los artefactos se comprimen en streaming
+    durante la subida (ver ArchiveStream).
+    """
+
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = host_cpus()
+        self.processes = min(max(int(processes), 0), host_cpus())
+        self.slots = TransferSlots(self.processes)
+
+    @property
+    def enabled(self):
+        return self.processes > 0
+
+    async def build(self, output_path, codec, source_dir=None, source_file=None, arcname=None, mtime=None):
+        """
+        Genera un artefacto en un proceso del pool (ver build_artifact).
+
+        Si se cancela la corrutina se mata el proceso.
+
+        Args:
+            output_path: Archivo a generar
+            codec: Codec de compresión
+            source_dir: Directorio a empaquetar en un tar
+            source_file: Archivo a comprimir
+            arcname: Nombre del directorio dentro del tar
+            mtime: Fecha de todas las entradas del tar
+
+        Returns:
+            Diccionario con path, size, sha256, bytes_in y seconds
+        """
+        job = {
+            'output_path': output_path,
+            'codec_name': codec.name,
+            'level': codec.level,
+            # Con varios procesos, un hilo de zstd por núcleo en cada uno
+            # repartiría cada núcleo entre todos ellos
+            'threads': 1,
+            'source_dir': source_dir,
+            'source_file': source_file,
+            'arcname': arcname,
+            'mtime': mtime
+        }
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [PROJECT_ROOT, env.get('PYTHONPATH')]))
+
+        await self.slots.acquire()
+        try:
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'services.artifact_pool',
+                env=env,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=os.name == 'posix'
+            )
+            try:
+                stdout, stderr = await process.communicate(json.dumps(job).encode())
+            finally:
+                if process.returncode is None:
+                    kill_process_group(process)
+                    await process.wait()
+        finally:
+            self.slots.release()
+
+        if process.returncode != 0:
+            lines = stderr.decode(errors='replace').strip().splitlines()
+            raise RuntimeError(f'Error generando el artefacto {output_path}: {lines[-1] if lines else process.returncode}')
+        return json.loads(stdout)
+
+class _HashingWriter:
+    """
+    Objeto de escritura que calcula el SHA-256 de lo escrito.
+    """
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self.digest = hashlib.sha256()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.bytes_written += len(data)
+        return self._fileobj.write(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+if __name__ == '__main__':
+    # Proceso del pool: trabajo en JSON por stdin, resultado en JSON por stdout
+    print(json.dumps(build_artifact(**json.load(sys.stdin))))
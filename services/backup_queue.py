@@ -0,0 +1,971 @@
+from models import db, Backup, Repository, User
+from services.job_control import DeadlineExceeded, JobCancelled, JobControl, LeaseLost, Preempted
+from services.job_estimator import JobEstimator
+from services.scratch_space import ScratchSpace
+from datetime import datetime, timedelta
+from sqlalchemy import and_, case, func, or_
+import asyncio
+import json
+import logging
+import os
+import socket
+import statistics
+import threading
+import uuid
+
+# Estados por los que pasa un backup mientras lo procesa un worker
+ACTIVE_STATUSES = ('cloning', 'compressing', 'uploading')
+
+# Estados finales de un backup correcto ('unchanged' reutiliza un artefacto previo)
+SUCCESSFUL_STATUSES = ('completed', 'unchanged')
+
+# Estados finales de un backup sin artefacto
+FAILED_STATUSES = ('error', 'cancelled')
+
+BUNDLE_TYPES = ('full_bundle', 'incremental_bundle')
+
+# Prioridades de la cola (los valores menores se procesan antes): los
+# backups pedidos por un usuario y, de los programados, primero los de
+# repositorios cuyo último backup falló y los de repositorios con pushes recientes
+PRIORITY_MANUAL = 0
+PRIORITY_FAILED = 10
+PRIORITY_RECENT_PUSH = 20
+PRIORITY_SCHEDULED = 30
+
+class BackupQueue:
+    """
+    Cola persistente de backups.
+
+    Cada fila Backup en estado 'pending' es un trabajo pendiente. Un pool de
+    workers reclama los trabajos de la base de datos y los procesa en segundo
+    plano: pending → cloning → compressing → uploading → completed/error.
+    En los backups completos la compresión se hace durante la etapa de
+    subida, por lo que pasan directamente de cloning a uploading.
+
+    Varios procesos, en la misma o en distintas máquinas, pueden compartir
+    la cola (ver `repomirror worker`). Un worker reclama un backup con una
+    lease de `lease_ttl` segundos que un hilo de heartbeat renueva mientras
+    trabaja. Si el proceso muere, la lease caduca y otro worker reclama el
+    backup, cuyas subidas continúan desde el último punto de control; tras
+    `max_attempts` reclamaciones el backup se da por fallido.
+
+    Los workers se reparten entre los usuarios de forma justa y ponderada,
+    con un máximo opcional de backups simultáneos por usuario; los backups
+    manuales van antes que los programados y, si esperan demasiado, un
+    backup programado en curso les cede su worker (ver _select_tenant y
+    _request_preemptions).
+
+    Cada etapa (clone, compress, upload) tiene un tiempo límite, y un backup
+    pendiente o en curso en cualquier worker se puede cancelar con `cancel`
+    (ver JobControl).
+
+    Cada worker ejecuta su backup como una única corrutina en su propio bucle
+    de eventos: git (ver GitRunner) y las subidas no bloquean el hilo.
+    """
+
+    def __init__(self, app, github_service, storage_service, notification_service, config, timeouts=None):
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+        self.github_service = github_service
+        self.storage_service = storage_service
+        self.notification_service = notification_service
+        self.config = config
+        self.pool_size = config.get('pool_size', 4)
+        self.poll_interval = config.get('poll_interval', 5)
+        self.full_bundle_every = config.get('full_bundle_every', 7)
+        self.lease_ttl = config.get('lease_ttl', 60)
+        self.max_attempts = config.get('max_attempts', 3)
+        self.timeouts = timeouts or {}
+        self.estimator = JobEstimator()
+        # Identificador único de este proceso como propietario de las leases;
+        # empieza por el de su máquina
+        self.lease_host = f'{socket.gethostname()[:40]}:'
+        self.worker_id = f'{self.lease_host}{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        # Admisión por espacio en el disco de trabajo (ver ScratchSpace)
+        self.scratch = ScratchSpace(github_service.temp_dir, config.get('scratch') or {}, self.lease_host)
+        # Reparto de los workers entre usuarios (ver _select_tenant)
+        fair_share = config.get('fair_share') or {}
+        self.by_organization = fair_share.get('by_organization', False)
+        self.tenant_max_concurrent = fair_share.get('max_concurrent', 0)
+        self.tenant_weights = fair_share.get('weights') or {}
+        self.tenant_limits = fair_share.get('limits') or {}
+        self.preempt_after = config.get('preempt_after', 120)
+        # Controles de los backups en curso en este proceso, por ID
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self._heartbeat = None
+        self._heartbeat_stop = threading.Event()
+
+    def start(self):
+        """
+        Arranca el pool de workers.
+        """
+        if self._threads:
+            return
+
+        self._stop.clear()
+        self._heartbeat_stop.clear()
+        for i in range(self.pool_size):
+            thread = threading.Thread(
+                target=self._worker_loop,
+                name=f'backup-worker-{i}',
+                daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        self._heartbeat = threading.Thread(
+            target=self._heartbeat_loop,
+            name='backup-heartbeat',
+            daemon=True
+        )
+        self._heartbeat.start()
+
+        self.logger.info(f'Cola de backups iniciada con {self.pool_size} workers ({self.worker_id})')
+
+    def stop(self, timeout=None):
+        """
+        Detiene el pool de workers cuando terminan el trabajo en curso.
+
+        Args:
+            timeout: Segundos máximos de espera por cada worker
+        """
+        self._stop.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        # Tras los workers: sus leases se renuevan hasta que terminan
+        self._heartbeat_stop.set()
+        if self._heartbeat:
+            self._heartbeat.join(timeout)
+        self._heartbeat = None
+
+    def enqueue(self, repository, priority=PRIORITY_MANUAL):
+        """
+        Encola un backup de un repositorio.
+
+        Args:
+            repository: Objeto Repository
+            priority: Prioridad en la cola (ver PRIORITY_*)
+
+        Returns:
+            Backup creado en estado 'pending'
+        """
+        duration, size = self.estimator.estimate(repository)
+        backup = Backup(
+            repository_id=repository.id,
+            status='pending',
+            priority=priority,
+            estimated_duration=duration,
+            estimated_size=size,
+            organization=repository.get_owner()
+        )
+        db.session.add(backup)
+        db.session.commit()
+
+        self._wakeup.set()
+        return backup
+
+    def cancel(self, backup_id, reason='Backup cancelado por el usuario'):
+        """
+        Cancela un backup pendiente o en curso.
+
+        Un backup pendiente se cancela al momento. En uno en curso se
+        interrumpe la operación que esté haciendo el worker, que descarta
+        las subidas a medias y los archivos temporales: al momento si el
+        worker es de este proceso y, si no, cuando renueva su lease.
+
+        Args:
+            backup_id: ID del backup
+            reason: Motivo, que se registra como mensaje de error
+
+        Returns:
+            True si el backup se canceló, False si no estaba pendiente ni en curso
+        """
+        cancelled = Backup.query.filter_by(id=backup_id, status='pending').update(
+            {'status': 'cancelled', 'error_message': reason, 'completed_at': datetime.utcnow()},
+            synchronize_session=False
+        )
+        db.session.commit()
+        if cancelled:
+            return True
+
+        requested = Backup.query.filter(
+            Backup.id == backup_id,
+            Backup.status.in_(ACTIVE_STATUSES)
+        ).update({'cancel_requested': True, 'error_message': reason}, synchronize_session=False)
+        db.session.commit()
+        if not requested:
+            return False
+
+        with self._jobs_lock:
+            control = self._jobs.get(backup_id)
+        if control is not None:
+            control.cancel(reason)
+        return True
+
+    def _worker_loop(self):
+        """
+        Bucle de un worker: reclama trabajos pendientes hasta que se detiene la cola.
+        """
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    with self.scratch.admission():
+                        backup_id = self._claim_next()
+                    if backup_id is not None:
+                        # Todo el backup es una corrutina en el bucle de eventos del worker
+                        asyncio.run(self._process(backup_id))
+                        continue
+            except Exception as e:
+                self.logger.error(f'Error in backup worker: {str(e)}')
+
+            # Sin trabajo: esperar a un nuevo encolado o al siguiente sondeo
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _heartbeat_loop(self):
+        """
+        Renueva las leases de los backups en curso hasta que se detiene la cola.
+        """
+        while not self._heartbeat_stop.wait(self.lease_ttl / 3):
+            try:
+                with self.app.app_context():
+                    self._renew_leases()
+                    self._request_preemptions()
+            except Exception as e:
+                self.logger.error(f'Error renewing backup leases: {str(e)}')
+
+    def _renew_leases(self):
+        """
+        Renueva las leases de los backups en curso en este proceso.
+
+        Interrumpe los backups cuya cancelación se pidió desde otro proceso,
+        los que deben ceder su worker (ver _request_preemptions) y los que
+        perdieron la lease (p. ej. el proceso estuvo detenido más de
+        `lease_ttl` segundos y otro worker reclamó el backup).
+        """
+        with self._jobs_lock:
+            jobs = dict(self._jobs)
+        if not jobs:
+            return
+
+        Backup.query.filter(
+            Backup.id.in_(jobs),
+            Backup.lease_owner == self.worker_id
+        ).update(
+            {'lease_expires_at': datetime.utcnow() + timedelta(seconds=self.lease_ttl)},
+            synchronize_session=False
+        )
+        db.session.commit()
+
+        rows = db.session.query(
+            Backup.id, Backup.lease_owner, Backup.cancel_requested, Backup.preempt_requested, Backup.error_message
+        ).filter(Backup.id.in_(jobs)).all()
+        for backup_id, owner, cancel_requested, preempt_requested, reason in rows:
+            if owner != self.worker_id:
+                jobs[backup_id].interrupt(LeaseLost(f'El backup {backup_id} lo procesa otro worker ({owner})'))
+            elif cancel_requested:
+                jobs[backup_id].cancel(reason or 'Backup cancelado')
+            elif preempt_requested:
+                jobs[backup_id].interrupt(Preempted(f'El backup {backup_id} cede su worker a un backup manual'))
+
+    def _request_preemptions(self):
+        """
+        Pide a backups programados en curso que cedan su worker a los
+        backups manuales que llevan más de `preempt_after` segundos esperando.
+
+        Solo se cuentan los backups manuales que podrían reclamarse al
+        quedar libre el worker: si su usuario ya tiene en curso su máximo de
+        backups simultáneos, únicamente cede uno de sus propios backups
+        programados, y solo se interrumpe un backup si al liberar su reserva
+        de disco de trabajo el manual cabe (ver ScratchSpace). Como el
+        espacio libre solo se conoce en la máquina local, cada proceso pide
+        ceder solo backups de su máquina. Se eligen los que empezaron más
+        tarde (los que menos trabajo pierden; sus subidas continúan desde el
+        último punto de control al volver a procesarse), primero los del
+        mismo usuario que espera. Cada worker interrumpe sus backups al
+        renovar su lease.
+        """
+        if not self.preempt_after:
+            return
+
+        waiting = db.session.query(Backup.id, Repository).join(Backup.repository).filter(
+            Backup.status == 'pending',
+            Backup.priority <= PRIORITY_MANUAL,
+            Backup.created_at <= datetime.utcnow() - timedelta(seconds=self.preempt_after)
+        ).order_by(Backup.created_at, Backup.id).all()
+        if not waiting:
+            return
+
+        active = db.session.query(
+            Backup.id, Repository.user_id, Backup.priority, Backup.preempt_requested, Backup.cancel_requested,
+            Backup.scratch_reserved, Backup.lease_owner
+        ).join(Backup.repository).filter(
+            Backup.status.in_(ACTIVE_STATUSES)
+        ).order_by(Backup.started_at.desc()).all()
+
+        running = {}
+        for _, user_id, *_ in active:
+            running[user_id] = running.get(user_id, 0) + 1
+        usernames = dict(db.session.query(User.id, User.username).filter(
+            User.id.in_({repo.user_id for _, repo in waiting})
+        ))
+
+        # Cada petición ya hecha liberará un worker para uno de los que esperan,
+        # preferentemente de su mismo usuario
+        pending = list(waiting)
+        for _, user_id, _, preempt_requested, *_ in active:
+            if not preempt_requested or not pending:
+                continue
+            match = next((item for item in pending if item[1].user_id == user_id), pending[0])
+            pending.remove(match)
+
+        victims = [
+            (backup_id, user_id, reserved or 0)
+            for backup_id, user_id, priority, preempt_requested, cancel_requested, reserved, owner in active
+            if priority > PRIORITY_MANUAL and not preempt_requested and not cancel_requested
+            and (owner or '').startswith(self.lease_host)
+        ]
+        local = sum(1 for *_, owner in active if (owner or '').startswith(self.lease_host))
+        available = self.scratch.available()
+
+        chosen = []
+        for _, repo in pending:
+            limit = self._tenant_limit(usernames.get(repo.user_id))
+            capped = limit and running.get(repo.user_id, 0) >= limit
+            needed = self.scratch.reservation(repo)
+            candidates = sorted(victims, key=lambda victim: victim[1] != repo.user_id)
+            for victim in candidates:
+                backup_id, user_id, reserved = victim
+                if capped and user_id != repo.user_id:
+                    continue
+                # Al quedarse la máquina sin backups en curso se admite cualquiera
+                if needed > available + reserved and local - len(chosen) > 1:
+                    continue
+                victims.remove(victim)
+                chosen.append(backup_id)
+                available += reserved - needed
+                running[user_id] -= 1
+                running[repo.user_id] = running.get(repo.user_id, 0) + 1
+                break
+
+        for backup_id in chosen:
+            Backup.query.filter_by(id=backup_id, preempt_requested=False).update(
+                {'preempt_requested': True},
+                synchronize_session=False
+            )
+        db.session.commit()
+        if chosen:
+            self.logger.info(f'Preempting backups {chosen} for manual backups')
+
+    def _claimable(self, now):
+        """
+        Condición de los backups que puede reclamar un worker: los pendientes
+        y los que están en curso con la lease caducada (su worker murió).
+
+        Args:
+            now: Fecha actual
+        """
+        return or_(
+            Backup.status == 'pending',
+            and_(
+                Backup.status.in_(ACTIVE_STATUSES),
+                or_(Backup.lease_expires_at.is_(None), Backup.lease_expires_at < now)
+            )
+        )
+
+    def _claim_next(self):
+        """
+        Reclama el siguiente backup pendiente o abandonado por otro worker.
+
+        Primero se elige de qué usuario se toma (ver _select_tenant). De sus
+        backups se toman primero los de mayor prioridad y, a igual prioridad,
+        los más largos: un repositorio enorme que empezara el último
+        alargaría todo el lote, mientras que los cortos rellenan los huecos
+        que dejan los largos en los demás workers.
+
+        Solo se reclaman backups cuya reserva de disco de trabajo cabe en el
+        espacio libre (ver ScratchSpace). El cambio de estado se hace con un
+        UPDATE condicionado a que el backup siga siendo reclamable, de modo
+        que dos workers nunca reclaman el mismo trabajo. En bases de datos con bloqueo de filas (PostgreSQL)
+        los workers además se saltan las filas que otro está reclamando.
+
+        Returns:
+            ID del backup reclamado o None si no hay trabajo
+        """
+        while True:
+            now = datetime.utcnow()
+            claimable = self._claimable(now)
+            admissible = claimable
+            if self.scratch.busy:
+                # Con backups en curso solo se admiten los que caben en disco
+                admissible = and_(claimable, self.scratch.fits(self.scratch.available()))
+            tenant = self._select_tenant(admissible)
+            if tenant is None:
+                db.session.commit()
+                return None
+
+            candidate = Backup.query.filter(admissible, *tenant).order_by(
+                Backup.priority, Backup.estimated_duration.desc(), Backup.created_at, Backup.id
+            ).with_for_update(skip_locked=True).first()
+            if not candidate:
+                # Otro worker está reclamando los backups de este usuario
+                db.session.commit()
+                return None
+
+            # Tras el commit el objeto se recarga con los valores ya actualizados
+            backup_id, attempts = candidate.id, candidate.attempts
+            if candidate.cancel_requested or attempts >= self.max_attempts:
+                # Se canceló mientras su worker estaba caído, o mató a sus
+                # workers (o se quedaron sin lease) demasiadas veces
+                if candidate.cancel_requested:
+                    status, message = 'cancelled', candidate.error_message
+                else:
+                    status, message = 'error', f'Abandonado tras {attempts} intentos sin terminar'
+                abandoned = Backup.query.filter(Backup.id == backup_id, claimable).update(
+                    {
+                        'status': status,
+                        'error_message': message,
+                        'completed_at': now,
+                        'lease_owner': None,
+                        'lease_expires_at': None
+                    },
+                    synchronize_session=False
+                )
+                db.session.commit()
+                if abandoned:
+                    self.logger.warning(f'Backup {backup_id} {status} after {attempts} attempts')
+                continue
+
+            reserved = self.scratch.reservation(candidate.repository)
+            claimed = Backup.query.filter(Backup.id == backup_id, claimable).update(
+                {
+                    'scratch_reserved': reserved,
+                    'status': 'cloning',
+                    'started_at': now,
+                    'lease_owner': self.worker_id,
+                    'lease_expires_at': now + timedelta(seconds=self.lease_ttl),
+                    'attempts': Backup.attempts + 1,
+                    'preempt_requested': False
+                },
+                synchronize_session=False
+            )
+            db.session.commit()
+
+            if claimed:
+                self.scratch.register(backup_id, reserved)
+                if attempts:
+                    self.logger.info(f'Backup {backup_id} reclaimed (attempt {attempts + 1})')
+                return backup_id
+
+    def _select_tenant(self, claimable):
+        """
+        Elige de qué usuario (y organización) se toma el siguiente backup.
+
+        Reparto justo ponderado: los backups manuales van antes que los
+        programados de cualquier usuario y, dentro de la misma clase, se
+        elige el usuario con menos backups en curso en proporción a su peso
+        (`fair_share.weights`); a igualdad, el que lleva más tiempo
+        esperando. Los usuarios que ya tienen en curso su máximo de backups
+        simultáneos no se eligen. Con `by_organization` se reparte igual
+        entre las organizaciones de GitHub del usuario elegido.
+
+        Args:
+            claimable: Condición de los backups reclamables
+
+        Returns:
+            Lista de condiciones sobre Backup o None si no hay nada que reclamar
+        """
+        groups = db.session.query(
+            Repository.user_id,
+            Backup.organization,
+            func.min(Backup.priority),
+            func.min(Backup.created_at)
+        ).join(Backup.repository).filter(claimable).group_by(Repository.user_id, Backup.organization).all()
+        if not groups:
+            return None
+
+        running = self._running_counts()
+        usernames = dict(db.session.query(User.id, User.username).filter(
+            User.id.in_({user_id for user_id, _, _, _ in groups})
+        ))
+
+        # Clase (0 = manual, 1 = programado) y espera de cada usuario
+        heads = {}
+        for user_id, _, priority, oldest in groups:
+            head = (0 if priority <= PRIORITY_MANUAL else 1, oldest)
+            heads[user_id] = min(heads.get(user_id, head), head)
+
+        eligible = [
+            user_id for user_id in heads
+            if not self._tenant_limit(usernames.get(user_id))
+            or sum(running.get(user_id, {}).values()) < self._tenant_limit(usernames.get(user_id))
+        ]
+        if not eligible:
+            return None
+
+        def share(user_id):
+            klass, oldest = heads[user_id]
+            in_use = sum(running.get(user_id, {}).values())
+            return klass, in_use / self._tenant_weight(usernames.get(user_id)), oldest
+
+        user_id = min(eligible, key=share)
+        klass = heads[user_id][0]
+        conditions = [Backup.repository.has(Repository.user_id == user_id)]
+        if klass == 0:
+            conditions.append(Backup.priority <= PRIORITY_MANUAL)
+
+        if self.by_organization:
+            organizations = [
+                (running.get(user_id, {}).get(organization, 0), oldest, organization or '', organization)
+                for group_user, organization, priority, oldest in groups
+                if group_user == user_id and (klass == 1 or priority <= PRIORITY_MANUAL)
+            ]
+            organization = min(organizations)[-1]
+            conditions.append(
+                Backup.organization == organization if organization is not None else Backup.organization.is_(None)
+            )
+        return conditions
+
+    def _running_counts(self):
+        """
+        Backups en curso (en todos los workers) por usuario y organización.
+
+        Returns:
+            Diccionario {ID de usuario: {organización: backups}}
+        """
+        rows = db.session.query(
+            Repository.user_id, Backup.organization, func.count(Backup.id)
+        ).join(Backup.repository).filter(
+            Backup.status.in_(ACTIVE_STATUSES)
+        ).group_by(Repository.user_id, Backup.organization)
+
+        running = {}
+        for user_id, organization, count in rows:
+            running.setdefault(user_id, {})[organization] = count
+        return running
+
+    def _tenant_weight(self, username):
+        """
+        Peso de un usuario en el reparto de los workers.
+
+        Args:
+            username: Nombre del usuario
+        """
+        return max(float(self.tenant_weights.get(username, 1)), 0.001)
+
+    def _tenant_limit(self, username):
+        """
+        Máximo de backups simultáneos de un usuario (0 = sin límite).
+
+        Args:
+            username: Nombre del usuario
+        """
+        return self.tenant_limits.get(username, self.tenant_max_concurrent) or 0
+
+    def tenants(self, user_id=None):
+        """
+        Estado de la cola de cada usuario: backups pendientes y en curso,
+        límites y tiempos de espera.
+
+        Args:
+            user_id: Solo este usuario (por defecto, todos los que tienen
+                backups pendientes o en curso)
+
+        Returns:
+            Lista de diccionarios, uno por usuario
+        """
+        now = datetime.utcnow()
+        query = db.session.query(
+            Repository.user_id,
+            Backup.organization,
+            func.count(Backup.id),
+            func.sum(case((Backup.priority <= PRIORITY_MANUAL, 1), else_=0)),
+            func.min(Backup.created_at)
+        ).join(Backup.repository).filter(Backup.status == 'pending')
+        if user_id is not None:
+            query = query.filter(Repository.user_id == user_id)
+        pending = query.group_by(Repository.user_id, Backup.organization).all()
+
+        running = self._running_counts()
+        if user_id is not None:
+            running = {user_id: running[user_id]} if user_id in running else {}
+
+        # Espera de los backups que empezaron en la última hora
+        recent = db.session.query(Repository.user_id, Backup.created_at, Backup.started_at).join(
+            Backup.repository
+        ).filter(Backup.started_at >= now - timedelta(hours=1))
+        if user_id is not None:
+            recent = recent.filter(Repository.user_id == user_id)
+        waits = {}
+        for owner_id, created_at, started_at in recent:
+            waits.setdefault(owner_id, []).append(max((started_at - created_at).total_seconds(), 0))
+
+        user_ids = {owner_id for owner_id, *_ in pending} | set(running)
+        if user_id is not None:
+            user_ids.add(user_id)
+        usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(user_ids)))
+
+        tenants = {}
+        for owner_id in user_ids:
+            username = usernames.get(owner_id)
+            tenants[owner_id] = {
+                'user_id': owner_id,
+                'username': username,
+                'weight': self._tenant_weight(username),
+                'max_concurrent': self._tenant_limit(username),
+                'running': sum(running.get(owner_id, {}).values()),
+                'pending': 0,
+                'pending_manual': 0,
+                'oldest_wait': None,
+                'recent_wait': statistics.mean(waits[owner_id]) if owner_id in waits else None,
+                'organizations': {}
+            }
+        for owner_id, organization, count, manual, oldest in pending:
+            tenant = tenants[owner_id]
+            tenant['pending'] += count
+            tenant['pending_manual'] += manual or 0
+            wait = (now - oldest).total_seconds()
+            tenant['oldest_wait'] = max(tenant['oldest_wait'] or 0, wait)
+            tenant['organizations'].setdefault(organization, {'pending': 0, 'running': 0})['pending'] = count
+        for owner_id, organizations in running.items():
+            for organization, count in organizations.items():
+                tenants[owner_id]['organizations'].setdefault(organization, {'pending': 0, 'running': 0})['running'] = count
+
+        for tenant in tenants.values():
+            tenant['organizations'] = [
+                {'organization': organization, **counts}
+                for organization, counts in sorted(tenant['organizations'].items(), key=lambda item: item[0] or '')
+            ]
+        return sorted(tenants.values(), key=lambda tenant: tenant['oldest_wait'] or 0, reverse=True)
+
+    def _set_status(self, backup, status):
+        """
+        Actualiza el estado de un backup.
+
+        Args:
+            backup: Objeto Backup
+            status: Nuevo estado
+        """
+        backup.status = status
+        db.session.commit()
+
+    def _last_successful(self, backup, repo):
+        """
+        Obtiene el último backup correcto de un repositorio.
+
+        Args:
+            backup: Objeto Backup en curso (se excluye)
+            repo: Objeto Repository
+        """
+        return Backup.query.filter(
+            Backup.repository_id == repo.id,
+            Backup.id != backup.id,
+            Backup.status.in_(SUCCESSFUL_STATUSES)
+        ).order_by(Backup.created_at.desc(), Backup.id.desc()).first()
+
+    async def _skip_unchanged(self, backup, repo, control=None):
+        """
+        Marca el backup como 'unchanged' si las referencias remotas no cambiaron
+        desde el último backup correcto.
+
+        Args:
+            backup: Objeto Backup en curso
+            repo: Objeto Repository
+            control: JobControl del backup
+
+        Returns:
+            True si el backup se resolvió sin clonar
+        """
+        try:
+            backup.ref_fingerprint = await self.github_service.get_ref_fingerprint(repo.url, control)
+            db.session.commit()
+        except Exception as e:
+            # Sin huella se hace un backup completo
+            self.logger.warning(f'Error getting ref fingerprint for {repo.url}: {str(e)}')
+            return False
+
+        previous = self._last_successful(backup, repo)
+        if not previous or previous.ref_fingerprint != backup.ref_fingerprint:
+            return False
+        artifact = Backup.query.get(previous.artifact_backup_id) if previous.artifact_backup_id else previous
+        if not self._has_all_copies(artifact, repo):
+            # Falta la copia en algún destino: se vuelve a subir
+            return False
+
+        backup.status = 'unchanged'
+        backup.artifact_backup_id = previous.artifact_backup_id or previous.id
+        backup.artifact_type = previous.artifact_type
+        backup.storage_path = previous.storage_path
+        backup.size = previous.size
+        backup.repo_info = previous.repo_info
+        backup.completed_at = datetime.utcnow()
+        repo.last_backup = backup.completed_at
+        db.session.commit()
+
+        self.logger.info(f'Backup {backup.id} unchanged since backup {previous.id}')
+        return True
+
+    def _has_all_copies(self, artifact, repo):
+        """
+        Comprueba si un artefacto se subió a todos los destinos del repositorio.
+
+        Args:
+            artifact: Objeto Backup que contiene el artefacto
+            repo: Objeto Repository
+        """
+        copies = {d.storage_type for d in artifact.destinations if d.status == 'completed'}
+        return set(repo.get_storage_types()) <= copies
+
+    async def _create_bundle(self, backup, repo, control=None):
+        """
+        Genera el bundle de un backup incremental.
+
+        El bundle solo contiene los objetos que no estaban en el bundle
+        anterior de la cadena. Cada `full_bundle_every` backups se genera un
+        bundle completo que inicia una cadena nueva, igual que si al bundle
+        anterior le falta la copia en algún destino.
+
+        Args:
+            backup: Objeto Backup en curso
+            repo: Objeto Repository
+            control: JobControl del backup
+
+        Returns:
+            Ruta del bundle generado
+        """
+        previous = self._last_successful(backup, repo)
+        if previous and previous.artifact_backup_id:
+            previous = Backup.query.get(previous.artifact_backup_id)
+
+        base_id = None
+        if (previous and previous.artifact_type in BUNDLE_TYPES and previous.refs
+                and self._has_all_copies(previous, repo)):
+            base_id = previous.chain_base_id or previous.id
+            chain_length = Backup.query.filter(
+                Backup.chain_base_id == base_id,
+                Backup.status == 'completed'
+            ).count() + 1
+            if chain_length >= self.full_bundle_every:
+                base_id = None
+
+        def on_compress():
+            if control:
+                control.start_stage('compress')
+            self._set_status(backup, 'compressing')
+
+        exclude = list(json.loads(previous.refs).values()) if base_id else None
+        bundle_path, refs = await self.github_service.create_bundle(repo.url, backup.id, exclude, on_compress, control)
+
+        if bundle_path is None and base_id:
+            # Sin objetos nuevos (p. ej. solo se borraron ramas): bundle completo
+            base_id = None
+            bundle_path, refs = await self.github_service.create_bundle(repo.url, backup.id, control=control)
+        if bundle_path is None:
+            raise ValueError(f'El repositorio {repo.url} está vacío')
+
+        backup.refs = json.dumps(refs)
+        if base_id:
+            backup.artifact_type = 'incremental_bundle'
+            backup.parent_backup_id = previous.id
+            backup.chain_base_id = base_id
+        else:
+            backup.artifact_type = 'full_bundle'
+        db.session.commit()
+
+        return bundle_path
+
+    async def _process(self, backup_id):
+        """
+        Ejecuta un backup reclamado.
+
+        Args:
+            backup_id: ID del backup
+        """
+        backup = Backup.query.get(backup_id)
+        repo = backup.repository
+        control = JobControl(self.timeouts)
+        with self._jobs_lock:
+            self._jobs[backup_id] = control
+        # Medición del disco de trabajo que ocupa el backup
+        paths = lambda: self.github_service.scratch_paths(backup_id)
+        sampler = asyncio.ensure_future(self.scratch.track(backup_id, paths))
+
+        try:
+            control.start_stage('clone')
+            if await self._skip_unchanged(backup, repo, control):
+                return
+
+            if repo.backup_mode == 'incremental':
+                artifact_path = await self._create_bundle(backup, repo, control)
+            else:
+                await self.github_service.clone_repository(repo.url, backup.id, control)
+                # El archivo se comprime mientras se sube (ver ArchiveStream)
+                artifact_path = None
+
+            control.start_stage('upload')
+            self._set_status(backup, 'uploading')
+            await self.storage_service.upload_backup(backup.id, repo.get_storage_types(), artifact_path, control)
+
+            repo.last_backup = backup.completed_at
+            self._update_repository_info(repo, backup)
+            db.session.commit()
+
+            self.notification_service.send_notification(
+                repo.user_id,
+                'success',
+                'Backup completado',
+                f'El backup del repositorio {repo.url} ha finalizado correctamente'
+            )
+        except Preempted as e:
+            # Vuelve a la cola y continuará desde donde se quedó
+            self.logger.info(f'Backup {backup_id} preempted: {str(e)}')
+            db.session.rollback()
+            self._requeue(backup_id)
+        except LeaseLost as e:
+            # El backup es ahora de otro worker: no se toca su estado
+            self.logger.warning(f'Backup {backup_id} abandoned: {str(e)}')
+            db.session.rollback()
+        except JobCancelled as e:
+            self.logger.warning(f'Backup {backup_id} interrupted: {str(e)}')
+            db.session.rollback()
+            # Un tiempo límite vencido es un error; una cancelación, no
+            backup.status = 'error' if isinstance(e, DeadlineExceeded) else 'cancelled'
+            backup.error_message = str(e)
+            backup.completed_at = datetime.utcnow()
+            db.session.commit()
+
+            self.notification_service.send_notification(
+                repo.user_id,
+                'error' if isinstance(e, DeadlineExceeded) else 'warning',
+                'Backup interrumpido',
+                f'El backup del repositorio {repo.url} se ha interrumpido: {str(e)}'
+            )
+        except Exception as e:
+            self.logger.error(f'Error processing backup {backup_id}: {str(e)}')
+            db.session.rollback()
+            if not self._mark_failed(backup_id, str(e)):
+                # El backup es ahora de otro worker: no se toca su estado
+                self.logger.warning(f'Backup {backup_id} failed after losing its lease')
+                return
+
+            self.notification_service.send_notification(
+                repo.user_id,
+                'error',
+                'Error en el backup',
+                f'El backup del repositorio {repo.url} ha fallado: {str(e)}'
+            )
+        finally:
+            sampler.cancel()
+            await asyncio.gather(sampler, return_exceptions=True)
+            control.finish()
+            with self._jobs_lock:
+                self._jobs.pop(backup_id, None)
+            peak = self.scratch.release(backup_id, paths)
+            self.github_service.cleanup_backup(backup.id)
+            self._record_scratch_peak(backup_id, peak)
+            self._release_lease(backup_id)
+
+    @staticmethod
+    def _update_repository_info(repo, backup):
+        """
+        Guarda en el repositorio el último push y el tamaño según la
+        información de GitHub del backup (ver SchedulerService y JobEstimator).
+
+        Args:
+            repo: Objeto Repository
+            backup: Objeto Backup
+        """
+        info = json.loads(backup.repo_info or '{}')
+        if info.get('pushed_at'):
+            repo.pushed_at = datetime.fromisoformat(info['pushed_at']).replace(tzinfo=None)
+        if info.get('size') is not None:
+            repo.size = info['size']
+
+    def _requeue(self, backup_id):
+        """
+        Devuelve a la cola un backup que cedió su worker. La reclamación no
+        cuenta como intento.
+
+        Args:
+            backup_id: ID del backup
+        """
+        Backup.query.filter_by(id=backup_id, lease_owner=self.worker_id).update(
+            {
+                'status': 'pending',
+                'started_at': None,
+                'lease_owner': None,
+                'lease_expires_at': None,
+                'preempt_requested': False,
+                'attempts': Backup.attempts - 1
+            },
+            synchronize_session=False
+        )
+        db.session.commit()
+        self._wakeup.set()
+
+    def _mark_failed(self, backup_id, message):
+        """
+        Marca como erróneo un backup, si aún es de este worker. Si el
+        almacenamiento ya lo marcó se conserva su mensaje de error.
+
+        Args:
+            backup_id: ID del backup
+            message: Mensaje de error
+
+        Returns:
+            bool: False si la lease ya es de otro worker
+        """
+        values = {'completed_at': datetime.utcnow()}
+        if db.session.get(Backup, backup_id).status != 'error':
+            values.update({'status': 'error', 'error_message': message})
+        owned = Backup.query.filter_by(id=backup_id, lease_owner=self.worker_id).update(
+            values,
+            synchronize_session=False
+        )
+        db.session.commit()
+        return owned > 0
+
+    def _record_scratch_peak(self, backup_id, peak):
+        """
+        Guarda el pico de disco de trabajo de un backup y, si se completó,
+        en su repositorio para la reserva de su próximo backup. El valor del
+        repositorio decae un 10 % por backup en lugar de sustituirse, para
+        recordar los picos de los bundles completos entre los incrementales.
+
+        Args:
+            backup_id: ID del backup
+            peak: Bytes
+        """
+        try:
+            backup = Backup.query.get(backup_id)
+            backup.scratch_peak = peak
+            if backup.status == 'completed' and peak:
+                repo = backup.repository
+                repo.scratch_peak = max(peak, int((repo.scratch_peak or 0) * 0.9))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.logger.error(f'Error recording scratch usage of backup {backup_id}: {str(e)}')
+
+    def _release_lease(self, backup_id):
+        """
+        Libera la lease de un backup terminado, si aún es de este worker.
+
+        Args:
+            backup_id: ID del backup
+        """
+        try:
+            Backup.query.filter_by(id=backup_id, lease_owner=self.worker_id).update(
+                {'lease_owner': None, 'lease_expires_at': None},
+                synchronize_session=False
+            )
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            self.logger.error(f'Error releasing lease of backup {backup_id}: {str(e)}')
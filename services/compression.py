@@ -0,0 +1,161 @@
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+class Codec:
+    """
+    Codec de compresión para los artefactos de backup.
+
+    `open_writer` envuelve un objeto de escritura y `open_reader` uno de
+    lectura; cerrar el objeto devuelto termina el flujo comprimido pero no
+    cierra el original.
+    """
+
+    name = None
+    extension = ''
+    # Niveles de compresión admitidos (None = el nivel no se usa)
+    levels = None
+
+    def __init__(self, level=None, threads=-1):
+        self.level = level
+        self.threads = threads
+
+    def open_writer(self, fileobj):
+        raise NotImplementedError
+
+    def open_reader(self, fileobj):
+        raise NotImplementedError
+
+class ZstdCodec(Codec):
+    """
+    Zstandard con compresión multihilo.
+    """
+
+    name = 'zstd'
+    extension = '.zst'
+    levels = range(-131072, 23)
+
+    def open_writer(self, fileobj):
+        compressor = zstandard.ZstdCompressor(
+            level=self.level if self.level is not None else 3,
+            threads=self.threads
+        )
+        return compressor.stream_writer(fileobj, closefd=False)
+
+    def open_reader(self, fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False)
+
+class Lz4Codec(Codec):
+    """
+    LZ4: poca reducción de tamaño a muy alta velocidad.
+    """
+
+    name = 'lz4'
+    extension = '.lz4'
+    levels = range(0, 17)
+
+    def open_writer(self, fileobj):
+        return lz4.frame.LZ4FrameFile(
+            fileobj,
+            mode='wb',
+            compression_level=self.level if self.level is not None else 0
+        )
+
+    def open_reader(self, fileobj):
+        return lz4.frame.LZ4FrameFile(fileobj, mode='rb')
+
+class GzipCodec(Codec):
+    """
+    Gzip de un solo hilo, compatible con cualquier herramienta.
+    """
+
+    name = 'gzip'
+    extension = '.gz'
+    levels = range(0, 10)
+
+    def open_writer(self, fileobj):
+        # mtime=0 para que el mismo contenido produzca siempre los mismos bytes
+        return gzip.GzipFile(
+            fileobj=fileobj,
+            mode='wb',
+            compresslevel=self.level if self.level is not None else 6,
+            mtime=0
+        )
+
+    def open_reader(self, fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+class NoneCodec(Codec):
+    """
+    Sin compresión (solo almacenamiento).
+    """
+
+    name = 'none'
+
+    def open_writer(self, fileobj):
+        return _Passthrough(fileobj)
+
+    def open_reader(self, fileobj):
+        return _Passthrough(fileobj)
+
+class _Passthrough:
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def write(self, data):
+        return self._fileobj.write(data)
+
+    def read(self, size=-1):
+        return self._fileobj.read(size)
+
+    def close(self):
+        pass
+
+CODECS = {
+    'zstd': ZstdCodec,
+    'lz4': Lz4Codec,
+    'gzip': GzipCodec,
+    'none': NoneCodec
+}
+
+def get_codec(name, level=None, threads=-1):
+    """
+    Crea un codec a partir de su nombre.
+
+    Args:
+        name: Nombre del codec (zstd, lz4, gzip, none)
+        level: Nivel de compresión (None para el nivel por defecto del codec)
+        threads: Hilos de compresión para zstd (-1 = uno por núcleo)
+
+    Raises:
+        ValueError: Si el codec no existe, falta su dependencia o el nivel
+            no es válido para el codec
+    """
+    if name not in CODECS:
+        raise ValueError(f'Codec de compresión no soportado: {name}')
+    if name == 'zstd' and zstandard is None:
+        raise ValueError('El codec zstd requiere el paquete zstandard')
+    if name == 'lz4' and lz4 is None:
+        raise ValueError('El codec lz4 requiere el paquete lz4')
+
+    codec = CODECS[name]
+    if level in (None, ''):
+        return codec(None, threads)
+    try:
+        level = int(level)
+    except (TypeError, ValueError):
+        raise ValueError(f'Nivel de compresión no válido: {level}')
+    if codec.levels is not None and level not in codec.levels:
+        raise ValueError(
+            f'Nivel de compresión no válido para {name}: {level} '
+            f'(de {codec.levels.start} a {codec.levels.stop - 1})'
+        )
+    return codec(level, threads)
@@ -0,0 +1,167 @@
+from models import Backup, Repository
+from services.backup_queue import ACTIVE_STATUSES, PRIORITY_SCHEDULED
+from services.schedule import next_run
+from datetime import datetime, timedelta
+from sqlalchemy.orm import joinedload
+import heapq
+
+# Ejecuciones programadas de un repositorio que se simulan como máximo
+MAX_OCCURRENCES = 1000
+
+class QueueForecast:
+    """
+    Previsión de cuándo terminará el trabajo de la cola.
+
+    Simula el reparto de los workers: los backups en curso ocupan un worker
+    durante lo que les queda, y cada worker que queda libre toma, como la
+    cola (ver BackupQueue._claim_next), el backup disponible de mayor
+    prioridad y, a igual prioridad, el más largo. Opcionalmente incluye las
+    ejecuciones programadas hasta una fecha.
+    """
+
+    def __init__(self, estimator):
+        self.estimator = estimator
+
+    def forecast(self, workers, until=None, jitter=0, deadline=None, priority=PRIORITY_SCHEDULED, top=10):
+        """
+        Calcula la previsión.
+
+        Args:
+            workers: Backups simultáneos entre todos los workers
+            until: Incluir las ejecuciones programadas hasta esta fecha
+            jitter: Ventana de reparto del programador (ver next_run)
+            deadline: Fecha límite con la que comparar la previsión
+            priority: Prioridad de las ejecuciones programadas en la cola
+            top: Backups más largos que se detallan
+
+        Returns:
+            Diccionario con los trabajos, los bytes a transferir, la fecha
+            prevista de fin y, con `deadline`, si el trabajo cabe
+        """
+        now = datetime.utcnow()
+        running, jobs = [], []
+
+        for backup in Backup.query.options(joinedload(Backup.repository)).filter(Backup.status.in_(ACTIVE_STATUSES)):
+            elapsed = (now - backup.started_at).total_seconds() if backup.started_at else 0
+            running.append(self._job(backup, backup.repository, 0, 0, max((backup.estimated_duration or 0) - elapsed, 0)))
+
+        for backup in Backup.query.options(joinedload(Backup.repository)).filter(Backup.status == 'pending'):
+            jobs.append(self._job(backup, backup.repository, 0, backup.priority, backup.estimated_duration or 0))
+
+        scheduled = 0
+        if until:
+            repositories = Repository.query.filter(
+                Repository.next_run_at <= until,
+                Repository.status == 'active'
+            ).all()
+            estimates = self.estimator.estimate_many(repositories)
+            for repository in repositories:
+                duration, size = estimates[repository.id]
+                for run_at in self._occurrences(repository, until, jitter):
+                    arrival = max((run_at - now).total_seconds(), 0)
+                    jobs.append(self._job(None, repository, arrival, priority, duration, size))
+                    scheduled += 1
+
+        workers = max(int(workers), 1)
+        timeline = self._simulate(workers, running, jobs)
+        finish = max((job['finish'] for job in timeline), default=0)
+        completion_at = now + timedelta(seconds=finish)
+
+        longest = sorted(timeline, key=lambda job: job['duration'], reverse=True)[:top]
+        result = {
+            'generated_at': now.isoformat(),
+            'workers': workers,
+            'running': len(running),
+            'queued': len(jobs) - scheduled,
+            'scheduled': scheduled,
+            'work_seconds': sum(job['duration'] for job in timeline),
+            'bytes': sum(job['size'] or 0 for job in timeline),
+            'unknown_sizes': sum(1 for job in timeline if job['size'] is None),
+            'completion_seconds': finish,
+            'completion_at': completion_at.isoformat(),
+            'longest': [
+                {
+                    'backup_id': job['backup_id'],
+                    'repository_id': job['repository_id'],
+                    'url': job['url'],
+                    'estimated_duration': job['duration'],
+                    'estimated_size': job['size'],
+                    'start_at': (now + timedelta(seconds=job['start'])).isoformat(),
+                    'finish_at': (now + timedelta(seconds=job['finish'])).isoformat()
+                }
+                for job in longest
+            ]
+        }
+        if deadline:
+            result['deadline'] = deadline.isoformat()
+            result['fits'] = completion_at <= deadline
+        return result
+
+    @staticmethod
+    def _job(backup, repository, arrival, priority, duration, size=None):
+        """
+        Trabajo de la simulación.
+        """
+        return {
+            'backup_id': backup.id if backup else None,
+            'repository_id': repository.id,
+            'url': repository.url,
+            'arrival': arrival,
+            'priority': priority,
+            'duration': duration,
+            'size': backup.estimated_size if backup else size
+        }
+
+    @staticmethod
+    def _occurrences(repository, until, jitter):
+        """
+        Ejecuciones programadas de un repositorio desde su `next_run_at` hasta `until`.
+        """
+        run_at = repository.next_run_at
+        for _ in range(MAX_OCCURRENCES):
+            if run_at is None or run_at > until:
+                return
+            yield run_at
+            try:
+                run_at = next_run(repository.schedule, run_at, repository.id, jitter)
+            except ValueError:
+                return
+
+    @staticmethod
+    def _simulate(workers, running, jobs):
+        """
+        Reparte los trabajos entre los workers (planificación por listas con
+        el trabajo más largo primero).
+
+        Args:
+            workers: Número de workers
+            running: Trabajos en curso (su duración es lo que les queda)
+            jobs: Trabajos pendientes, con su llegada en segundos desde ahora
+
+        Returns:
+            Trabajos con su inicio y fin previstos, en segundos desde ahora
+        """
+        for job in running:
+            job['start'], job['finish'] = 0, job['duration']
+        free = sorted(job['finish'] for job in running)
+        # Hay más backups en curso que workers indicados: ya ocupan su hueco
+        free = free[len(free) - workers:] if len(free) > workers else free + [0] * (workers - len(free))
+        heapq.heapify(free)
+
+        arrivals = sorted(jobs, key=lambda job: job['arrival'])
+        available = []
+        i = 0
+        while i < len(arrivals) or available:
+            now = heapq.heappop(free)
+            if not available and arrivals[i]['arrival'] > now:
+                now = arrivals[i]['arrival']
+            while i < len(arrivals) and arrivals[i]['arrival'] <= now:
+                job = arrivals[i]
+                heapq.heappush(available, (job['priority'], -job['duration'], job['arrival'], i, job))
+                i += 1
+
+            job = heapq.heappop(available)[-1]
+            job['start'], job['finish'] = now, now + job['duration']
+            heapq.heappush(free, job['finish'])
+
+        return running + jobs
@@ -0,0 +1,173 @@
+from collections import deque
+from git.exc import GitCommandError
+from git.util import remove_password_if_present
+from repomirror.storage.scheduler import TransferSlots
+from services.job_control import JobControl, kill_process_group
+import asyncio
+import logging
+import os
+import re
+
+# Progreso que git escribe en stderr con --progress, p. ej.
+# "Receiving objects:  45% (450/1000), 1.20 MiB | 2.00 MiB/s"
+PROGRESS_PATTERN = re.compile(
+    r'^(?:remote: )?(?P<phase>[A-Za-z][A-Za-z ]*?):\s+(?P<percent>\d+)% \((?P<current>\d+)/(?P<total>\d+)\)'
+)
+
+class GitRunner:
+    """
+    Ejecuta comandos git como subprocesos de asyncio.
+
+    Cada comando espera en el bucle de eventos sin ocupar un hilo. El número
+    de comandos simultáneos está acotado para todos los workers a la vez,
+    cada uno con su propio bucle de eventos (ver TransferSlots). Un comando
+    se mata si supera su tiempo límite, si no escribe nada durante
+    `idle_timeout` segundos (p. ej. un servidor que dejó de responder) o si
+    se interrumpe su backup (ver JobControl).
+    """
+
+    def __init__(self, max_concurrency=8, idle_timeout=600):
+        self.logger = logging.getLogger(__name__)
+        self.slots = TransferSlots(max_concurrency)
+        self.idle_timeout = idle_timeout
+
+    async def run(self, args, cwd=None, input=None, control=None, on_progress=None, timeout=None):
+        """
+        Ejecuta un comando git.
+
+        Args:
+            args: Argumentos de git
+            cwd: Directorio de trabajo
+            input: Texto a escribir en la entrada estándar
+            control: JobControl del backup en curso
+            on_progress: Función que recibe el progreso de git
+                ({phase, percent, current, total}); el comando debe
+                incluir --progress
+            timeout: Segundos máximos de ejecución
+
+        Returns:
+            Salida estándar del comando
+
+        Raises:
+            GitCommandError: Si el comando falla
+            TimeoutError: Si supera su tiempo límite o deja de avanzar
+        """
+        control = control or JobControl()
+        control.check()
+        command = ['git'] + list(args)
+
+        await self.slots.acquire()
+        try:
+            returncode, stdout, stderr = await self._execute(command, cwd, input, control, on_progress, timeout)
+        finally:
+            self.slots.release()
+
+        control.check()
+        if returncode != 0:
+            # Sin las credenciales de las URLs, igual que GitPython
+            raise GitCommandError(remove_password_if_present(command), returncode, stderr, stdout)
+        return stdout
+
+    async def _execute(self, command, cwd, input, control, on_progress, timeout):
+        """
+        Lanza el subproceso y recoge su salida vigilando los tiempos límite.
+
+        Returns:
+            Tupla (código de salida, salida estándar, últimas líneas de error)
+        """
+        loop = asyncio.get_running_loop()
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            cwd=cwd,
+            # Sin credenciales git pediría usuario y contraseña y se quedaría esperando
+            env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'},
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # Propio grupo de procesos para matar también a git-remote-http, ssh...
+            start_new_session=os.name == 'posix'
+        )
+        started = loop.time()
+        activity = [started]
+        errors = deque(maxlen=50)
+        stdout = []
+
+        async def read_stdout():
+            while True:
+                chunk = await process.stdout.read(64 * 1024)
+                if not chunk:
+                    return
+                activity[0] = loop.time()
+                stdout.append(chunk)
+
+        async def read_stderr():
+            buffer = b''
+            while True:
+                chunk = await process.stderr.read(4096)
+                activity[0] = loop.time()
+                if not chunk:
+                    lines, buffer = [buffer], b''
+                else:
+                    # El progreso se reescribe en la misma línea con \r
+                    *lines, buffer = re.split(rb'[\r\n]', buffer + chunk)
+                for line in lines:
+                    self._parse_stderr(line.decode(errors='replace').strip(), errors, on_progress)
+                if not chunk:
+                    return
+
+        async def write_stdin():
+            if input is None:
+                return
+            try:
+                process.stdin.write(input.encode())
+                await process.stdin.drain()
+                process.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                # El proceso terminó sin leer la entrada: lo indica su código de salida
+                pass
+
+        io = asyncio.gather(read_stdout(), read_stderr(), write_stdin())
+        try:
+            with control.on_interrupt(lambda: kill_process_group(process)):
+                while True:
+                    try:
+                        await asyncio.wait_for(asyncio.shield(io), 1)
+                        break
+                    except asyncio.TimeoutError:
+                        now = loop.time()
+                        if timeout and now - started > timeout:
+                            raise TimeoutError(f'{command[1]} superó su tiempo límite de {timeout} s')
+                        if self.idle_timeout and now - activity[0] > self.idle_timeout:
+                            raise TimeoutError(f'{command[1]} sin actividad durante {self.idle_timeout} s')
+                returncode = await process.wait()
+        finally:
+            if process.returncode is None:
+                kill_process_group(process)
+                await process.wait()
+            io.cancel()
+            await asyncio.gather(io, return_exceptions=True)
+
+        return returncode, b''.join(stdout).decode(errors='replace'), '\n'.join(errors)
+
+    def _parse_stderr(self, line, errors, on_progress):
+        """
+        Separa las líneas de progreso de los mensajes de error.
+
+        Args:
+            line: Línea de stderr
+            errors: Cola con las últimas líneas que no son progreso
+            on_progress: Función que recibe el progreso o None
+        """
+        if not line:
+            return
+        match = PROGRESS_PATTERN.match(line)
+        if not match:
+            errors.append(line)
+            return
+        if on_progress:
+            on_progress({
+                'phase': match.group('phase'),
+                'percent': int(match.group('percent')),
+                'current': int(match.group('current')),
+                'total': int(match.group('total'))
+            })
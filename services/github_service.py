@@ -1,27 +1,41 @@
 import os
+import asyncio
+import glob
 import tempfile
+import hashlib
 import shutil
 import logging
-from git import Repo
-from github import Github
+from git.exc import GitCommandError
+from github import Github, GithubException, RateLimitExceededException
+from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout
 from models import db, Backup
-import subprocess
+from repomirror.retry import RetryPolicy
+from services.git_runner import GitRunner
+from services.job_control import JobCancelled
+from services.mirror_cache import MirrorCache, classify_git_error
 import json
 
 class GitHubService:
-    def __init__(self, config):
+    def __init__(self, config, retry_policy=None):
         self.logger = logging.getLogger(__name__)
         self.config = config
         self.github_client = Github(config.get('token'))
         self.temp_dir = tempfile.mkdtemp()
+        # Reintentos de las operaciones de red (git y API de GitHub)
+        self.retry_policy = retry_policy or RetryPolicy(0)
+        # Comandos git asíncronos, limitados entre todos los workers
+        git_config = config.get('git', {})
+        self.git = GitRunner(git_config.get('max_concurrency', 8), git_config.get('idle_timeout', 600))
+        self.mirror_cache = MirrorCache(config.get('mirror_cache', {}), self.retry_policy, self.git)
 
-    def clone_repository(self, repo_url, backup_id):
+    async def clone_repository(self, repo_url, backup_id, control=None):
         """
         Clona un repositorio de GitHub.
         
         Args:
             repo_url: URL del repositorio
             backup_id: ID del backup
+            control: JobControl del backup (mata git si se cancela)
         """
         backup = Backup.query.get(backup_id)
         if not backup:
@@ -32,28 +46,25 @@ class GitHubService:
             backup_dir = os.path.join(self.temp_dir, str(backup_id))
             os.makedirs(backup_dir, exist_ok=True)
 
-            # Clonar repositorio
-            if 'github.com' in repo_url:
-                # Repositorio público
-                repo = Repo.clone_from(repo_url, backup_dir)
-            else:
-                # Repositorio privado
-                repo = Repo.clone_from(
-                    repo_url.replace('https://', f'https://{self.config["token"]}@'),
-                    backup_dir
-                )
+            # Actualizar el espejo en caché y clonar desde él (los objetos se
+            # enlazan con hardlinks en lugar de descargarse de nuevo)
+            async with self.mirror_cache.checkout(repo_url, self._get_auth_url(repo_url), control) as mirror_path:
+                await self.git.run(['clone', '--local', mirror_path, backup_dir], control=control)
+            await self.git.run(['remote', 'set-url', 'origin', repo_url], cwd=backup_dir)
 
             # Obtener información del repositorio
-            repo_info = self._get_repo_info(repo_url)
+            repo_info = await self._fetch_repo_info(repo_url)
             
             # Actualizar backup
             backup.local_path = backup_dir
             backup.repo_info = json.dumps(repo_info)
-            backup.status = 'cloned'
             db.session.commit()
 
             return backup_dir
 
+        except JobCancelled:
+            # El estado del backup lo registra la cola
+            raise
         except Exception as e:
             self.logger.error(f'Error cloning repository {repo_url}: {str(e)}')
             backup.status = 'error'
@@ -61,6 +72,136 @@ class GitHubService:
             db.session.commit()
             raise
 
+    async def create_bundle(self, repo_url, backup_id, exclude=None, on_compress=None, control=None):
+        """
+        Genera un git bundle de un repositorio a partir de su espejo en caché.
+        
+        Args:
+            repo_url: URL del repositorio
+            backup_id: ID del backup
+            exclude: SHAs ya incluidos en bundles anteriores (bundle incremental)
+            on_compress: Función a llamar cuando el espejo está actualizado y
+                empieza el empaquetado
+            control: JobControl del backup (mata git si se cancela)
+            
+        Returns:
+            Tupla (ruta del bundle, referencias incluidas) o (None, referencias)
+            si no hay objetos nuevos respecto a `exclude`
+        """
+        backup = Backup.query.get(backup_id)
+        if not backup:
+            raise ValueError(f'Backup {backup_id} no encontrado')
+
+        bundle_path = os.path.join(self.temp_dir, f'{backup_id}.bundle')
+
+        try:
+            async with self.mirror_cache.checkout(repo_url, self._get_auth_url(repo_url), control) as mirror_path:
+                if on_compress:
+                    on_compress()
+
+                refs = {}
+                output = await self.git.run(['for-each-ref', '--format=%(objectname) %(refname)'], cwd=mirror_path)
+                for line in output.splitlines():
+                    sha, ref = line.split(' ', 1)
+                    refs[ref] = sha
+
+                # Tras un force-push o un desalojo de la caché algunos SHAs pueden
+                # no existir en el espejo; git bundle no admite exclusiones inválidas
+                exclude = await self._existing_objects(mirror_path, exclude or [])
+
+                try:
+                    # --progress mantiene viva la vigilancia de inactividad del runner
+                    await self.git.run(
+                        ['bundle', 'create', '--progress', bundle_path, '--all', '--stdin'],
+                        cwd=mirror_path,
+                        input=''.join(f'^{sha}\n' for sha in exclude),
+                        control=control
+                    )
+                except GitCommandError as e:
+                    if 'empty bundle' in str(e.stderr):
+                        return None, refs
+                    raise
+
+            backup.repo_info = json.dumps(await self._fetch_repo_info(repo_url))
+            db.session.commit()
+
+            return bundle_path, refs
+
+        except JobCancelled:
+            # El estado del backup lo registra la cola
+            raise
+        except Exception as e:
+            self.logger.error(f'Error creating bundle for {repo_url}: {str(e)}')
+            backup.status = 'error'
+            backup.error_message = str(e)
+            db.session.commit()
+            raise
+
+    async def _existing_objects(self, repo_path, shas):
+        """
+        Filtra los SHAs que existen en un repositorio.
+        
+        Args:
+            repo_path: Ruta del repositorio
+            shas: SHAs a comprobar
+        """
+        if not shas:
+            return []
+
+        output = await self.git.run(
+            ['cat-file', '--batch-check'],
+            cwd=repo_path,
+            input=''.join(f'{sha}\n' for sha in set(shas))
+        )
+        return [line.split()[0] for line in output.splitlines() if not line.endswith(' missing')]
+
+    async def get_ref_fingerprint(self, repo_url, control=None):
+        """
+        Calcula una huella de las referencias remotas de un repositorio.
+        
+        Usa `git ls-remote`, que solo transfiere la lista de referencias, de
+        modo que dos huellas iguales indican que no hubo pushes entre medias.
+        
+        Args:
+            repo_url: URL del repositorio
+            control: JobControl del backup en curso
+            
+        Returns:
+            Hash SHA-256 de las referencias remotas
+        """
+        auth_url = self._get_auth_url(repo_url)
+        output = await self.retry_policy.run(
+            lambda: self.git.run(['ls-remote', auth_url], control=control),
+            f'ls-remote of {repo_url}',
+            classify=classify_git_error
+        )
+        refs = sorted(line.strip() for line in output.splitlines() if line.strip())
+        return hashlib.sha256('\n'.join(refs).encode()).hexdigest()
+
+    def _get_auth_url(self, repo_url):
+        """
+        Obtiene la URL con credenciales para acceder a un repositorio.
+        
+        Args:
+            repo_url: URL del repositorio
+        """
+        if 'github.com' in repo_url:
+            # Repositorio público
+            return repo_url
+        # Repositorio privado
+        return repo_url.replace('https://', f'https://{self.config["token"]}@')
+
+    async def _fetch_repo_info(self, repo_url):
+        """
+        Obtiene la información de un repositorio sin bloquear el bucle de eventos.
+
+        PyGithub es síncrono: la petición se hace en un hilo aparte.
+
+        Args:
+            repo_url: URL del repositorio
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self._get_repo_info, repo_url)
+
     def _get_repo_info(self, repo_url):
         """
         Obtiene información de un repositorio de GitHub.
@@ -75,7 +216,11 @@ class GitHubService:
             repo_name = parts[-1].replace('.git', '')
 
             # Obtener información del repositorio
-            repo = self.github_client.get_repo(f'{owner}/{repo_name}')
+            repo = self.retry_policy.call(
+                lambda: self.github_client.get_repo(f'{owner}/{repo_name}'),
+                f'GitHub metadata of {repo_url}',
+                classify=self._classify_api_error
+            )
             
             return {
                 'name': repo.name,
@@ -87,12 +232,56 @@ class GitHubService:
                 'size': repo.size,
                 'default_branch': repo.default_branch,
                 'created_at': repo.created_at.isoformat(),
-                'updated_at': repo.updated_at.isoformat()
+                'updated_at': repo.updated_at.isoformat(),
+                'pushed_at': repo.pushed_at.isoformat() if repo.pushed_at else None
             }
         except Exception as e:
             self.logger.warning(f'Error getting repo info: {str(e)}')
             return {}
 
+    @staticmethod
+    def _classify_api_error(error):
+        """
+        Clasifica los errores de la API de GitHub (ver repomirror.retry.is_transient).
+
+        Agotar la cuota de peticiones no se reintenta: se restablece en
+        minutos u horas, y la información del repositorio es opcional.
+
+        Args:
+            error: Excepción a clasificar
+        """
+        if isinstance(error, RateLimitExceededException):
+            return False
+        if isinstance(error, GithubException):
+            return error.status in (408, 429) or (error.status or 0) >= 500
+        if isinstance(error, (RequestsConnectionError, Timeout)):
+            return True
+        return None
+
+    def cleanup_backup(self, backup_id):
+        """
+        Elimina la copia local de un backup, su bundle y sus artefactos.
+        
+        Args:
+            backup_id: ID del backup
+        """
+        backup_dir = os.path.join(self.temp_dir, str(backup_id))
+        shutil.rmtree(backup_dir, ignore_errors=True)
+        # El bundle y los artefactos comprimidos (.bundle.zst, .tar.zst...)
+        for path in glob.glob(f'{glob.escape(backup_dir)}.*'):
+            os.unlink(path)
+
+    def scratch_paths(self, backup_id):
+        """
+        Archivos y directorios de trabajo de un backup: su copia local, su
+        bundle y sus artefactos.
+        
+        Args:
+            backup_id: ID del backup
+        """
+        backup_dir = os.path.join(self.temp_dir, str(backup_id))
+        return [backup_dir] + glob.glob(f'{glob.escape(backup_dir)}.*')
+
     def cleanup_temp_files(self):
         """
         Limpia los archivos temporales.
@@ -0,0 +1,207 @@
+from contextlib import contextmanager
+import asyncio
+import logging
+import os
+import signal
+import threading
+
+# Etapas de un backup con tiempo límite propio
+STAGES = ('clone', 'compress', 'upload')
+
+def stage_timeouts(config):
+    """
+    Calcula el tiempo límite de cada etapa de un backup.
+
+    Args:
+        config: Sección general de la configuración: `timeout` es el límite
+            de cada etapa y `stage_timeouts` lo sobreescribe por etapa
+
+    Returns:
+        Diccionario etapa -> segundos (None o 0 = sin límite)
+    """
+    overrides = config.get('stage_timeouts') or {}
+    return {stage: overrides.get(stage, config.get('timeout')) for stage in STAGES}
+
+def kill_process_group(process):
+    """
+    Mata un subproceso junto con los procesos que haya lanzado.
+
+    git delega el transporte en otros procesos (git-remote-http, ssh) que, si
+    siguieran vivos, mantendrían abiertas las tuberías. Para ello el
+    subproceso debe lanzarse en su propio grupo (start_new_session=True).
+
+    Args:
+        process: subprocess.Popen o asyncio.subprocess.Process
+    """
+    try:
+        if os.name == 'posix':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+    except ProcessLookupError:
+        pass
+
+class JobCancelled(Exception):
+    """El backup se canceló mientras se procesaba."""
+    pass
+
+class DeadlineExceeded(JobCancelled):
+    """Una etapa del backup superó su tiempo límite."""
+    pass
+
+class JobSuspended(JobCancelled):
+    """El backup se interrumpe sin descartar su progreso: lo continuará otro worker."""
+    pass
+
+class LeaseLost(JobSuspended):
+    """El worker perdió la lease del backup, que ahora procesa otro worker."""
+    pass
+
+class Preempted(JobSuspended):
+    """El backup cede su worker a uno de mayor prioridad y vuelve a la cola."""
+    pass
+
+class JobControl:
+    """
+    Control de cancelación y de tiempos límite de un backup en curso.
+
+    El worker marca el comienzo de cada etapa con `start_stage`, que arma un
+    temporizador con el límite de la etapa. Al cancelar el trabajo o vencer
+    el límite se ejecutan las funciones registradas con `on_interrupt`
+    (matar un subproceso, cancelar una corrutina...) para desbloquear la
+    operación en curso, que termina con JobCancelled o DeadlineExceeded.
+    Las operaciones que no se pueden interrumpir lo comprueban con `check`.
+    """
+
+    def __init__(self, timeouts=None):
+        self.logger = logging.getLogger(__name__)
+        self.timeouts = timeouts or {}
+        self.stage = None
+        self._error = None
+        self._timer = None
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def interrupted(self):
+        return self._error is not None
+
+    def check(self):
+        """
+        Lanza JobCancelled (o DeadlineExceeded) si el trabajo se interrumpió.
+        """
+        if self._error is not None:
+            raise self._error
+
+    def start_stage(self, stage):
+        """
+        Empieza una etapa del trabajo; el límite de la anterior deja de contar.
+
+        Args:
+            stage: Nombre de la etapa (ver STAGES)
+        """
+        self.check()
+        self._cancel_timer()
+        self.stage = stage
+        timeout = self.timeouts.get(stage)
+        if timeout:
+            error = DeadlineExceeded(f'La etapa {stage} superó su tiempo límite de {timeout} s')
+            self._timer = threading.Timer(timeout, self._interrupt, args=(error,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    async def wait(self, seconds):
+        """
+        Espera `seconds` segundos o hasta que el trabajo se interrumpa.
+        """
+        await self.run_task(asyncio.sleep(seconds))
+
+    async def run_task(self, coro):
+        """
+        Ejecuta una corrutina que se cancela si el trabajo se interrumpe.
+
+        Args:
+            coro: Corrutina a ejecutar
+
+        Returns:
+            Resultado de la corrutina
+
+        Raises:
+            JobCancelled: Si el trabajo se interrumpe antes de que termine
+        """
+        loop = asyncio.get_running_loop()
+        task = asyncio.ensure_future(coro)
+        try:
+            with self.on_interrupt(lambda: loop.call_soon_threadsafe(task.cancel)):
+                return await task
+        except asyncio.CancelledError:
+            # Cancelada por la interrupción (si no, se propaga la cancelación)
+            self.check()
+            raise
+
+    def finish(self):
+        """
+        Termina el trabajo: desarma el temporizador de la etapa en curso.
+        """
+        self._cancel_timer()
+        self.stage = None
+
+    def cancel(self, reason='Backup cancelado'):
+        """
+        Cancela el trabajo.
+
+        Args:
+            reason: Motivo, que se registra como mensaje de error del backup
+        """
+        self.interrupt(JobCancelled(reason))
+
+    def interrupt(self, error):
+        """
+        Interrumpe el trabajo.
+
+        Args:
+            error: JobCancelled (o subclase) que lanzará la operación en curso
+        """
+        self._interrupt(error)
+
+    @contextmanager
+    def on_interrupt(self, callback):
+        """
+        Registra una función que desbloquea la operación en curso si el
+        trabajo se interrumpe mientras dura el bloque `with`.
+
+        Args:
+            callback: Función sin argumentos; se llama desde otro hilo
+        """
+        key = object()
+        with self._lock:
+            interrupted = self._error is not None
+            if not interrupted:
+                self._callbacks[key] = callback
+        if interrupted:
+            callback()
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._callbacks.pop(key, None)
+
+    def _interrupt(self, error):
+        with self._lock:
+            if self._error is not None:
+                return
+            self._error = error
+            callbacks = list(self._callbacks.values())
+
+        self.logger.warning(f'Interrupting job: {str(error)}')
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                self.logger.warning(f'Error interrupting job: {str(e)}')
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
@@ -0,0 +1,157 @@
+from models import db, Backup, Repository
+from sqlalchemy import func
+import statistics
+import threading
+import time
+
+# Duración supuesta de un backup sin historial ni tamaño conocido (segundos)
+DEFAULT_DURATION = 300
+
+# Backups completados de cada repositorio con los que se estima el siguiente
+HISTORY_SIZE = 5
+
+# Backups recientes con los que se aprende el coste por KB de los repositorios
+# sin historial, y segundos que se reutiliza lo aprendido
+RATE_SAMPLE = 200
+RATE_TTL = 600
+
+# Tasas por defecto: 10 MB/s y artefactos del tamaño que indica GitHub
+DEFAULT_RATES = {'seconds_per_kb': 1 / 10240, 'bytes_per_kb': 1024}
+
+# Repositorios por consulta (límite de parámetros de un IN)
+CHUNK_SIZE = 500
+
+class JobEstimator:
+    """
+    Estima la duración y los bytes a transferir del backup de un repositorio.
+
+    Con historial se usa la mediana de sus últimos `HISTORY_SIZE` backups
+    completados. Sin él se parte del tamaño que indica GitHub
+    (Repository.size) y de los segundos y bytes por KB aprendidos de los
+    backups recientes de todos los repositorios.
+    """
+
+    def __init__(self):
+        self._rates = None
+        self._rates_at = 0
+        self._lock = threading.Lock()
+
+    def estimate(self, repository):
+        """
+        Estima el backup de un repositorio.
+
+        Args:
+            repository: Objeto Repository
+
+        Returns:
+            Tupla (segundos, bytes o None si no se conoce)
+        """
+        return self.estimate_many([repository])[repository.id]
+
+    def estimate_many(self, repositories):
+        """
+        Estima los backups de varios repositorios con una consulta por lote.
+
+        Args:
+            repositories: Objetos Repository
+
+        Returns:
+            Diccionario {ID del repositorio: (segundos, bytes o None)}
+        """
+        repositories = list(repositories)
+        history = {}
+        for i in range(0, len(repositories), CHUNK_SIZE):
+            history.update(self._history([r.id for r in repositories[i:i + CHUNK_SIZE]]))
+
+        estimates = {}
+        for repository in repositories:
+            durations, sizes = history.get(repository.id, ([], []))
+            if durations:
+                estimates[repository.id] = (
+                    statistics.median(durations),
+                    int(statistics.median(sizes)) if sizes else None
+                )
+            elif repository.size:
+                rates = self.rates()
+                estimates[repository.id] = (
+                    repository.size * rates['seconds_per_kb'],
+                    int(repository.size * rates['bytes_per_kb'])
+                )
+            else:
+                estimates[repository.id] = (DEFAULT_DURATION, None)
+        return estimates
+
+    def rates(self):
+        """
+        Segundos y bytes de artefacto por KB de repositorio de los backups
+        recientes (se recalculan cada `RATE_TTL` segundos).
+
+        Returns:
+            Diccionario con seconds_per_kb y bytes_per_kb
+        """
+        with self._lock:
+            if self._rates is None or time.monotonic() - self._rates_at > RATE_TTL:
+                self._rates = self._learn_rates()
+                self._rates_at = time.monotonic()
+            return self._rates
+
+    def _history(self, repository_ids):
+        """
+        Duraciones y tamaños de los últimos backups completados de cada repositorio.
+
+        Args:
+            repository_ids: IDs de los repositorios
+
+        Returns:
+            Diccionario {ID del repositorio: (duraciones, tamaños)}
+        """
+        ranked = db.session.query(
+            Backup.repository_id,
+            Backup.started_at,
+            Backup.completed_at,
+            Backup.size,
+            func.row_number().over(
+                partition_by=Backup.repository_id,
+                order_by=(Backup.created_at.desc(), Backup.id.desc())
+            ).label('position')
+        ).filter(
+            Backup.repository_id.in_(repository_ids),
+            Backup.status == 'completed',
+            Backup.started_at.isnot(None),
+            Backup.completed_at.isnot(None)
+        ).subquery()
+
+        history = {}
+        for repo_id, started_at, completed_at, size, _ in db.session.query(ranked).filter(ranked.c.position <= HISTORY_SIZE):
+            durations, sizes = history.setdefault(repo_id, ([], []))
+            durations.append(max((completed_at - started_at).total_seconds(), 0))
+            if size:
+                sizes.append(size)
+        return history
+
+    def _learn_rates(self):
+        """
+        Calcula las tasas por KB a partir de los backups completados recientes.
+        """
+        rows = db.session.query(
+            Backup.started_at, Backup.completed_at, Backup.size, Repository.size
+        ).join(Repository, Backup.repository_id == Repository.id).filter(
+            Backup.status == 'completed',
+            Backup.started_at.isnot(None),
+            Backup.completed_at.isnot(None),
+            Repository.size > 0
+        ).order_by(Backup.id.desc()).limit(RATE_SAMPLE).all()
+
+        kilobytes = sum(repo_size for _, _, _, repo_size in rows)
+        if not kilobytes:
+            return dict(DEFAULT_RATES)
+
+        seconds = sum(max((completed - started).total_seconds(), 0) for started, completed, _, _ in rows)
+        sized = [(size, repo_size) for _, _, size, repo_size in rows if size]
+        return {
+            'seconds_per_kb': seconds / kilobytes,
+            'bytes_per_kb': (
+                sum(size for size, _ in sized) / sum(repo_size for _, repo_size in sized)
+                if sized else DEFAULT_RATES['bytes_per_kb']
+            )
+        }
@@ -0,0 +1,108 @@
+import logging
+import threading
+
+class MaintenanceService:
+    """
+    Tareas periódicas de mantenimiento del almacenamiento.
+
+    Un hilo en segundo plano ejecuta la conciliación de tamaños de los
+    backups con los listados de los backends cada `reconcile_interval`
+    segundos, descarta las subidas reanudables abandonadas y, si
+    `apply_retention` está activo, aplica después la política de retención.
+    """
+
+    def __init__(self, app, storage_service, config):
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+        self.storage_service = storage_service
+        self.config = config
+        self.reconcile_interval = config.get('reconcile_interval', 6 * 3600)
+        self.apply_retention = config.get('apply_retention', False)
+        self.upload_session_ttl = config.get('upload_session_ttl', 24 * 3600)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Arranca el hilo de mantenimiento.
+        """
+        if self._thread or not self.reconcile_interval:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop,
+            name='storage-maintenance',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Detiene el hilo de mantenimiento.
+
+        Args:
+            timeout: Segundos máximos de espera
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _loop(self):
+        """
+        Bucle de mantenimiento: espera el intervalo y ejecuta las tareas.
+        """
+        while not self._stop.wait(self.reconcile_interval):
+            self.reconcile()
+            self.cleanup_uploads()
+            if self.apply_retention:
+                self.retention()
+
+    def reconcile(self):
+        """
+        Concilia los tamaños registrados con los almacenamientos.
+
+        Returns:
+            Resultado de StorageService.reconcile_storage o None si falló
+        """
+        try:
+            with self.app.app_context():
+                results = self.storage_service.reconcile_storage()
+            self.logger.info(f'Storage reconciliation finished: {results}')
+            return results
+        except Exception as e:
+            self.logger.error(f'Error in storage reconciliation: {str(e)}')
+            return None
+
+    def cleanup_uploads(self):
+        """
+        Descarta las subidas reanudables abandonadas.
+
+        Returns:
+            Resultado de StorageService.cleanup_upload_sessions o None si falló
+        """
+        try:
+            with self.app.app_context():
+                results = self.storage_service.cleanup_upload_sessions(self.upload_session_ttl)
+            self.logger.info(f'Upload session cleanup finished: {results}')
+            return results
+        except Exception as e:
+            self.logger.error(f'Error cleaning up upload sessions: {str(e)}')
+            return None
+
+    def retention(self):
+        """
+        Aplica la política de retención configurada.
+
+        Returns:
+            Resultado de StorageService.apply_retention o None si falló
+        """
+        try:
+            with self.app.app_context():
+                results = self.storage_service.apply_retention()
+            self.logger.info(f'Retention finished: {results}')
+            return results
+        except Exception as e:
+            self.logger.error(f'Error applying retention: {str(e)}')
+            return None
@@ -0,0 +1,339 @@
+from contextlib import asynccontextmanager
+from git.exc import GitCommandError
+from repomirror.retry import RetryPolicy
+from repomirror.storage.scheduler import TransferSlots
+from services.git_runner import GitRunner
+from services.job_control import JobControl
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Sin flock (Windows) la caché no puede compartirse entre procesos
+    fcntl = None
+
+# Mensajes de git que indican un fallo de red o del servidor (se reintentan)
+GIT_TRANSIENT_ERRORS = re.compile(
+    r'could not resolve host|connection (timed out|reset|refused)|operation timed out|'
+    r'failed to connect|early eof|rpc failed|remote end hung up|unexpected disconnect|'
+    r'temporary failure|gnutls|ssl_read|returned error: (429|5\d\d)|internal server error|'
+    # Otro proceso que comparte la caché actualiza el mismo espejo
+    r'cannot lock ref|unable to create .*\.lock',
+    re.IGNORECASE
+)
+
+def classify_git_error(error):
+    """
+    Clasifica los errores de los comandos git (ver repomirror.retry.is_transient).
+
+    Args:
+        error: Excepción a clasificar
+
+    Returns:
+        True si es un fallo de red pasajero, False si es otro error de git
+        (credenciales, repositorio inexistente...) o None si no es de git
+    """
+    if not isinstance(error, GitCommandError):
+        return None
+    return bool(GIT_TRANSIENT_ERRORS.search(f'{error.stderr} {error.stdout}'))
+
+class MirrorCache:
+    """
+    Caché local de espejos bare de repositorios.
+
+    Cada repositorio se clona una sola vez con `git clone --mirror` y en los
+    backups siguientes solo se actualiza con `git fetch --prune`. El tamaño
+    total de la caché está limitado y se liberan primero los espejos usados
+    hace más tiempo (LRU). Los fallos de red al clonar o actualizar un
+    espejo se reintentan según `retry_policy`.
+
+    Varios procesos de la misma máquina pueden compartir la caché: cada
+    espejo tiene un archivo de lock (`<clave>.lock`, flock) que se toma en
+    exclusiva para clonarlo o actualizarlo y compartido mientras se usa, y
+    un espejo solo se desaloja si se consigue en exclusiva sin esperar. Los
+    locks de flock no son fiables en sistemas de archivos de red: cada
+    máquina debe usar su propio directorio de caché.
+    """
+
+    def __init__(self, config, retry_policy=None, git=None):
+        self.logger = logging.getLogger(__name__)
+        self.config = config
+        self.cache_dir = config.get('path') or os.path.join(tempfile.gettempdir(), 'repomirror-mirrors')
+        self.max_size = int(config.get('max_size_mb', 10240)) * 1024 * 1024
+        self.retry_policy = retry_policy or RetryPolicy(0)
+        self.git = git or GitRunner()
+        self._lock = threading.Lock()
+        self._repo_locks = {}
+        self._in_use = {}
+        self._sizes = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        """
+        Calcula el tamaño de los espejos que ya existen en disco y elimina
+        los restos de clones y desalojos interrumpidos.
+        """
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.git'):
+                self._sizes[name[:-4]] = self._dir_size(path)
+            elif '.tmp-' in name:
+                # Si otro proceso tiene el lock del espejo puede estar clonándolo
+                fd = self._open_lock(name.split('.tmp-', 1)[0])
+                try:
+                    if self._try_lock(fd):
+                        shutil.rmtree(path, ignore_errors=True)
+                finally:
+                    os.close(fd)
+
+    def _open_lock(self, key):
+        """
+        Abre el archivo de lock entre procesos de un espejo.
+
+        Cada apertura es un lock independiente, también dentro del mismo
+        proceso. Los archivos de lock no se borran nunca: borrar uno
+        mientras otro proceso espera en él rompería la exclusión.
+
+        Args:
+            key: Clave de caché
+
+        Returns:
+            Descriptor del archivo (cerrarlo libera el lock)
+        """
+        return os.open(os.path.join(self.cache_dir, f'{key}.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+
+    @staticmethod
+    def _try_lock(fd, mode=None):
+        """
+        Intenta tomar un lock sin esperar.
+
+        Args:
+            fd: Descriptor del archivo de lock
+            mode: fcntl.LOCK_EX (por defecto) o fcntl.LOCK_SH
+
+        Returns:
+            True si se tomó
+        """
+        if fcntl is None:
+            return True
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_EX if mode is None else mode) | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    async def _lock(self, fd, mode=None):
+        """
+        Espera a tomar un lock sin bloquear el bucle de eventos (se puede
+        cancelar).
+
+        Args:
+            fd: Descriptor del archivo de lock
+            mode: fcntl.LOCK_EX (por defecto) o fcntl.LOCK_SH
+        """
+        while not self._try_lock(fd, mode):
+            await asyncio.sleep(0.2)
+
+    def _key(self, repo_url):
+        """
+        Obtiene la clave de caché de un repositorio.
+
+        Args:
+            repo_url: URL del repositorio
+        """
+        return hashlib.sha256(repo_url.rstrip('/').encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.git')
+
+    @asynccontextmanager
+    async def checkout(self, repo_url, auth_url=None, control=None):
+        """
+        Sincroniza el espejo de un repositorio y lo reserva mientras se usa.
+
+        Un espejo reservado no se desaloja de la caché. Los backups del
+        mismo repositorio, en este o en otros procesos, lo sincronizan de
+        uno en uno, y mientras lo usan ningún proceso lo actualiza.
+
+        Args:
+            repo_url: URL del repositorio (clave de la caché)
+            auth_url: URL con credenciales para clonar/actualizar
+            control: JobControl del backup (mata git si se interrumpe)
+
+        Yields:
+            Ruta del espejo bare
+        """
+        key = self._key(repo_url)
+        control = control or JobControl()
+        with self._lock:
+            repo_lock = self._repo_locks.setdefault(key, TransferSlots(1))
+            self._in_use[key] = self._in_use.get(key, 0) + 1
+
+        fd = self._open_lock(key)
+        try:
+            # La espera y los reintentos se cortan si se interrumpe el backup
+            await control.run_task(repo_lock.acquire())
+            try:
+                await control.run_task(self._lock(fd))
+                path = await control.run_task(self._sync(key, auth_url or repo_url, control))
+                if fcntl is not None:
+                    # Para usarlo basta compartido (pasar de exclusivo a compartido no espera)
+                    fcntl.flock(fd, fcntl.LOCK_SH)
+            finally:
+                repo_lock.release()
+            yield path
+        finally:
+            os.close(fd)
+            with self._lock:
+                self._in_use[key] -= 1
+                if not self._in_use[key]:
+                    del self._in_use[key]
+            self._evict()
+
+    async def _sync(self, key, url, control=None):
+        """
+        Crea o actualiza el espejo de un repositorio.
+
+        Args:
+            key: Clave de caché
+            url: URL del repositorio
+            control: JobControl del backup en curso
+        """
+        path = self._path(key)
+
+        if os.path.isdir(path):
+            await self.retry_policy.run(
+                lambda: self.git.run(
+                    ['fetch', '--prune', '--progress', url, '+refs/*:refs/*'],
+                    cwd=path,
+                    control=control,
+                    on_progress=self._log_progress(key)
+                ),
+                f'Fetch of mirror {key[:12]}',
+                classify=classify_git_error
+            )
+        else:
+            await self.retry_policy.run(
+                lambda: self._clone(path, url, control),
+                f'Clone of mirror {key[:12]}',
+                classify=classify_git_error
+            )
+
+        os.utime(path)
+        # Recorrer un espejo grande lleva su tiempo: no bloquear el bucle de eventos
+        size = await asyncio.get_running_loop().run_in_executor(None, self._dir_size, path)
+        with self._lock:
+            self._sizes[key] = size
+        return path
+
+    async def _clone(self, path, url, control=None):
+        """
+        Clona el espejo de un repositorio.
+
+        Args:
+            path: Ruta del espejo
+            url: URL del repositorio
+            control: JobControl del backup en curso
+        """
+        # Clonar en un directorio temporal para no dejar espejos a medias
+        tmp_path = f'{path[:-4]}.tmp-{os.getpid()}-{threading.get_ident()}'
+        try:
+            await self.git.run(
+                ['clone', '--mirror', '--progress', url, tmp_path],
+                control=control,
+                on_progress=self._log_progress(os.path.basename(path)[:-4])
+            )
+            # No guardar credenciales en la configuración del espejo
+            await self.git.run(['remote', 'remove', 'origin'], cwd=tmp_path)
+            os.rename(tmp_path, path)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            if not os.path.isdir(path):
+                raise
+            # Otro proceso que comparte la caché clonó el mismo espejo a la vez
+        except Exception:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    def _log_progress(self, key):
+        """
+        Crea una función que registra el final de cada fase de git.
+
+        Args:
+            key: Clave de caché del espejo
+        """
+        def log(progress):
+            if progress['percent'] == 100:
+                self.logger.debug(
+                    f'Mirror {key[:12]}: {progress["phase"]} done ({progress["total"]})'
+                )
+        return log
+
+    def _evict(self):
+        """
+        Elimina los espejos usados hace más tiempo hasta respetar el tamaño máximo.
+        """
+        evicted = []
+        with self._lock:
+            total = sum(self._sizes.values())
+            if total <= self.max_size:
+                return
+
+            candidates = sorted(
+                (key for key in self._sizes if key not in self._in_use),
+                key=lambda key: self._last_used(key)
+            )
+            for key in candidates:
+                if total <= self.max_size:
+                    break
+                fd = self._open_lock(key)
+                try:
+                    if not self._try_lock(fd):
+                        # Otro proceso lo está usando o actualizando
+                        continue
+                    total -= self._sizes.pop(key)
+                    # Se aparta con los locks tomados para que nadie reserve el espejo
+                    # a medias; borrarlo puede llevar un rato y se hace sin ellos
+                    path = f'{self._path(key)[:-4]}.tmp-evicted-{os.getpid()}-{threading.get_ident()}'
+                    try:
+                        os.rename(self._path(key), path)
+                    except OSError:
+                        continue
+                    evicted.append((key, path))
+                finally:
+                    os.close(fd)
+
+        for key, path in evicted:
+            self.logger.info(f'Evicting mirror {key} from cache')
+            shutil.rmtree(path, ignore_errors=True)
+
+    def _last_used(self, key):
+        try:
+            return os.path.getmtime(self._path(key))
+        except OSError:
+            return 0
+
+    def _dir_size(self, path):
+        """
+        Calcula el tamaño en bytes de un directorio.
+
+        Args:
+            path: Ruta del directorio
+        """
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
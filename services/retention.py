@@ -0,0 +1,225 @@
+from models import db, Backup, BackupDestination, Repository
+from services.backup_queue import ACTIVE_STATUSES, FAILED_STATUSES, SUCCESSFUL_STATUSES
+from sqlalchemy import and_, case, func, literal, or_, union
+from sqlalchemy.orm import aliased
+from datetime import datetime, timedelta
+
+# Niveles de la política GFS: nombre -> unidad del periodo (date_trunc de
+# PostgreSQL). Las semanas empiezan el lunes.
+GFS_LEVELS = {
+    'hourly': 'hour',
+    'daily': 'day',
+    'weekly': 'week',
+    'monthly': 'month'
+}
+
+# Inicio del periodo en SQLite, que guarda las fechas como texto ISO: un
+# prefijo de la fecha, que ordena antes que cualquier fecha del periodo
+ISO_PREFIXES = {'hour': 13, 'day': 10, 'month': 7}
+
+DEFAULT_POLICY = {'hourly': 24, 'daily': 14, 'weekly': 8, 'monthly': 12, 'errors_days': 7}
+
+class RetentionPlanner:
+    """
+    Calcula qué backups se eliminan según una política de retención.
+
+    Todo el cálculo se hace en la base de datos con consultas por conjuntos
+    (consultas recursivas por repositorio sobre el índice
+    ix_backups_retention), sin recorrer los backups en Python. Un backup que la política permite eliminar se conserva
+    igualmente si un backup conservado necesita su artefacto (backups
+    'unchanged' y cadenas de bundles) o si aún se está procesando.
+    """
+
+    def gfs(self, policy=None):
+        """
+        Condición de los backups eliminables según una política
+        abuelo-padre-hijo.
+
+        De cada repositorio se conserva el backup correcto más reciente de
+        cada uno de los últimos N periodos de cada nivel (N horas, N días...).
+        Los backups con error o cancelados se eliminan tras `errors_days` días.
+
+        Args:
+            policy: Diccionario con hourly, daily, weekly, monthly y errors_days
+
+        Returns:
+            Función que recibe el modelo (o un alias) y devuelve la condición SQL
+        """
+        policy = {**DEFAULT_POLICY, **(policy or {})}
+        keep_ids = self._gfs_keep_ids(policy)
+        errors_cutoff = datetime.utcnow() - timedelta(days=policy['errors_days'])
+
+        def expired(model):
+            return or_(
+                and_(model.status.in_(SUCCESSFUL_STATUSES), model.id.notin_(keep_ids)),
+                and_(model.status.in_(FAILED_STATUSES), model.created_at < errors_cutoff)
+            )
+
+        return expired
+
+    def older_than(self, days):
+        """
+        Condición de los backups eliminables por antigüedad.
+
+        Args:
+            days: Número de días después de los cuales eliminar backups
+        """
+        cutoff_date = datetime.utcnow() - timedelta(days=days)
+        return lambda model: model.created_at < cutoff_date
+
+    def _gfs_keep_ids(self, policy):
+        """
+        Construye la consulta con los IDs que conserva la política GFS.
+
+        Cada nivel recorre los backups correctos de cada repositorio del más
+        reciente al más antiguo saltando de periodo en periodo (consulta
+        recursiva): el siguiente backup conservado es el más reciente anterior
+        al inicio del periodo del actual, y se para tras N periodos. Cada
+        salto es una búsqueda en el índice ix_backups_retention, de modo que
+        el coste depende de los repositorios y de N, no del número de backups.
+
+        Args:
+            policy: Política completa (con todos los niveles)
+        """
+        levels = {level: int(policy.get(level) or 0) for level in GFS_LEVELS}
+        levels = {level: count for level, count in levels.items() if count > 0}
+        if not levels:
+            return db.select(Backup.id).where(literal(False))
+
+        def latest(repository_id, before=None):
+            # Backup correcto más reciente de un repositorio (anterior a `before`)
+            newer = aliased(Backup)
+            query = db.select(newer.id).where(
+                newer.repository_id == repository_id,
+                newer.status.in_(SUCCESSFUL_STATUSES)
+            )
+            if before is not None:
+                query = query.where(newer.created_at < before)
+            return query.order_by(newer.created_at.desc(), newer.id.desc()).limit(1).scalar_subquery()
+
+        walks = []
+        for level, count in levels.items():
+            walk = db.select(
+                Repository.id.label('repository_id'), Backup.id, Backup.created_at, literal(1).label('depth')
+            ).join(Backup, Backup.id == latest(Repository.id)).cte(f'retention_{level}', recursive=True)
+
+            previous = aliased(Backup)
+            walk = walk.union_all(
+                db.select(
+                    walk.c.repository_id, previous.id, previous.created_at, walk.c.depth + 1
+                ).join(
+                    previous, previous.id == latest(walk.c.repository_id, self._period_start(walk.c.created_at, level))
+                ).where(walk.c.depth < count)
+            )
+            walks.append(db.select(walk.c.id))
+
+        # CTE: se evalúa una sola vez aunque la consulta la use varias veces
+        keep = union(*walks).cte('retention_keep')
+        return db.select(keep.c.id)
+
+    def _period_start(self, column, level):
+        """
+        Expresión SQL con el inicio del periodo de una fecha según el motor
+        de base de datos.
+
+        Args:
+            column: Columna de fecha
+            level: Nivel de la política (ver GFS_LEVELS)
+        """
+        unit = GFS_LEVELS[level]
+        if db.engine.dialect.name == 'postgresql':
+            return func.date_trunc(unit, column)
+        if unit in ISO_PREFIXES:
+            # SQLite guarda las fechas como texto ISO: el inicio del periodo
+            # es un prefijo y substr es mucho más barato que strftime
+            return func.substr(column, 1, ISO_PREFIXES[unit])
+        # Lunes de la semana
+        return func.date(column, '-6 days', 'weekday 1')
+
+    def deletable(self, expired):
+        """
+        Consulta de los IDs de los backups que se pueden eliminar.
+
+        La condición de la política se evalúa una sola vez por backup (CTE
+        retention_candidates) y se reutiliza para los backups eliminables y
+        para las cadenas de artefactos que necesitan los conservados.
+
+        Args:
+            expired: Condición (ver gfs y older_than) de los backups que la
+                política permite eliminar
+        """
+        removable = and_(expired(Backup), Backup.status.notin_(('pending',) + ACTIVE_STATUSES))
+        candidates = db.session.query(
+            Backup.id,
+            func.coalesce(Backup.chain_base_id, Backup.id).label('chain_id'),
+            func.coalesce(Backup.artifact_backup_id, Backup.id).label('artifact_id'),
+            case((removable, 1), else_=0).label('removable')
+        ).cte('retention_candidates')
+
+        # Cadenas de artefactos (bundle completo, o artefacto compartido) que
+        # aún necesita algún backup conservado
+        artifact = aliased(Backup)
+        kept_chains = db.session.query(
+            func.coalesce(artifact.chain_base_id, artifact.id)
+        ).select_from(candidates).join(
+            artifact, artifact.id == candidates.c.artifact_id
+        ).filter(candidates.c.removable == 0)
+
+        return db.session.query(candidates.c.id).filter(
+            candidates.c.removable == 1,
+            candidates.c.chain_id.notin_(kept_chains)
+        )
+
+    def plan(self, expired):
+        """
+        Calcula los IDs de los backups a eliminar, del más reciente al más
+        antiguo (los que referencian a otros backups van antes).
+
+        Args:
+            expired: Condición de los backups que la política permite eliminar
+        """
+        query = self.deletable(expired).subquery()
+        return [backup_id for backup_id, in db.session.query(query.c.id).order_by(query.c.id.desc())]
+
+    def report(self, expired):
+        """
+        Informe de una ejecución en seco: backups conservados y eliminados y
+        bytes liberados por repositorio.
+
+        Args:
+            expired: Condición de los backups que la política permite eliminar
+        """
+        # Se calcula una sola vez y se une a los backups (no un IN por columna)
+        deletable = self.deletable(expired).subquery()
+        is_deleted = deletable.c.id.isnot(None)
+        owns_artifact = Backup.artifact_backup_id.is_(None)
+        # Tamaño de todas las copias de cada artefacto
+        copies = db.session.query(
+            BackupDestination.backup_id,
+            func.sum(BackupDestination.size).label('size')
+        ).filter(BackupDestination.status == 'completed').group_by(BackupDestination.backup_id).subquery()
+
+        rows = db.session.query(
+            Backup.repository_id,
+            Repository.url,
+            func.sum(case((is_deleted, 0), else_=1)),
+            func.sum(case((is_deleted, 1), else_=0)),
+            func.coalesce(func.sum(case((and_(is_deleted, owns_artifact), copies.c.size), else_=0)), 0)
+        ).join(Repository, Backup.repository_id == Repository.id).outerjoin(
+            deletable, deletable.c.id == Backup.id
+        ).outerjoin(
+            copies, copies.c.backup_id == Backup.id
+        ).group_by(
+            Backup.repository_id, Repository.url
+        ).all()
+
+        repositories = [
+            {'repository_id': repository_id, 'url': url, 'keep': keep, 'delete': delete, 'bytes_freed': freed}
+            for repository_id, url, keep, delete, freed in rows
+        ]
+        return {
+            'repositories': repositories,
+            'keep': sum(r['keep'] for r in repositories),
+            'delete': sum(r['delete'] for r in repositories),
+            'bytes_freed': sum(r['bytes_freed'] for r in repositories)
+        }
@@ -0,0 +1,191 @@
+from datetime import timedelta
+import hashlib
+
+# Programaciones con nombre y su expresión cron equivalente
+SCHEDULE_ALIASES = {
+    'hourly': '0 * * * *',
+    'daily': '0 0 * * *',
+    'weekly': '0 0 * * 0',
+    'monthly': '0 0 1 * *'
+}
+
+# Programaciones que no generan backups automáticos
+MANUAL_SCHEDULES = ('', 'manual')
+
+MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+DAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+class CronSchedule:
+    """
+    Expresión cron de cinco campos: minuto, hora, día del mes, mes y día de
+    la semana (0-7, 0 y 7 son domingo), en UTC.
+
+    Cada campo admite `*`, valores, rangos (`1-5`), pasos (`*/15`, `8-18/2`)
+    y listas separadas por comas; los meses y los días de la semana también
+    por su nombre en inglés (`jan`, `mon`). Si se restringen a la vez el día
+    del mes y el de la semana basta con que coincida uno de ellos, como en
+    cron.
+    """
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'La expresión cron "{expression}" debe tener 5 campos')
+
+        self.expression = expression
+        self.minutes = self._parse_field(fields[0], 0, 59)
+        self.hours = self._parse_field(fields[1], 0, 23)
+        self.days = self._parse_field(fields[2], 1, 31)
+        self.months = self._parse_field(fields[3], 1, 12, MONTH_NAMES, 1)
+        weekdays = self._parse_field(fields[4], 0, 7, DAY_NAMES, 0)
+        # Días de la semana de cron (domingo = 0) a los de Python (lunes = 0)
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def next_after(self, after):
+        """
+        Calcula la primera ejecución posterior a una fecha.
+
+        Args:
+            after: Fecha de referencia
+
+        Returns:
+            Fecha de la siguiente ejecución (minuto exacto)
+        """
+        current = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = current + timedelta(days=366 * 5)
+
+        while current < limit:
+            if current.month not in self.months:
+                year, month = divmod(current.month, 12)
+                current = current.replace(year=current.year + year, month=month + 1, day=1, hour=0, minute=0)
+            elif not self._matches_day(current):
+                current = current.replace(hour=0, minute=0) + timedelta(days=1)
+            elif current.hour not in self.hours:
+                current = current.replace(minute=0) + timedelta(hours=1)
+            elif current.minute not in self.minutes:
+                current += timedelta(minutes=1)
+            else:
+                return current
+
+        # Solo fechas imposibles, p. ej. el 30 de febrero
+        raise ValueError(f'La expresión cron "{self.expression}" no tiene ejecuciones')
+
+    def _matches_day(self, date):
+        """
+        Comprueba si el día de una fecha cumple los campos de día del mes y
+        de la semana.
+
+        Args:
+            date: Fecha a comprobar
+        """
+        day = date.day in self.days
+        weekday = date.weekday() in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    @staticmethod
+    def _parse_field(field, minimum, maximum, names=None, names_offset=0):
+        """
+        Convierte un campo de la expresión en el conjunto de valores que admite.
+
+        Args:
+            field: Texto del campo
+            minimum: Valor mínimo del campo
+            maximum: Valor máximo del campo
+            names: Nombres de los valores (meses o días de la semana)
+            names_offset: Valor del primer nombre
+        """
+        def value(text):
+            text = text.lower()
+            if names and text in names:
+                return names.index(text) + names_offset
+            if not text.isdigit():
+                raise ValueError(f'Valor "{text}" no válido en el campo cron "{field}"')
+            return int(text)
+
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            step = int(step) if step.isdigit() else (None if step else 1)
+            if not step:
+                raise ValueError(f'Paso no válido en el campo cron "{field}"')
+
+            if part == '*':
+                start, end = minimum, maximum
+            elif '-' in part:
+                start, end = (value(bound) for bound in part.split('-', 1))
+            else:
+                start = value(part)
+                # `5/10` equivale a `5-max/10`
+                end = maximum if step > 1 else start
+
+            if start < minimum or end > maximum or start > end:
+                raise ValueError(f'Rango fuera de límites en el campo cron "{field}"')
+            values.update(range(start, end + 1, step))
+
+        return values
+
+def parse_schedule(schedule):
+    """
+    Interpreta la programación de un repositorio.
+
+    Args:
+        schedule: 'manual', un alias ('hourly', 'daily', 'weekly', 'monthly',
+            también con el prefijo '@') o una expresión cron
+
+    Returns:
+        CronSchedule o None si el repositorio no se programa
+
+    Raises:
+        ValueError: Si la programación no es válida
+    """
+    schedule = (schedule or '').strip().lower()
+    if schedule in MANUAL_SCHEDULES:
+        return None
+    return CronSchedule(SCHEDULE_ALIASES.get(schedule.lstrip('@'), schedule))
+
+def schedule_offset(key, jitter):
+    """
+    Desplazamiento fijo de las ejecuciones de un repositorio.
+
+    Se deriva del hash de `key`, de modo que es siempre el mismo para cada
+    repositorio (sus backups se siguen haciendo a intervalos regulares) y
+    los repositorios con la misma programación se reparten uniformemente
+    por la ventana en lugar de empezar todos a la vez.
+
+    Args:
+        key: Identificador estable del repositorio
+        jitter: Segundos de la ventana de reparto
+
+    Returns:
+        Segundos de desplazamiento, entre 0 y `jitter`
+    """
+    if not jitter:
+        return 0
+    digest = hashlib.sha256(str(key).encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % int(jitter)
+
+def next_run(schedule, after, key, jitter=0):
+    """
+    Calcula la siguiente ejecución programada de un repositorio.
+
+    Las ejecuciones son las de la expresión cron desplazadas
+    `schedule_offset(key, jitter)` segundos.
+
+    Args:
+        schedule: Programación del repositorio (ver parse_schedule)
+        after: Fecha de referencia
+        key: Identificador estable del repositorio
+        jitter: Segundos de la ventana de reparto
+
+    Returns:
+        Fecha de la siguiente ejecución o None si el repositorio no se programa
+    """
+    cron = parse_schedule(schedule)
+    if cron is None:
+        return None
+    offset = timedelta(seconds=schedule_offset(key, jitter))
+    return cron.next_after(after - offset) + offset
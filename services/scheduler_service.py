@@ -0,0 +1,246 @@
+from models import db, Backup, Repository
+from services.backup_queue import (
+    ACTIVE_STATUSES, FAILED_STATUSES, PRIORITY_FAILED, PRIORITY_RECENT_PUSH, PRIORITY_SCHEDULED,
+    SUCCESSFUL_STATUSES
+)
+from services.schedule import MANUAL_SCHEDULES, next_run
+from datetime import datetime, timedelta
+from sqlalchemy import func
+import logging
+import threading
+
+class SchedulerService:
+    """
+    Encola los backups programados de los repositorios (Repository.schedule).
+
+    Cada repositorio guarda la fecha de su siguiente backup en `next_run_at`,
+    indexada: en cada vuelta el hilo del programador solo lee los
+    repositorios vencidos, en lotes de `batch_size`, sin recorrer la tabla.
+    Las ejecuciones de cada repositorio se desplazan un tiempo fijo dentro de
+    una ventana de `jitter` segundos (ver schedule_offset), de modo que los
+    repositorios con la misma programación no empiezan todos a la vez.
+
+    Los backups programados entran en la cola por detrás de los manuales;
+    entre ellos van primero los de repositorios cuyo último backup falló y
+    después los de repositorios con pushes en las últimas
+    `recent_push_hours` horas. Si un repositorio ya tiene un backup pendiente
+    o en curso no se encola otro. Tras una parada no se recuperan las
+    ejecuciones perdidas: cada repositorio vencido hace un único backup.
+
+    Varios procesos pueden ejecutar el programador a la vez: cada
+    repositorio se adelanta con un UPDATE condicionado a su `next_run_at`,
+    así que solo uno de ellos encola cada ejecución.
+    """
+
+    def __init__(self, app, backup_queue, config):
+        self.logger = logging.getLogger(__name__)
+        self.app = app
+        self.backup_queue = backup_queue
+        self.config = config
+        self.interval = config.get('interval', 60)
+        self.jitter = config.get('jitter', 1800)
+        self.batch_size = config.get('batch_size', 500)
+        self.recent_push_hours = config.get('recent_push_hours', 24)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Arranca el hilo del programador.
+        """
+        if self._thread or not self.interval:
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop,
+            name='backup-scheduler',
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Detiene el hilo del programador.
+
+        Args:
+            timeout: Segundos máximos de espera
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def schedule(self, repository, after=None):
+        """
+        Calcula la siguiente ejecución de un repositorio (sin guardarla).
+
+        Args:
+            repository: Objeto Repository (con ID)
+            after: Fecha de referencia (por defecto, ahora)
+
+        Raises:
+            ValueError: Si la programación no es válida
+        """
+        repository.next_run_at = next_run(
+            repository.schedule,
+            after or datetime.utcnow(),
+            repository.id,
+            self.jitter
+        )
+
+    def _loop(self):
+        """
+        Bucle del programador: encola los backups vencidos en cada intervalo.
+        """
+        try:
+            with self.app.app_context():
+                self.initialize()
+        except Exception as e:
+            self.logger.error(f'Error initializing backup schedules: {str(e)}')
+
+        while True:
+            self.tick()
+            if self._stop.wait(self.interval):
+                return
+
+    def initialize(self):
+        """
+        Calcula `next_run_at` de los repositorios programados que no lo
+        tienen (p. ej. creados antes de existir el programador).
+
+        Returns:
+            Número de repositorios programados
+        """
+        scheduled = 0
+        last_id = 0
+        while True:
+            repositories = Repository.query.filter(
+                Repository.id > last_id,
+                Repository.next_run_at.is_(None),
+                Repository.schedule.isnot(None),
+                Repository.schedule.notin_(MANUAL_SCHEDULES)
+            ).order_by(Repository.id).limit(self.batch_size).all()
+            if not repositories:
+                return scheduled
+
+            for repository in repositories:
+                try:
+                    self.schedule(repository)
+                    scheduled += repository.next_run_at is not None
+                except ValueError as e:
+                    self.logger.warning(f'Invalid schedule for repository {repository.id}: {str(e)}')
+            last_id = repositories[-1].id
+            db.session.commit()
+
+    def tick(self):
+        """
+        Encola los backups de los repositorios vencidos.
+
+        Returns:
+            Número de backups encolados o None si falló
+        """
+        try:
+            with self.app.app_context():
+                enqueued = 0
+                while True:
+                    count, full = self._enqueue_due(datetime.utcnow())
+                    enqueued += count
+                    if not full:
+                        break
+            if enqueued:
+                self.logger.info(f'Scheduler enqueued {enqueued} backups')
+            return enqueued
+        except Exception as e:
+            self.logger.error(f'Error in backup scheduler: {str(e)}')
+            return None
+
+    def _enqueue_due(self, now):
+        """
+        Procesa un lote de repositorios vencidos.
+
+        Args:
+            now: Fecha actual
+
+        Returns:
+            Tupla (backups encolados, si el lote estaba completo)
+        """
+        due = Repository.query.filter(
+            Repository.next_run_at <= now
+        ).order_by(Repository.next_run_at).limit(self.batch_size).all()
+        if not due:
+            return 0, False
+
+        ids = [repository.id for repository in due]
+        busy = self._busy(ids)
+        failed = self._last_failed(ids)
+        recent_push = now - timedelta(hours=self.recent_push_hours)
+
+        # Los objetos caducan con cada commit: se copian los campos antes
+        pending = [
+            (repository, repository.id, repository.next_run_at, repository.status, repository.pushed_at,
+             repository.schedule)
+            for repository in due
+        ]
+
+        enqueued = 0
+        for repository, repo_id, scheduled_for, status, pushed_at, schedule in pending:
+            try:
+                following = next_run(schedule, now, repo_id, self.jitter)
+            except ValueError as e:
+                self.logger.warning(f'Invalid schedule for repository {repo_id}: {str(e)}')
+                following = None
+
+            advanced = Repository.query.filter_by(id=repo_id, next_run_at=scheduled_for).update(
+                {'next_run_at': following},
+                synchronize_session=False
+            )
+            if not advanced or status != 'active' or repo_id in busy:
+                # Otro programador ya tomó esta ejecución, o no procede
+                db.session.commit()
+                continue
+
+            if repo_id in failed:
+                priority = PRIORITY_FAILED
+            elif pushed_at and pushed_at >= recent_push:
+                priority = PRIORITY_RECENT_PUSH
+            else:
+                priority = PRIORITY_SCHEDULED
+            # El encolado confirma también el avance de next_run_at
+            self.backup_queue.enqueue(repository, priority)
+            enqueued += 1
+
+        return enqueued, len(due) == self.batch_size
+
+    def _busy(self, repository_ids):
+        """
+        Repositorios con un backup pendiente o en curso.
+
+        Args:
+            repository_ids: IDs de los repositorios
+        """
+        rows = db.session.query(Backup.repository_id).filter(
+            Backup.repository_id.in_(repository_ids),
+            Backup.status.in_(('pending',) + ACTIVE_STATUSES)
+        ).distinct()
+        return {repo_id for repo_id, in rows}
+
+    def _last_failed(self, repository_ids):
+        """
+        Repositorios cuyo último backup terminado falló.
+
+        Args:
+            repository_ids: IDs de los repositorios
+        """
+        latest = db.session.query(
+            Backup.repository_id,
+            func.max(Backup.id).label('backup_id')
+        ).filter(
+            Backup.repository_id.in_(repository_ids),
+            Backup.status.in_(SUCCESSFUL_STATUSES + FAILED_STATUSES)
+        ).group_by(Backup.repository_id).subquery()
+
+        rows = db.session.query(Backup.repository_id).join(
+            latest, Backup.id == latest.c.backup_id
+        ).filter(Backup.status == 'error')
+        return {repo_id for repo_id, in rows}
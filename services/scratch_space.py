@@ -0,0 +1,226 @@
+from models import db, Backup, Repository
+from datetime import datetime
+from sqlalchemy import func, literal
+import asyncio
+import logging
+import os
+import shutil
+import statistics
+import threading
+import time
+
+# Margen sobre el pico medido del backup anterior de un repositorio
+PEAK_MARGIN = 1.2
+
+# Backups recientes con los que se aprende el factor de expansión, y
+# segundos que se reutiliza lo aprendido
+FACTOR_SAMPLE = 100
+FACTOR_TTL = 600
+
+class ScratchSpace:
+    """
+    Control de admisión por espacio en el disco de trabajo de los backups
+    (clones, bundles y artefactos comprimidos).
+
+    Cada backup reserva el espacio que se espera que ocupe: el pico que
+    midió su backup anterior o, sin él, el tamaño que indica GitHub por un
+    factor de expansión aprendido de los picos de los backups recientes. Un
+    worker solo reclama un backup si su reserva cabe en el espacio libre,
+    descontando lo que aún pueden crecer los backups en curso en la máquina
+    y dejando libres al menos `min_free_mb`; si no cabe ninguno espera a que
+    terminen los que están en curso. Un backup se admite siempre si no hay
+    otro en curso en la máquina, para que uno que no quepa nunca no bloquee
+    la cola.
+
+    Los backups de otros procesos de la misma máquina se conocen por su
+    lease (`Backup.lease_owner` empieza por `host`) y cuentan con toda su
+    reserva (`Backup.scratch_reserved`): lo que ya ocupan no se sabe fuera
+    de su proceso, así que la cuenta es conservadora.
+
+    Mientras se procesa un backup se mide periódicamente lo que ocupan sus
+    archivos, y el pico se guarda en el backup y en su repositorio para
+    afinar las reservas siguientes. Los objetos enlazados desde la caché de
+    espejos (hardlinks de `git clone --local`) no cuentan: ya ocupan espacio
+    en la caché, que tiene su propio límite.
+    """
+
+    def __init__(self, path, config, host=''):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.host = host
+        self.config = config
+        self.min_free = config.get('min_free_mb', 1024) * 1024 * 1024
+        self.default_reservation = config.get('default_reservation_mb', 512) * 1024 * 1024
+        self.default_factor = config.get('expansion_factor', 3.0)
+        self.sample_interval = config.get('sample_interval', 5)
+        # Reservas de los backups en curso en este proceso: ID -> [reservado, usado, pico]
+        self._reservations = {}
+        self._lock = threading.Lock()
+        self._factor = None
+        self._factor_at = 0
+
+    def admission(self):
+        """
+        Cerrojo que debe rodear el cálculo del espacio disponible y el
+        registro de la reserva, para que dos workers del proceso no admitan
+        a la vez backups que juntos no caben.
+        """
+        return self._lock
+
+    @property
+    def busy(self):
+        """
+        True si hay backups en curso en la máquina.
+        """
+        return bool(self._reservations) or bool(self._host_reservations())
+
+    def available(self):
+        """
+        Espacio disponible para reservas nuevas, en bytes.
+        """
+        free = shutil.disk_usage(self.path).free
+        outstanding = sum(max(reserved - used, 0) for reserved, used, _ in self._reservations.values())
+        outstanding += sum(self._host_reservations())
+        return free - outstanding - self.min_free
+
+    def _host_reservations(self):
+        """
+        Reservas de los backups en curso en otros procesos de la máquina.
+        """
+        # Los backups en curso tienen lease; la de un proceso muerto caduca
+        query = db.session.query(Backup.scratch_reserved).filter(
+            Backup.lease_owner.startswith(self.host, autoescape=True),
+            Backup.lease_expires_at >= datetime.utcnow()
+        )
+        if self._reservations:
+            query = query.filter(Backup.id.notin_(list(self._reservations)))
+        return [reserved or 0 for reserved, in query]
+
+    def fits(self, available):
+        """
+        Condición de los backups cuya reserva cabe en el espacio disponible.
+
+        Args:
+            available: Bytes disponibles (ver available)
+        """
+        factor = self.expansion_factor()
+        reservation = func.coalesce(
+            Repository.scratch_peak * PEAK_MARGIN,
+            Repository.size * (1024 * factor),
+            literal(self.default_reservation)
+        )
+        return Backup.repository.has(reservation <= available)
+
+    def reservation(self, repository):
+        """
+        Espacio a reservar para el backup de un repositorio, en bytes.
+
+        Args:
+            repository: Objeto Repository
+        """
+        if repository.scratch_peak:
+            return int(repository.scratch_peak * PEAK_MARGIN)
+        if repository.size:
+            return int(repository.size * 1024 * self.expansion_factor())
+        return self.default_reservation
+
+    def register(self, backup_id, reserved):
+        """
+        Registra la reserva de un backup admitido (con `admission` tomado).
+
+        Args:
+            backup_id: ID del backup
+            reserved: Bytes reservados
+        """
+        self._reservations[backup_id] = [reserved, 0, 0]
+
+    def release(self, backup_id, paths):
+        """
+        Libera la reserva de un backup terminado tras una última medición.
+
+        Args:
+            backup_id: ID del backup
+            paths: Archivos y directorios del backup
+
+        Returns:
+            Pico de espacio medido, en bytes
+        """
+        self._record(backup_id, self._usage(paths))
+        with self._lock:
+            _, _, peak = self._reservations.pop(backup_id, (0, 0, 0))
+        return peak
+
+    async def track(self, backup_id, paths):
+        """
+        Mide lo que ocupan los archivos de un backup hasta que se cancela.
+
+        Recorrer un clone grande es costoso: el intervalo entre medidas
+        crece con lo que tarda cada una (como mucho un 5 % del tiempo).
+
+        Args:
+            backup_id: ID del backup
+            paths: Función que devuelve los archivos y directorios del backup
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            started = time.monotonic()
+            used = await loop.run_in_executor(None, self._usage, paths)
+            self._record(backup_id, used)
+            await asyncio.sleep(max(self.sample_interval, (time.monotonic() - started) * 20))
+
+    def expansion_factor(self):
+        """
+        Bytes de disco de trabajo por byte del tamaño que indica GitHub
+        (percentil 90 de los backups completados recientes, recalculado cada
+        `FACTOR_TTL` segundos).
+        """
+        if self._factor is None or time.monotonic() - self._factor_at > FACTOR_TTL:
+            rows = db.session.query(Backup.scratch_peak, Repository.size).join(Backup.repository).filter(
+                Backup.status == 'completed',
+                Backup.scratch_peak > 0,
+                Repository.size > 0
+            ).order_by(Backup.id.desc()).limit(FACTOR_SAMPLE).all()
+
+            ratios = [peak / (size * 1024) for peak, size in rows]
+            if len(ratios) >= 10:
+                self._factor = max(statistics.quantiles(ratios, n=10)[-1], 1.0)
+            else:
+                self._factor = self.default_factor
+            self._factor_at = time.monotonic()
+        return self._factor
+
+    def _record(self, backup_id, used):
+        """
+        Guarda una medida del espacio que ocupa un backup.
+        """
+        with self._lock:
+            reservation = self._reservations.get(backup_id)
+            if reservation:
+                reservation[1] = used
+                reservation[2] = max(reservation[2], used)
+
+    @staticmethod
+    def _usage(paths):
+        """
+        Espacio en disco que ocupan unos archivos y directorios, en bytes.
+
+        Args:
+            paths: Función que devuelve las rutas
+        """
+        total = 0
+        for path in paths():
+            if os.path.isfile(path):
+                entries = [('', [], [path])]
+            else:
+                entries = os.walk(path)
+            for root, _, files in entries:
+                for name in files:
+                    try:
+                        stat = os.lstat(os.path.join(root, name))
+                    except OSError:
+                        # Borrado mientras se recorría
+                        continue
+                    # Los hardlinks a la caché de espejos no ocupan espacio nuevo
+                    if stat.st_nlink == 1:
+                        total += stat.st_blocks * 512 if hasattr(stat, 'st_blocks') else stat.st_size
+        return total
@@ -1,324 +1,1063 @@
-import boto3
 import os
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from ftplib import FTP
-import logging
-from models import db, Backup
 import json
-import pickle
-import tempfile
-import shutil
-from datetime import datetime, timedelta
+import logging
+from models import db, Backup, BackupDestination, Repository, UploadSession
+from sqlalchemy import func
+from repomirror.retry import CircuitBreaker, CircuitOpenError, RetryPolicy, is_transient
+from repomirror.storage.base import UploadCheckpoint, UploadResumeError
+from repomirror.storage.factory import StorageFactory
+from repomirror.storage.scheduler import TransferScheduler
+from services.archive_stream import ArchiveStream, CheckpointReader, StagedReader, TeeStream
+from services.artifact_pool import ArtifactPool
+from services.backup_queue import ACTIVE_STATUSES
+from services.job_control import JobCancelled, JobControl, JobSuspended
+from services.retention import RetentionPlanner
+from services.compression import get_codec
+import asyncio
+import time
+from datetime import datetime, timedelta, timezone
 
 class StorageService:
     def __init__(self, config):
         self.logger = logging.getLogger(__name__)
         self.config = config
-        self.s3_client = None
-        self.gdrive_service = None
-        self.ftp_client = None
-        self._initialize_clients()
+        self.backends = {}
+        self.retention = RetentionPlanner()
+        self.retention_policy = config.get('retention')
+        self._initialize_backends()
+        self.retry_policy = RetryPolicy(config.get('max_retries', 3))
+        breaker_config = config.get('circuit_breaker') or {}
+        self.breakers = {
+            storage_type: CircuitBreaker(
+                storage_type,
+                failure_threshold=breaker_config.get('failure_threshold', 5),
+                reset_timeout=breaker_config.get('reset_timeout', 60)
+            )
+            for storage_type in self.backends
+        }
+        self.transfers = TransferScheduler(
+            {storage_type: self._transfer_limits(self.config[storage_type]) for storage_type in self.backends},
+            bandwidth_limit=self._transfer_limits(self.config)['bandwidth_limit']
+        )
+        # Compresión y hash en procesos aparte (por defecto uno por núcleo; 0 = en streaming)
+        self.artifacts = ArtifactPool((config.get('compression') or {}).get('processes'))
 
-    def _initialize_clients(self):
+    def _initialize_backends(self):
         """
-        Inicializa los clientes de almacenamiento según la configuración.
+        Inicializa los backends de almacenamiento según la configuración.
         """
-        # Inicializar S3
-        if 's3' in self.config:
+        for storage_type in ('s3', 'gdrive', 'ftp'):
+            if storage_type not in self.config:
+                continue
             try:
-                self.s3_client = boto3.client(
-                    's3',
-                    aws_access_key_id=self.config['s3']['access_key'],
-                    aws_secret_access_key=self.config['s3']['secret_key'],
-                    region_name=self.config['s3']['region']
+                self.backends[storage_type] = StorageFactory.create_storage(
+                    storage_type,
+                    self.config[storage_type]
                 )
             except Exception as e:
-                self.logger.warning(f'No se pudo inicializar el cliente S3: {e}. Se omite inicialización de S3.')
-                self.s3_client = None
+                self.logger.warning(f'No se pudo inicializar el backend {storage_type}: {e}. Se omite su inicialización.')
 
-        # Inicializar Google Drive
-        if 'gdrive' in self.config:
-            self._initialize_gdrive()
+    def _transfer_limits(self, backend_config):
+        """
+        Límites de transferencia de un backend según su configuración.
 
-        # Inicializar FTP
-        if 'ftp' in self.config:
-            try:
-                self.ftp_client = FTP()
-                self.ftp_client.connect(
-                    host=self.config['ftp']['host'],
-                    port=self.config['ftp'].get('port', 21)
-                )
-                self.ftp_client.login(
-                    user=self.config['ftp']['username'],
-                    passwd=self.config['ftp']['password']
-                )
-            except Exception as e:
-                self.logger.warning(f'No se pudo inicializar el cliente FTP: {e}. Se omite inicialización de FTP.')
-                self.ftp_client = None
+        Args:
+            backend_config: Sección de configuración del backend (o la de
+                storage para el límite total)
+        """
+        return {
+            'max_transfers': int(backend_config.get('max_transfers') or 0),
+            # En la configuración en MB/s; el planificador trabaja en bytes/s
+            'bandwidth_limit': int(float(backend_config.get('bandwidth_limit_mb') or 0) * 1024 * 1024)
+        }
 
-    def _initialize_gdrive(self):
+    def get_transfer_limits(self):
         """
-        Inicializa el cliente de Google Drive, pero ignora si faltan credenciales.
+        Límites de transferencia, transferencias activas y en espera y
+        estado del circuit breaker de cada backend.
         """
-        SCOPES = ['https://www.googleapis.com/auth/drive.file']
-        creds = None
-        cred_file = self.config['gdrive'].get('credentials_file', 'credentials.json')
-        token_file = self.config['gdrive'].get('token_file', 'token.json')
+        stats = self.transfers.stats()
+        for storage_type, breaker in self.breakers.items():
+            stats['backends'].setdefault(storage_type, {})['circuit'] = breaker.stats()
+        return stats
 
-        # Verificar existencia de archivos
-        if not os.path.exists(cred_file):
-            self.logger.warning(f'Archivo de credenciales de Google Drive no encontrado: {cred_file}. Se omite inicialización de Google Drive.')
-            return
-        if not os.path.exists(token_file):
-            self.logger.warning(f'Archivo de token de Google Drive no encontrado: {token_file}. Se intentará obtener uno nuevo si es posible.')
+    def set_transfer_limits(self, limits):
+        """
+        Cambia en caliente los límites de transferencia.
 
-        # Cargar credenciales existentes
-        if os.path.exists(token_file):
-            with open(token_file, 'rb') as token:
-                creds = pickle.load(token)
+        Args:
+            limits: Diccionario con `bandwidth_limit` (total, bytes/s) y
+                `backends`: {tipo: {max_transfers, bandwidth_limit}}
+        """
+        backends = limits.get('backends') or {}
+        for storage_type in backends:
+            self._get_backend(storage_type)
+        if limits.get('bandwidth_limit') is not None:
+            self.transfers.configure(bandwidth_limit=int(limits['bandwidth_limit']))
+        for storage_type, backend_limits in backends.items():
+            self.transfers.configure(
+                storage_type,
+                max_transfers=backend_limits.get('max_transfers'),
+                bandwidth_limit=backend_limits.get('bandwidth_limit')
+            )
+        return self.get_transfer_limits()
 
-        # Si no hay credenciales válidas, obtener nuevas
-        if not creds or not creds.valid:
-            try:
-                if creds and creds.expired and creds.refresh_token:
-                    creds.refresh(Request())
-                else:
-                    from google_auth_oauthlib.flow import InstalledAppFlow
-                    flow = InstalledAppFlow.from_client_secrets_file(
-                        cred_file,
-                        SCOPES
-                    )
-                    creds = flow.run_local_server(port=0)
+    def _get_backend(self, storage_type):
+        """
+        Obtiene el backend de un tipo de almacenamiento.
 
-                # Guardar credenciales
-                with open(token_file, 'wb') as token:
-                    pickle.dump(creds, token)
-            except Exception as e:
-                self.logger.warning(f'No se pudo obtener credenciales de Google Drive: {e}. Se omite inicialización de Google Drive.')
-                return
+        Args:
+            storage_type: Tipo de almacenamiento (s3, gdrive, ftp)
+        """
+        if storage_type not in ('s3', 'gdrive', 'ftp'):
+            raise ValueError(f'Tipo de almacenamiento no soportado: {storage_type}')
+        if storage_type not in self.backends:
+            raise ValueError(f'Backend {storage_type} no inicializado')
+        return self.backends[storage_type]
 
-        try:
-            self.gdrive_service = build('drive', 'v3', credentials=creds)
-        except Exception as e:
-            self.logger.warning(f'No se pudo inicializar el cliente de Google Drive: {e}. Se omite inicialización de Google Drive.')
-            self.gdrive_service = None
+    async def _call_backend(self, storage_type, description, func):
+        """
+        Llama a un backend con reintentos y a través de su circuit breaker.
 
-    def upload_backup(self, backup_id, storage_type):
+        Args:
+            storage_type: Tipo de almacenamiento
+            description: Descripción de la operación para los logs
+            func: Función que recibe el backend y devuelve la corrutina a ejecutar
+
+        Returns:
+            Resultado de la llamada
+        """
+        backend = self._get_backend(storage_type)
+        return await self.retry_policy.run(
+            lambda: func(backend),
+            description,
+            breaker=self.breakers[storage_type],
+            classify=backend.classify_error
+        )
+
+    async def upload_backup(self, backup_id, storage_types, artifact_path=None, control=None):
         """
-        Sube un backup al almacenamiento especificado.
-        
+        Sube un backup a uno o varios almacenamientos.
+
+        El artefacto se genera una sola vez por codec y se reparte entre los
+        destinos que lo usan, que se suben a la vez. Cada destino tiene su
+        propio registro BackupDestination: si uno falla los demás continúan, y
+        el backup se completa si al menos una copia se subió.
+
+        Sin `artifact_path`, la copia local se empaqueta en un tar. El
+        artefacto comprimido de cada codec se genera en disco en el pool de
+        procesos (ver ArtifactPool) y luego se sube; sin pool, se comprime y
+        se sube a la vez, sin pasar por un archivo temporal.
+
+        Las subidas son reanudables: si el backup ya tiene copias de un
+        intento interrumpido, las completadas no se repiten y las demás
+        continúan desde su último punto de control (ver _open_checkpoint).
+        Las copias que fallan por un error pasajero se reintentan igual, desde
+        su último punto de control, tras una espera exponencial con jitter.
+
+        Si el backup se cancela o vence su tiempo límite, las subidas en curso
+        se interrumpen, se descartan sus datos parciales y se lanza JobCancelled.
+
         Args:
             backup_id: ID del backup
-            storage_type: Tipo de almacenamiento (s3, gdrive, ftp)
+            storage_types: Tipo o lista de tipos de almacenamiento (s3, gdrive, ftp)
+            artifact_path: Archivo ya generado a subir (p. ej. un git bundle)
+            control: JobControl del backup en curso
         """
         backup = Backup.query.get(backup_id)
         if not backup:
             raise ValueError(f'Backup {backup_id} no encontrado')
+        if isinstance(storage_types, str):
+            storage_types = [storage_types]
+        control = control or JobControl()
 
+        destinations = []
         try:
-            if storage_type == 's3':
-                self._upload_to_s3(backup)
-            elif storage_type == 'gdrive':
-                self._upload_to_gdrive(backup)
-            elif storage_type == 'ftp':
-                self._upload_to_ftp(backup)
-            else:
-                raise ValueError(f'Tipo de almacenamiento no soportado: {storage_type}')
+            existing = {d.storage_type: d for d in backup.destinations}
+            for storage_type in storage_types:
+                destination = existing.get(storage_type)
+                if destination is None:
+                    destination = BackupDestination(backup_id=backup.id, storage_type=storage_type)
+                    db.session.add(destination)
+                destinations.append(destination)
+                if destination.status != 'completed':
+                    destination.status = 'uploading'
+                    destination.error_message = None
+                    destination.started_at = datetime.utcnow()
+            db.session.commit()
 
+            pending = [d for d in destinations if d.status == 'uploading']
+            # Artefactos generados en disco por codec, reutilizados en los reintentos
+            staged = {}
+            attempt = 0
+            while pending:
+                # Las copias que fallaron por un error pasajero continúan desde
+                # su punto de control, y aquellas cuyo punto de control no
+                # sirvió se suben de nuevo desde el principio
+                groups = self._group_by_codec(backup, pending, artifact_path)
+                pending = await control.run_task(self._upload_groups(backup, groups, artifact_path, attempt, staged))
+                if pending:
+                    await control.wait(self.retry_policy.backoff(attempt))
+                    attempt += 1
+            db.session.commit()
+
+            completed = [d for d in destinations if d.status == 'completed']
+            failed = [d for d in destinations if d.status != 'completed']
+            if not completed:
+                raise Exception('; '.join(f'{d.storage_type}: {d.error_message}' for d in failed))
+
+            # La primera copia correcta es la principal del backup
+            primary = completed[0]
             backup.status = 'completed'
-            backup.storage_path = self._get_storage_path(backup, storage_type)
+            backup.completed_at = datetime.utcnow()
+            backup.compression = primary.compression
+            backup.storage_type = primary.storage_type
+            backup.storage_path = primary.storage_path
+            backup.size = primary.size
+            if failed:
+                backup.error_message = 'Copias fallidas: ' + '; '.join(
+                    f'{d.storage_type}: {d.error_message}' for d in failed
+                )
             db.session.commit()
 
+        except JobSuspended:
+            # Otro worker continúa el backup y sus subidas: no se descarta nada
+            db.session.rollback()
+            raise
+        except JobCancelled as e:
+            db.session.rollback()
+            # Las subidas a medias no se van a reanudar
+            unfinished = [d for d in destinations if d.status == 'uploading']
+            await self._discard_sessions(unfinished)
+            for destination in unfinished:
+                self._finish_destination(destination, error=e)
+            db.session.commit()
+            raise
         except Exception as e:
             self.logger.error(f'Error uploading backup {backup_id}: {str(e)}')
+            db.session.rollback()
             backup.status = 'error'
             backup.error_message = str(e)
             db.session.commit()
             raise
 
-    def _upload_to_s3(self, backup):
+    def _group_by_codec(self, backup, destinations, artifact_path):
         """
-        Sube un backup a Amazon S3.
-        
+        Agrupa los destinos por codec: se genera un artefacto por codec,
+        compartido por los destinos que lo usan.
+
         Args:
             backup: Objeto Backup
+            destinations: Lista de objetos BackupDestination
+            artifact_path: Archivo ya generado a subir o None
+
+        Returns:
+            Lista de (codec, destinos)
         """
-        if not self.s3_client:
-            raise ValueError('Cliente S3 no inicializado')
-
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            # Comprimir el backup
-            shutil.make_archive(temp_file.name, 'zip', backup.local_path)
-            
-            # Subir a S3
-            self.s3_client.upload_file(
-                f'{temp_file.name}.zip',
-                self.config['s3']['bucket'],
-                f'backups/{backup.id}.zip'
-            )
+        groups = {}
+        for destination in destinations:
+            try:
+                codec = self.get_codec(backup.repository, destination.storage_type, packs=artifact_path is not None)
+            except ValueError as e:
+                self._finish_destination(destination, error=e)
+                continue
+            groups.setdefault((codec.name, codec.level), (codec, []))[1].append(destination)
+        db.session.commit()
+        return list(groups.values())
+
+    async def _upload_groups(self, backup, groups, artifact_path, attempt=0, staged=None):
+        """
+        Genera el artefacto de cada codec y lo sube a todos sus destinos a la vez.
 
-        # Limpiar archivos temporales
-        os.unlink(temp_file.name)
-        os.unlink(f'{temp_file.name}.zip')
+        Los artefactos se generan primero en el pool de procesos, si lo hay.
+        Después se espera a que todos los backends de los destinos tengan una
+        transferencia libre (ver TransferScheduler). Si se cancela la tarea
+        (p. ej. al interrumpirse el backup) se cierran los flujos, lo que
+        detiene las subidas en curso.
 
-    def _upload_to_gdrive(self, backup):
+        Args:
+            backup: Objeto Backup
+            groups: Lista de (codec, destinos)
+            artifact_path: Archivo ya generado a subir o None
+            attempt: Número de reintento (0 en el primer intento)
+            staged: Artefactos ya generados en disco, por codec
+
+        Returns:
+            Destinos que hay que volver a subir
         """
-        Sube un backup a Google Drive.
-        
+        staged = {} if staged is None else staged
+        if self.artifacts.enabled:
+            await self._stage_artifacts(backup, groups, artifact_path, staged)
+
+        storage_types = [destination.storage_type for _, destinations in groups for destination in destinations]
+        waiting = time.monotonic()
+        # Los huecos se reservan antes de generar el artefacto: mientras se
+        # espera no hay ningún flujo abierto ocupando memoria ni CPU
+        async with self.transfers.transfers(storage_types):
+            waited = time.monotonic() - waiting
+            if waited >= 1:
+                self.logger.info(f'Backup {backup.id}: waited {waited:.1f}s for a transfer slot')
+            return await self._start_uploads(backup, groups, artifact_path, attempt, staged)
+
+    async def _stage_artifacts(self, backup, groups, artifact_path, staged):
+        """
+        Genera en el pool de procesos los artefactos de los codecs que faltan.
+
         Args:
             backup: Objeto Backup
+            groups: Lista de (codec, destinos)
+            artifact_path: Archivo ya generado a comprimir o None
+            staged: Artefactos ya generados, por codec; se completa con los nuevos
         """
-        if not self.gdrive_service:
-            raise ValueError('Cliente Google Drive no inicializado')
-
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            # Comprimir el backup
-            shutil.make_archive(temp_file.name, 'zip', backup.local_path)
-            
-            # Crear metadatos del archivo
-            file_metadata = {
-                'name': f'backup_{backup.id}.zip',
-                'mimeType': 'application/zip'
-            }
-            
-            # Subir a Google Drive
-            media = MediaFileUpload(
-                f'{temp_file.name}.zip',
-                mimetype='application/zip',
-                resumable=True
+        builds = []
+        for codec, _ in groups:
+            key = (codec.name, codec.level)
+            if key in staged:
+                continue
+            if artifact_path:
+                extension = os.path.splitext(artifact_path)[1] + codec.extension
+                build = self.artifacts.build(artifact_path + codec.extension, codec, source_file=artifact_path)
+            else:
+                extension = '.tar' + codec.extension
+                arcname, mtime = self._archive_params(backup)
+                build = self.artifacts.build(
+                    backup.local_path + extension,
+                    codec,
+                    source_dir=backup.local_path,
+                    arcname=arcname,
+                    mtime=mtime
+                )
+            builds.append((key, codec, extension, build))
+
+        artifacts = await asyncio.gather(*(build for _, _, _, build in builds))
+        for (key, codec, extension, _), artifact in zip(builds, artifacts):
+            artifact['extension'] = extension
+            staged[key] = artifact
+            ratio = artifact['size'] / artifact['bytes_in'] if artifact['bytes_in'] else 1
+            throughput = artifact['bytes_in'] / artifact['seconds'] / (1024 * 1024) if artifact['seconds'] else 0
+            self.logger.info(
+                f'Backup {backup.id}: staged {artifact["bytes_in"]} bytes -> {artifact["size"]} bytes '
+                f'({codec.name}, ratio {ratio:.2f}) at {throughput:.1f} MB/s'
             )
-            
-            file = self.gdrive_service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id'
-            ).execute()
 
-        # Limpiar archivos temporales
-        os.unlink(temp_file.name)
-        os.unlink(f'{temp_file.name}.zip')
+    async def _start_uploads(self, backup, groups, artifact_path, attempt, staged=None):
+        """
+        Abre los flujos de cada codec y lanza las subidas de sus destinos.
+
+        Cada destino de un artefacto generado en disco lo lee por su cuenta;
+        si no, el flujo comprimido se reparte entre los destinos del codec.
 
-    def _upload_to_ftp(self, backup):
+        Args:
+            backup: Objeto Backup
+            groups: Lista de (codec, destinos)
+            artifact_path: Archivo ya generado a subir o None
+            attempt: Número de reintento
+            staged: Artefactos generados en disco, por codec
+
+        Returns:
+            Destinos que hay que volver a subir
         """
-        Sube un backup a un servidor FTP.
-        
+        streams = []
+        tees = []
+        uploads = []
+        targets = []
+        try:
+            for codec, destinations in groups:
+                artifact = (staged or {}).get((codec.name, codec.level))
+                if artifact:
+                    for destination in destinations:
+                        reader = StagedReader(artifact['path'], artifact['sha256'])
+                        uploads.append(self._upload_destination(
+                            backup, destination, codec, reader, artifact['extension'], attempt
+                        ))
+                        targets.append(destination)
+                    continue
+
+                if artifact_path:
+                    extension = os.path.splitext(artifact_path)[1] + codec.extension
+                    stream = ArchiveStream.from_file(artifact_path, codec)
+                else:
+                    extension = '.tar' + codec.extension
+                    stream = self.open_archive_stream(backup, codec)
+                streams.append((codec, stream))
+
+                branches = [stream]
+                if len(destinations) > 1:
+                    tee = TeeStream(stream, len(destinations)).start()
+                    tees.append(tee)
+                    branches = tee.branches
+
+                for destination, branch in zip(destinations, branches):
+                    uploads.append(self._upload_destination(
+                        backup, destination, codec, CheckpointReader(branch), extension, attempt
+                    ))
+                    targets.append(destination)
+
+            started = time.monotonic()
+            restart = await asyncio.gather(*uploads)
+            for codec, stream in streams:
+                self._log_throughput(backup, codec, stream, time.monotonic() - started)
+            return [destination for destination, again in zip(targets, restart) if again]
+        finally:
+            # Primero las ramas: el reparto necesita el flujo original para terminar
+            for tee in tees:
+                tee.close()
+            for _, stream in streams:
+                stream.close()
+
+    async def _upload_destination(self, backup, destination, codec, reader, extension, attempt=0):
+        """
+        Sube el artefacto a un destino y registra el resultado.
+
         Args:
             backup: Objeto Backup
+            destination: Objeto BackupDestination
+            codec: Codec del artefacto
+            reader: CheckpointReader (sobre un flujo o una rama de un
+                TeeStream) o StagedReader con el artefacto comprimido
+            extension: Extensión del artefacto
+            attempt: Número de reintento
+
+        Returns:
+            True si hay que repetir la subida: falló por un error pasajero
+            (continuará desde su punto de control) o la subida interrumpida
+            no pudo continuarse (empezará desde el principio)
         """
-        if not self.ftp_client:
-            raise ValueError('Cliente FTP no inicializado')
-
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            # Comprimir el backup
-            shutil.make_archive(temp_file.name, 'zip', backup.local_path)
-            
-            # Subir a FTP
-            with open(f'{temp_file.name}.zip', 'rb') as file:
-                self.ftp_client.storbinary(
-                    f'STOR {self.config["ftp"]["path"]}/backup_{backup.id}.zip',
-                    file
+        started = time.monotonic()
+        try:
+            backend = self._get_backend(destination.storage_type)
+            # Un destino caído falla al momento, sin esperar a sus timeouts
+            self.breakers[destination.storage_type].allow()
+            remote_path = self._get_destination(backup, destination.storage_type, extension)
+            checkpoint = await self._open_checkpoint(backend, destination, remote_path, reader)
+            # Límite de ancho de banda después de descartar el prefijo ya subido
+            throttled = self.transfers.throttle(reader, destination.storage_type)
+            file_id = await backend.upload_stream(throttled, remote_path, checkpoint)
+            self.breakers[destination.storage_type].record_success()
+            destination.storage_path = self._get_storage_path(destination.storage_type, file_id)
+            destination.compression = codec.name
+            # Bytes del artefacto, es decir, el tamaño del objeto remoto
+            destination.size = reader.position
+            destination.sha256 = reader.digest_at(reader.position)
+            destination.upload_session = None
+            self._finish_destination(destination, duration=time.monotonic() - started)
+            db.session.commit()
+        except UploadResumeError as e:
+            # La subida se repite desde el principio aunque no se pueda abortar
+            # la anterior, que queda huérfana para cleanup_upload_sessions
+            await self._discard_session(destination, detach=True)
+            if attempt < self.retry_policy.max_retries:
+                self.logger.warning(f'Backup {backup.id}: restarting upload to {destination.storage_type}: {str(e)}')
+                return True
+            self.logger.error(f'Error uploading backup {backup.id} to {destination.storage_type}: {str(e)}')
+            self._finish_destination(destination, duration=time.monotonic() - started, error=e)
+            db.session.commit()
+        except Exception as e:
+            if self._should_retry_upload(destination.storage_type, e, attempt):
+                # La sesión se conserva para continuar desde el punto de control
+                self.logger.warning(
+                    f'Backup {backup.id}: upload to {destination.storage_type} failed, retrying: {str(e)}'
                 )
+                return True
+            self.logger.error(f'Error uploading backup {backup.id} to {destination.storage_type}: {str(e)}')
+            await self._discard_session(destination)
+            self._finish_destination(destination, duration=time.monotonic() - started, error=e)
+            db.session.commit()
+        finally:
+            # Una rama cerrada deja de recibir datos y no frena a las demás
+            reader.close()
+        return False
 
-        # Limpiar archivos temporales
-        os.unlink(temp_file.name)
-        os.unlink(f'{temp_file.name}.zip')
+    def _should_retry_upload(self, storage_type, error, attempt):
+        """
+        Registra el fallo de una subida en el circuit breaker del backend y
+        decide si se reintenta.
 
-    def _get_storage_path(self, backup, storage_type):
+        Args:
+            storage_type: Tipo de almacenamiento
+            error: Excepción de la subida
+            attempt: Número de reintento
         """
-        Obtiene la ruta de almacenamiento para un backup.
-        
+        if isinstance(error, CircuitOpenError) or storage_type not in self.backends:
+            return False
+        transient = is_transient(error, self.backends[storage_type].classify_error)
+        breaker = self.breakers[storage_type]
+        if transient:
+            breaker.record_failure()
+        else:
+            # El destino respondió: el error es de esta subida y no del servicio
+            breaker.record_success()
+        return transient and attempt < self.retry_policy.max_retries
+
+    async def _open_checkpoint(self, backend, destination, remote_path, reader):
+        """
+        Prepara el punto de control de la subida de una copia.
+
+        Si la copia tiene la sesión de un intento interrumpido y el backend
+        aún la acepta, se lee y descarta del artefacto el prefijo ya subido,
+        comprobando que su SHA-256 coincide con el registrado (el artefacto se
+        genera de forma determinista, ver ArchiveStream.from_directory).
+
+        Args:
+            backend: Backend de almacenamiento
+            destination: Objeto BackupDestination
+            remote_path: Ruta de destino en el almacenamiento
+            reader: CheckpointReader con el artefacto
+
+        Returns:
+            UploadCheckpoint a pasar a upload_stream
+
+        Raises:
+            UploadResumeError: Si el prefijo ya subido no coincide con el artefacto
+        """
+        session = destination.upload_session
+        if session:
+            # Los puntos de control se escriben fuera de la sesión de SQLAlchemy
+            db.session.refresh(session)
+        if session and session.remote_path != remote_path:
+            # Otro artefacto (p. ej. cambió el codec): no se puede continuar
+            await self._discard_session(destination)
+            session = destination.upload_session
+        if session is None:
+            session = UploadSession(
+                storage_type=destination.storage_type,
+                remote_path=remote_path,
+                state='{}',
+                offset=0
+            )
+            destination.upload_session = session
+            db.session.commit()
+
+        checkpoint = UploadCheckpoint(json.loads(session.state or '{}'), self._session_saver(session.id, reader))
+        if not checkpoint.state:
+            return checkpoint
+
+        if not await backend.resume_upload(checkpoint):
+            # La sesión caducó o se perdió en el servidor: se empieza de nuevo
+            await backend.abort_upload(checkpoint.state)
+            checkpoint.reset()
+            return checkpoint
+
+        loop = asyncio.get_event_loop()
+        digest = await loop.run_in_executor(None, reader.skip, checkpoint.offset)
+        if digest != session.sha256:
+            raise UploadResumeError('El artefacto no coincide con el de la subida interrumpida')
+        self.logger.info(
+            f'Backup {destination.backup_id}: resuming upload to {destination.storage_type} at byte {checkpoint.offset}'
+        )
+        return checkpoint
+
+    def _session_saver(self, session_id, reader):
+        """
+        Crea la función que persiste los puntos de control de una subida.
+
+        Los backends la llaman desde el bucle de eventos o desde los hilos del
+        executor, así que escribe con su propia conexión y no con la sesión
+        de SQLAlchemy del worker. Solo se registran las posiciones de las que
+        se conoce el hash del prefijo.
+
+        Args:
+            session_id: ID de la UploadSession
+            reader: CheckpointReader de la subida
+        """
+        engine = db.engine
+        table = UploadSession.__table__
+
+        def save(state):
+            digest = reader.digest_at(state['offset'])
+            if digest is None:
+                return
+            with engine.begin() as connection:
+                connection.execute(table.update().where(table.c.id == session_id).values(
+                    state=json.dumps(state),
+                    offset=state['offset'],
+                    sha256=digest,
+                    updated_at=datetime.utcnow()
+                ))
+
+        return save
+
+    async def _discard_session(self, destination, detach=False):
+        """
+        Descarta la sesión de subida de una copia y los datos parciales que dejó.
+
+        Si no se puede descartar en el almacenamiento, la sesión se conserva
+        para que la limpie cleanup_upload_sessions.
+
+        Args:
+            destination: Objeto BackupDestination
+            detach: Desvincular la sesión aunque falle el descarte; la subida
+                remota queda huérfana y cleanup_upload_sessions la aborta
+                cuando caduca
+        """
+        session = destination.upload_session
+        if session is None:
+            return
+
+        # Los puntos de control se escriben fuera de la sesión de SQLAlchemy
+        db.session.refresh(session)
+        state = json.loads(session.state or '{}')
+        try:
+            await self._call_backend(
+                session.storage_type,
+                f'Abort of upload session {session.id}',
+                lambda backend: backend.abort_upload(state)
+            )
+        except Exception as e:
+            self.logger.warning(f'Error aborting upload session {session.id}: {str(e)}')
+            if not detach:
+                return
+
+        destination.upload_session = None
+        db.session.commit()
+
+    async def _discard_sessions(self, destinations):
+        """
+        Descarta a la vez las sesiones de subida de varias copias.
+
+        Args:
+            destinations: Lista de objetos BackupDestination
+        """
+        await asyncio.gather(*(self._discard_session(destination) for destination in destinations))
+
+    def _finish_destination(self, destination, duration=None, error=None):
+        """
+        Marca el final de la subida a un destino.
+
+        Args:
+            destination: Objeto BackupDestination
+            duration: Duración de la subida en segundos
+            error: Excepción si la subida falló
+        """
+        destination.status = 'error' if error else 'completed'
+        destination.error_message = str(error) if error else None
+        destination.duration = duration
+        destination.completed_at = datetime.utcnow()
+
+    def cleanup_upload_sessions(self, max_age=24 * 3600):
+        """
+        Descarta las subidas reanudables abandonadas.
+
+        Una sesión está abandonada si su backup ya no está en curso ni
+        pendiente (terminó, falló o se resolvió de otra forma) o si no avanza
+        desde hace `max_age` segundos. Se descarta también en el
+        almacenamiento (p. ej. se aborta la subida multipart de S3 y se
+        liberan sus partes), igual que las subidas incompletas que no llegaron
+        a registrar ningún punto de control.
+
+        Args:
+            max_age: Segundos sin avanzar tras los que una sesión se abandona
+
+        Returns:
+            Diccionario con las sesiones descartadas y las subidas huérfanas abortadas
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+        stale = UploadSession.query.join(BackupDestination).join(Backup).filter(db.or_(
+            UploadSession.updated_at < cutoff,
+            Backup.status.notin_(('pending',) + ACTIVE_STATUSES)
+        )).all()
+
+        async def abort_all():
+            async def abort(session):
+                state = json.loads(session.state or '{}')
+                await self._call_backend(
+                    session.storage_type,
+                    f'Abort of upload session {session.id}',
+                    lambda backend: backend.abort_upload(state)
+                )
+
+            return await asyncio.gather(*(abort(session) for session in stale), return_exceptions=True)
+
+        stats = {'sessions': 0, 'orphans': 0}
+        for session, result in zip(stale, asyncio.run(abort_all()) if stale else []):
+            if isinstance(result, Exception):
+                self.logger.warning(f'Error aborting upload session {session.id}: {str(result)}')
+                continue
+            db.session.delete(session)
+            stats['sessions'] += 1
+        db.session.commit()
+
+        # Subidas incompletas de las que no se guardó ninguna sesión
+        keep = [json.loads(session.state or '{}') for session in UploadSession.query.all()]
+        for storage_type in self.backends:
+            prefix = self._get_destination_prefix(storage_type)
+            try:
+                stats['orphans'] += asyncio.run(self._call_backend(
+                    storage_type,
+                    f'Abort of stale {storage_type} uploads',
+                    lambda backend: backend.abort_stale_uploads(prefix, cutoff, keep)
+                ))
+            except Exception as e:
+                self.logger.error(f'Error aborting stale {storage_type} uploads: {str(e)}')
+
+        return stats
+
+    def get_codec(self, repository, storage_type, packs=False):
+        """
+        Obtiene el codec de compresión de un backup.
+
+        La configuración se toma, de menor a mayor prioridad, de
+        `storage.compression`, de `storage.<tipo>.compression` y del campo
+        `compression` del repositorio. Los git bundles ya contienen packs
+        comprimidos, así que usan `packs_codec` (por defecto sin compresión).
+
+        Args:
+            repository: Objeto Repository
+            storage_type: Tipo de almacenamiento
+            packs: Si el artefacto son datos de packs de git
+        """
+        settings = {'codec': 'zstd', 'level': None, 'threads': -1, 'packs_codec': 'none', 'packs_level': None}
+        settings.update(self.config.get('compression') or {})
+        settings.update(self.config.get(storage_type, {}).get('compression') or {})
+
+        if packs:
+            return get_codec(settings['packs_codec'], settings['packs_level'], settings['threads'])
+
+        name, level = settings['codec'], settings['level']
+        if repository.compression:
+            name, _, level = repository.compression.partition(':')
+        return get_codec(name, level, settings['threads'])
+
+    def _log_throughput(self, backup, codec, stream, seconds):
+        """
+        Registra el tamaño y la velocidad de la compresión y subida de un backup.
+
+        Args:
+            backup: Objeto Backup
+            codec: Codec usado
+            stream: ArchiveStream subido
+            seconds: Duración de la subida
+        """
+        ratio = stream.bytes_read / stream.bytes_in if stream.bytes_in else 1
+        throughput = stream.bytes_in / seconds / (1024 * 1024) if seconds else 0
+        self.logger.info(
+            f'Backup {backup.id}: {stream.bytes_in} bytes -> {stream.bytes_read} bytes '
+            f'({codec.name}, ratio {ratio:.2f}) at {throughput:.1f} MB/s'
+        )
+
+    def open_archive_stream(self, backup, codec):
+        """
+        Empieza a generar el tar comprimido de la copia local de un backup.
+
+        Args:
+            backup: Objeto Backup
+            codec: Codec de compresión
+
+        Returns:
+            ArchiveStream del que leer el archivo comprimido
+        """
+        arcname, mtime = self._archive_params(backup)
+        return ArchiveStream.from_directory(backup.local_path, arcname, codec, mtime=mtime)
+
+    def _archive_params(self, backup):
+        """
+        Obtiene el nombre del directorio y la fecha de las entradas del tar de un backup.
+
+        La fecha del backup es la de todas las entradas: el artefacto generado
+        en un reintento es idéntico y su subida puede reanudarse.
+
+        Args:
+            backup: Objeto Backup
+
+        Returns:
+            Tupla (arcname, mtime)
+        """
+        arcname = os.path.basename(backup.repository.url.rstrip('/')).replace('.git', '')
+        return arcname, backup.created_at.replace(tzinfo=timezone.utc).timestamp()
+
+    def _get_destination(self, backup, storage_type, extension):
+        """
+        Obtiene el nombre de destino de un backup en el almacenamiento.
+
         Args:
             backup: Objeto Backup
             storage_type: Tipo de almacenamiento
+            extension: Extensión del artefacto ('.tar.zst', '.bundle')
         """
         if storage_type == 's3':
-            return f's3://{self.config["s3"]["bucket"]}/backups/{backup.id}.zip'
+            return f'backups/{backup.id}{extension}'
+        return f'backup_{backup.id}{extension}'
+
+    def _get_storage_path(self, storage_type, file_id):
+        """
+        Obtiene la ruta de almacenamiento de un archivo subido.
+
+        Args:
+            storage_type: Tipo de almacenamiento
+            file_id: Identificador devuelto por el backend
+        """
+        if storage_type == 's3':
+            return file_id
         elif storage_type == 'gdrive':
-            return f'gdrive://backup_{backup.id}.zip'
+            return f'gdrive://{file_id}'
         elif storage_type == 'ftp':
-            return f'ftp://{self.config["ftp"]["host"]}{self.config["ftp"]["path"]}/backup_{backup.id}.zip'
+            return f'ftp://{self.config["ftp"]["host"]}{file_id}'
         return None
 
+    def _parse_storage_path(self, storage_path):
+        """
+        Obtiene el tipo de almacenamiento y el identificador del backend a
+        partir de una ruta de almacenamiento.
+
+        Args:
+            storage_path: Ruta generada por _get_storage_path
+        """
+        storage_type, _, rest = storage_path.partition('://')
+        if storage_type == 's3':
+            return storage_type, storage_path
+        elif storage_type == 'ftp':
+            return storage_type, rest[rest.find('/'):]
+        return storage_type, rest
+
     def get_total_storage_used(self, user_id):
         """
         Obtiene el total de almacenamiento usado por un usuario.
-        
+
+        Se suma el tamaño registrado al subir cada copia de cada artefacto;
+        los backups 'unchanged' no se cuentan porque comparten el artefacto de
+        otro backup.
+
         Args:
             user_id: ID del usuario
         """
-        total_size = 0
-        
-        # Obtener todos los backups del usuario
-        backups = Backup.query.join(Repository).filter(
+        return db.session.query(func.coalesce(func.sum(BackupDestination.size), 0)).select_from(
+            BackupDestination
+        ).join(Backup).join(
+            Repository, Backup.repository_id == Repository.id
+        ).filter(
             Repository.user_id == user_id,
-            Backup.status == 'completed'
+            Backup.status == 'completed',
+            BackupDestination.status == 'completed'
+        ).scalar()
+
+    def reconcile_storage(self, batch_size=500):
+        """
+        Concilia los tamaños registrados con el contenido real de los almacenamientos.
+
+        Recorre el listado paginado de cada backend (sin una consulta por
+        objeto) y, por lotes, corrige el tamaño de las copias que encuentra.
+        Las copias subidas que no aparecen en el listado se registran como
+        ausentes.
+
+        Args:
+            batch_size: Objetos del listado procesados por cada consulta a la base de datos
+
+        Returns:
+            Diccionario por tipo de almacenamiento con los objetos listados,
+            las copias corregidas y las copias ausentes
+        """
+        results = {}
+        for storage_type in self.backends:
+            started = datetime.utcnow()
+            try:
+                # Un listado interrumpido se repite entero: conciliar es idempotente
+                results[storage_type] = asyncio.run(self._call_backend(
+                    storage_type,
+                    f'Reconciliation of {storage_type} storage',
+                    lambda backend: self._reconcile_backend(storage_type, backend, started, batch_size)
+                ))
+            except Exception as e:
+                db.session.rollback()
+                self.logger.error(f'Error reconciling {storage_type} storage: {str(e)}')
+                continue
+
+            # Copias que no se encontraron en el listado completo
+            missing = BackupDestination.query.filter(
+                BackupDestination.storage_type == storage_type,
+                BackupDestination.status == 'completed',
+                BackupDestination.completed_at < started,
+                db.or_(BackupDestination.verified_at.is_(None), BackupDestination.verified_at < started)
+            ).all()
+            for destination in missing:
+                self.logger.warning(
+                    f'Backup {destination.backup_id}: artifact not found in {storage_type} ({destination.storage_path})'
+                )
+            results[storage_type]['missing'] = len(missing)
+
+        return results
+
+    async def _reconcile_backend(self, storage_type, backend, started, batch_size):
+        """
+        Concilia los backups de un backend con su listado.
+
+        Args:
+            storage_type: Tipo de almacenamiento
+            backend: Backend de almacenamiento
+            started: Inicio de la conciliación
+            batch_size: Objetos del listado por lote
+        """
+        stats = {'listed': 0, 'updated': 0}
+        batch = {}
+        async for item in backend.iter_files(self._get_destination_prefix(storage_type)):
+            batch[self._get_storage_path(storage_type, item['file_id'])] = int(item.get('size') or 0)
+            if len(batch) >= batch_size:
+                stats['updated'] += self._reconcile_batch(storage_type, batch, started)
+                stats['listed'] += len(batch)
+                batch = {}
+
+        if batch:
+            stats['updated'] += self._reconcile_batch(storage_type, batch, started)
+            stats['listed'] += len(batch)
+        return stats
+
+    def _reconcile_batch(self, storage_type, sizes, verified_at):
+        """
+        Actualiza las copias de un lote del listado.
+
+        Args:
+            storage_type: Tipo de almacenamiento
+            sizes: Diccionario ruta de almacenamiento -> tamaño remoto
+            verified_at: Fecha de verificación a registrar
+
+        Returns:
+            Número de copias cuyo tamaño se corrigió
+        """
+        updated = 0
+        destinations = BackupDestination.query.filter(
+            BackupDestination.storage_path.in_(list(sizes))
         ).all()
-        
-        for backup in backups:
-            if backup.storage_type == 's3':
-                try:
-                    response = self.s3_client.head_object(
-                        Bucket=self.config['s3']['bucket'],
-                        Key=f'backups/{backup.id}.zip'
-                    )
-                    total_size += response['ContentLength']
-                except:
-                    continue
-            elif backup.storage_type == 'gdrive':
-                try:
-                    file = self.gdrive_service.files().get(
-                        fileId=backup.storage_path.split('/')[-1],
-                        fields='size'
-                    ).execute()
-                    total_size += int(file.get('size', 0))
-                except:
-                    continue
-            elif backup.storage_type == 'ftp':
-                try:
-                    size = self.ftp_client.size(
-                        f'{self.config["ftp"]["path"]}/backup_{backup.id}.zip'
+
+        for destination in destinations:
+            size = sizes[destination.storage_path]
+            backup = destination.backup
+            if destination.size != size:
+                self.logger.info(f'Backup {backup.id} ({storage_type}): size {destination.size} -> {size}')
+                destination.size = size
+                updated += 1
+            destination.verified_at = verified_at
+
+            if backup.storage_path == destination.storage_path:
+                # Copia principal: el backup y los 'unchanged' que lo comparten
+                if backup.size != size:
+                    backup.size = size
+                    Backup.query.filter_by(artifact_backup_id=backup.id).update(
+                        {'size': size},
+                        synchronize_session=False
                     )
-                    total_size += int(size)
-                except:
-                    continue
-        
-        return total_size
+                backup.verified_at = verified_at
 
-    def cleanup_old_backups(self, days=30):
+        db.session.commit()
+        return updated
+
+    def _get_destination_prefix(self, storage_type):
+        """
+        Obtiene el prefijo común de los artefactos en un almacenamiento
+        (ver _get_destination).
+
+        Args:
+            storage_type: Tipo de almacenamiento
+        """
+        return 'backups/' if storage_type == 's3' else 'backup_'
+
+    def cleanup_old_backups(self, days=30, batch_size=1000):
         """
         Limpia los backups antiguos.
-        
+
         Args:
             days: Número de días después de los cuales eliminar backups
+            batch_size: Backups procesados por lote
+
+        Returns:
+            Diccionario con los backups eliminados y los que fallaron
         """
-        cutoff_date = datetime.utcnow() - timedelta(days=days)
-        old_backups = Backup.query.filter(
-            Backup.created_at < cutoff_date
-        ).all()
-        
-        for backup in old_backups:
-            try:
-                if backup.storage_type == 's3':
-                    self.s3_client.delete_object(
-                        Bucket=self.config['s3']['bucket'],
-                        Key=f'backups/{backup.id}.zip'
-                    )
-                elif backup.storage_type == 'gdrive':
-                    self.gdrive_service.files().delete(
-                        fileId=backup.storage_path.split('/')[-1]
-                    ).execute()
-                elif backup.storage_type == 'ftp':
-                    self.ftp_client.delete(
-                        f'{self.config["ftp"]["path"]}/backup_{backup.id}.zip'
+        ids = self.retention.plan(self.retention.older_than(days))
+        return self._delete_backups(ids, batch_size)
+
+    def apply_retention(self, policy=None, dry_run=False, batch_size=1000):
+        """
+        Aplica la política de retención GFS a todos los repositorios.
+
+        Args:
+            policy: Política (hourly, daily, weekly, monthly, errors_days); por
+                defecto la de `storage.retention`
+            dry_run: Solo calcular el informe, sin eliminar nada
+            batch_size: Backups procesados por lote
+
+        Returns:
+            Informe de la ejecución en seco o resultado de la limpieza
+        """
+        expired = self.retention.gfs(policy or self.retention_policy)
+        if dry_run:
+            return self.retention.report(expired)
+        return self._delete_backups(self.retention.plan(expired), batch_size)
+
+    def _delete_backups(self, backup_ids, batch_size):
+        """
+        Elimina backups y sus artefactos remotos por lotes.
+
+        Los IDs deben venir del más reciente al más antiguo para que ningún
+        backup se borre antes que los que lo referencian. En cada lote los
+        artefactos se eliminan agrupados por backend (todos los backends a la
+        vez) y las filas se borran con un commit por lote, de modo que una
+        ejecución interrumpida no repite lo ya eliminado.
+
+        Args:
+            backup_ids: IDs de los backups a eliminar
+            batch_size: Backups procesados por lote
+
+        Returns:
+            Diccionario con los backups eliminados y los que fallaron
+        """
+        stats = {'deleted': 0, 'failed': 0}
+
+        for i in range(0, len(backup_ids), batch_size):
+            batch = Backup.query.filter(
+                Backup.id.in_(backup_ids[i:i + batch_size])
+            ).order_by(Backup.id.desc()).all()
+
+            errors = self._delete_artifacts(batch)
+            for backup in batch:
+                if backup.id in errors:
+                    self.logger.error(f'Error cleaning up backup {backup.id}: {errors[backup.id]}')
+                    stats['failed'] += 1
+                else:
+                    db.session.delete(backup)
+                    stats['deleted'] += 1
+
+            # Punto de control: lo eliminado en este lote ya no se repite
+            db.session.commit()
+
+        self.logger.info(f'Retention cleanup finished: {stats}')
+        return stats
+
+    def _delete_artifacts(self, backups):
+        """
+        Elimina los artefactos remotos de un lote de backups.
+
+        Args:
+            backups: Lista de objetos Backup
+
+        Returns:
+            Diccionario ID de backup -> error de los artefactos no eliminados
+        """
+        by_type = {}
+        for backup in backups:
+            # Los backups 'unchanged' comparten el artefacto de otro backup
+            if backup.artifact_backup_id:
+                continue
+            for destination in backup.destinations:
+                if destination.storage_path:
+                    storage_type, file_id = self._parse_storage_path(destination.storage_path)
+                    by_type.setdefault(storage_type, {})[file_id] = backup.id
+
+        async def delete_all():
+            async def delete(storage_type, file_ids):
+                try:
+                    return await self._call_backend(
+                        storage_type,
+                        f'Deletion of {len(file_ids)} {storage_type} artifacts',
+                        lambda backend: backend.delete_files(list(file_ids))
                     )
-                
-                # Eliminar backup de la base de datos
-                db.session.delete(backup)
-            except Exception as e:
-                self.logger.error(f'Error cleaning up backup {backup.id}: {str(e)}')
-        
-        db.session.commit() 
\ No newline at end of file
+                except Exception as e:
+                    return {file_id: str(e) for file_id in file_ids}
+
+            results = await asyncio.gather(*(
+                delete(storage_type, file_ids) for storage_type, file_ids in by_type.items()
+            ))
+            return {
+                by_type[storage_type][file_id]: error
+                for storage_type, result in zip(by_type, results)
+                for file_id, error in result.items()
+            }
+
+        return asyncio.run(delete_all()) if by_type else {}
@@ -27,6 +27,8 @@ setup(
         "tqdm>=4.65.0",
         "aiofiles>=23.1.0",
         "python-magic>=0.4.27",
+        "zstandard>=0.22.0",
+        "lz4>=4.3.2",
     ],
     entry_points={
         "console_scripts": [
@@ -0,0 +1,24 @@
+from flask import Flask
+from models import db, User
+import pytest
+
+@pytest.fixture
+def app():
+    """
+    Aplicación con una base de datos SQLite en memoria.
+    """
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+@pytest.fixture
+def user(app):
+    user = User(username='alice', email='alice@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.commit()
+    return user
@@ -0,0 +1,194 @@
+from models import db, Backup, Repository, User
+from services.backup_queue import BackupQueue, PRIORITY_MANUAL, PRIORITY_SCHEDULED
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import itertools
+import pytest
+
+_names = itertools.count()
+
+@pytest.fixture
+def make_queue(app, tmp_path):
+    def make(**config):
+        config.setdefault('scratch', {'min_free_mb': 0, 'default_reservation_mb': 1})
+        return BackupQueue(app, SimpleNamespace(temp_dir=str(tmp_path)), None, None, config)
+    return make
+
+def make_user(username):
+    user = User(username=username, email=f'{username}@example.com', password_hash='x')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+def make_repository(user, organization=None, **fields):
+    owner = organization or user.username
+    repository = Repository(
+        user_id=user.id, url=f'https://github.com/{owner}/repo{next(_names)}', storage_type='s3', **fields
+    )
+    db.session.add(repository)
+    db.session.commit()
+    return repository
+
+def enqueue(queue, user, priority=PRIORITY_SCHEDULED, count=1, age=0, organization=None, **fields):
+    backups = []
+    for _ in range(count):
+        backup = queue.enqueue(make_repository(user, organization, **fields), priority)
+        backup.created_at = datetime.utcnow() - timedelta(seconds=age)
+        backups.append(backup)
+    db.session.commit()
+    return backups
+
+def start_backup(queue, user, priority=PRIORITY_SCHEDULED, host=None, reserved=0, started_ago=60):
+    now = datetime.utcnow()
+    backup = Backup(
+        repository_id=make_repository(user).id,
+        status='cloning',
+        priority=priority,
+        started_at=now - timedelta(seconds=started_ago),
+        lease_owner=f'{host or queue.lease_host}1:worker',
+        lease_expires_at=now + timedelta(seconds=60),
+        scratch_reserved=reserved
+    )
+    db.session.add(backup)
+    db.session.commit()
+    return backup
+
+def owners(backup_ids):
+    return [db.session.get(Backup, backup_id).repository.user.username for backup_id in backup_ids]
+
+def claim(queue, count):
+    claimed = []
+    for _ in range(count):
+        with queue.scratch.admission():
+            claimed.append(queue._claim_next())
+    return claimed
+
+def test_claims_largest_first_within_priority(make_queue, user):
+    queue = make_queue()
+    short, long_ = enqueue(queue, user, count=2)
+    long_.estimated_duration = 600
+    short.estimated_duration = 60
+    manual, = enqueue(queue, user, priority=PRIORITY_MANUAL)
+    manual.estimated_duration = 1
+    db.session.commit()
+
+    assert claim(queue, 4) == [manual.id, long_.id, short.id, None]
+    assert db.session.get(Backup, manual.id).status == 'cloning'
+    assert db.session.get(Backup, manual.id).lease_owner == queue.worker_id
+
+def test_workers_are_shared_by_weight(make_queue):
+    queue = make_queue(fair_share={'weights': {'alice': 2}})
+    alice, bob = make_user('alice'), make_user('bob')
+    enqueue(queue, alice, count=6, age=60)
+    enqueue(queue, bob, count=6)
+
+    assert owners(claim(queue, 6)).count('alice') == 4
+
+def test_manual_backups_go_before_other_users(make_queue):
+    queue = make_queue()
+    alice, bob = make_user('alice'), make_user('bob')
+    enqueue(queue, alice, count=3, age=600)
+    manual, = enqueue(queue, bob, priority=PRIORITY_MANUAL)
+
+    assert claim(queue, 1) == [manual.id]
+
+def test_capped_user_is_skipped(make_queue):
+    queue = make_queue(fair_share={'max_concurrent': 2, 'limits': {'bob': 1}})
+    alice, bob = make_user('alice'), make_user('bob')
+    enqueue(queue, bob, priority=PRIORITY_MANUAL, count=3, age=60)
+    enqueue(queue, alice, count=3)
+
+    claimed = claim(queue, 4)
+    # Los manuales de bob van primero, pero solo puede tener uno en curso
+    assert owners(claimed[:3]) == ['bob', 'alice', 'alice']
+    # Todos en su límite: no se reclama nada más
+    assert claimed[3] is None
+
+def test_organizations_alternate_within_user(make_queue, user):
+    queue = make_queue(fair_share={'by_organization': True})
+    enqueue(queue, user, count=3, age=60, organization='acme')
+    enqueue(queue, user, count=3, organization='globex')
+
+    organizations = [db.session.get(Backup, backup_id).organization for backup_id in claim(queue, 4)]
+    assert sorted(organizations) == ['acme', 'acme', 'globex', 'globex']
+
+def test_preempts_latest_scheduled_backup_for_waiting_manual(make_queue):
+    queue = make_queue(preempt_after=120)
+    alice, bob = make_user('alice'), make_user('bob')
+    older = start_backup(queue, bob, started_ago=600)
+    newer = start_backup(queue, bob, started_ago=60)
+    enqueue(queue, alice, priority=PRIORITY_MANUAL, age=300)
+
+    queue._request_preemptions()
+    assert db.session.get(Backup, newer.id).preempt_requested
+    assert not db.session.get(Backup, older.id).preempt_requested
+
+    # La petición ya hecha cubre al backup que espera
+    queue._request_preemptions()
+    assert not db.session.get(Backup, older.id).preempt_requested
+
+def test_no_preemption_for_recent_manual_backups(make_queue):
+    queue = make_queue(preempt_after=120)
+    alice, bob = make_user('alice'), make_user('bob')
+    running = start_backup(queue, bob)
+    enqueue(queue, alice, priority=PRIORITY_MANUAL, age=10)
+
+    queue._request_preemptions()
+    assert not db.session.get(Backup, running.id).preempt_requested
+
+def test_capped_user_only_preempts_own_backups(make_queue):
+    queue = make_queue(preempt_after=120, fair_share={'limits': {'alice': 1}})
+    alice, bob = make_user('alice'), make_user('bob')
+    own_manual = start_backup(queue, alice, priority=PRIORITY_MANUAL)
+    other = start_backup(queue, bob)
+    enqueue(queue, alice, priority=PRIORITY_MANUAL, age=300)
+
+    # Aunque bob ceda su worker, alice no podría reclamar otro backup
+    queue._request_preemptions()
+    assert not db.session.get(Backup, other.id).preempt_requested
+
+    own_manual.priority = PRIORITY_SCHEDULED
+    db.session.commit()
+    queue._request_preemptions()
+    assert db.session.get(Backup, own_manual.id).preempt_requested
+    assert not db.session.get(Backup, other.id).preempt_requested
+
+def test_preemption_requires_scratch_space(make_queue):
+    queue = make_queue(preempt_after=120)
+    alice, bob = make_user('alice'), make_user('bob')
+    small = [start_backup(queue, bob, reserved=1024) for _ in range(2)]
+    # No cabe en el disco aunque uno de los backups en curso libere su reserva
+    enqueue(queue, alice, priority=PRIORITY_MANUAL, age=300, scratch_peak=queue.scratch.available() * 2)
+
+    queue._request_preemptions()
+    assert not any(db.session.get(Backup, backup.id).preempt_requested for backup in small)
+
+    # Con un solo backup en curso en la máquina, cederlo la deja libre y se admite cualquiera
+    small[0].status = 'completed'
+    db.session.commit()
+    queue._request_preemptions()
+    assert db.session.get(Backup, small[1].id).preempt_requested
+
+def test_only_preempts_backups_on_this_host(make_queue):
+    queue = make_queue(preempt_after=120)
+    alice, bob = make_user('alice'), make_user('bob')
+    remote = start_backup(queue, bob, host='otherhost:')
+    enqueue(queue, alice, priority=PRIORITY_MANUAL, age=300)
+
+    queue._request_preemptions()
+    assert not db.session.get(Backup, remote.id).preempt_requested
+
+def test_failure_only_marks_backups_this_worker_owns(make_queue, user):
+    queue = make_queue()
+    other = start_backup(queue, user)
+    own = start_backup(queue, user)
+    own.lease_owner = queue.worker_id
+    db.session.commit()
+
+    assert not queue._mark_failed(other.id, 'boom')
+    assert queue._mark_failed(own.id, 'boom')
+
+    db.session.expire_all()
+    assert other.status == 'cloning' and other.completed_at is None
+    assert own.status == 'error' and own.error_message == 'boom'
+    assert own.completed_at is not None
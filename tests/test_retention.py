@@ -0,0 +1,105 @@
+from models import db, Backup, BackupDestination, Repository
+from services.retention import RetentionPlanner
+from datetime import datetime, timedelta
+from sqlalchemy import insert
+import os
+import time
+import pytest
+
+NO_LEVELS = {'hourly': 0, 'daily': 0, 'weekly': 0, 'monthly': 0, 'errors_days': 7}
+
+def add_backup(repository, created_at, status='completed', size=100, **fields):
+    backup = Backup(repository_id=repository.id, status=status, created_at=created_at, **fields)
+    db.session.add(backup)
+    db.session.flush()
+    if status in ('completed', 'unchanged') and not fields.get('artifact_backup_id'):
+        db.session.add(BackupDestination(backup_id=backup.id, storage_type='s3', status='completed', size=size))
+    return backup
+
+@pytest.fixture
+def repository(user):
+    repository = Repository(user_id=user.id, url='https://github.com/alice/repo', storage_type='s3')
+    db.session.add(repository)
+    db.session.commit()
+    return repository
+
+def test_gfs_keeps_latest_backup_of_each_period(repository):
+    start = datetime(2025, 1, 6)
+    backups = [add_backup(repository, start + timedelta(hours=hours)) for hours in (0, 0.25, 0.5, 1, 2, 26, 50)]
+    db.session.commit()
+
+    planner = RetentionPlanner()
+    deleted = planner.plan(planner.gfs({**NO_LEVELS, 'hourly': 3}))
+    # Se conservan las tres últimas horas con backups
+    assert deleted == [backup.id for backup in reversed(backups[:4])]
+
+    deleted = planner.plan(planner.gfs({**NO_LEVELS, 'daily': 2}))
+    # Del primer día solo el último backup, que no está entre los dos días más recientes
+    assert deleted == [backup.id for backup in reversed(backups[:5])]
+
+def test_plan_keeps_artifact_chains_of_kept_backups(repository):
+    start = datetime(2025, 1, 6)
+    old_base = add_backup(repository, start, artifact_type='full_bundle')
+    old_increment = add_backup(
+        repository, start + timedelta(hours=1), artifact_type='incremental_bundle',
+        parent_backup_id=old_base.id, chain_base_id=old_base.id
+    )
+    base = add_backup(repository, start + timedelta(hours=2), artifact_type='full_bundle')
+    unchanged = add_backup(repository, start + timedelta(hours=3), status='unchanged', artifact_backup_id=base.id)
+    increment = add_backup(
+        repository, start + timedelta(hours=4), artifact_type='incremental_bundle',
+        parent_backup_id=base.id, chain_base_id=base.id
+    )
+    failed = add_backup(repository, start + timedelta(hours=5), status='error')
+    pending = add_backup(repository, start - timedelta(days=1), status='pending')
+    db.session.commit()
+
+    planner = RetentionPlanner()
+    expired = planner.gfs({**NO_LEVELS, 'hourly': 2})
+    # El bundle completo de la cadena conservada no se elimina aunque haya caducado
+    assert planner.plan(expired) == [failed.id, old_increment.id, old_base.id]
+
+    report = planner.report(expired)
+    assert report['keep'] == 4
+    assert report['delete'] == 3
+    assert report['bytes_freed'] == 200
+    assert {unchanged.id, increment.id, base.id, pending.id}.isdisjoint(planner.plan(expired))
+
+@pytest.mark.skipif(not os.environ.get('RETENTION_BENCHMARK'), reason='RETENTION_BENCHMARK=<backups> para ejecutarlo')
+def test_plan_benchmark(user):
+    """
+    Plan e informe sobre ~1M backups (5000 repositorios con un backup cada
+    6 horas) en segundos.
+    """
+    total = int(os.environ['RETENTION_BENCHMARK'])
+    repositories = 5000
+    per_repository = max(total // repositories, 1)
+    db.session.execute(insert(Repository), [
+        {'id': repo_id, 'user_id': user.id, 'url': f'https://github.com/alice/r{repo_id}', 'storage_type': 's3'}
+        for repo_id in range(1, repositories + 1)
+    ])
+    start = datetime.utcnow() - timedelta(hours=6 * per_repository)
+    for repo_id in range(1, repositories + 1):
+        db.session.execute(insert(Backup), [
+            {
+                'repository_id': repo_id,
+                'status': 'error' if i % 10 == 9 else 'completed',
+                'created_at': start + timedelta(hours=6 * i, minutes=repo_id % 30),
+                'artifact_type': 'archive'
+            }
+            for i in range(per_repository)
+        ])
+    db.session.commit()
+
+    planner = RetentionPlanner()
+    started = time.monotonic()
+    deleted = planner.plan(planner.gfs())
+    plan_seconds = time.monotonic() - started
+
+    started = time.monotonic()
+    report = planner.report(planner.gfs())
+    report_seconds = time.monotonic() - started
+
+    assert report['delete'] == len(deleted)
+    assert plan_seconds < 10, f'plan took {plan_seconds:.1f}s'
+    assert report_seconds < 10, f'report took {report_seconds:.1f}s'
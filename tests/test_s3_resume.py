@@ -0,0 +1,98 @@
+from repomirror.storage.base import UploadCheckpoint
+from botocore.exceptions import ClientError
+from functools import partial
+import asyncio
+import io
+import os
+import pytest
+
+moto = pytest.importorskip('moto')
+from repomirror.storage.s3 import S3Storage
+
+PART_SIZE = 5 * 1024 * 1024
+
+class FailingStream(io.BytesIO):
+    """
+    Flujo que falla con un error de red tras leer `limit` bytes.
+    """
+
+    def __init__(self, data, limit):
+        super().__init__(data)
+        self.limit = limit
+
+    def read(self, size=-1):
+        if self.tell() >= self.limit:
+            raise ConnectionResetError('Conexión cerrada')
+        return super().read(size)
+
+@pytest.fixture
+def storage():
+    with moto.mock_aws():
+        storage = S3Storage({
+            'access_key': 'test',
+            'secret_key': 'test',
+            'bucket': 'backups',
+            'region': 'us-east-1',
+            'part_size_mb': 5,
+            # Una parte a la vez: se confirman en orden y el punto de control avanza
+            'concurrency': 1
+        })
+        storage.s3_client.create_bucket(Bucket='backups')
+        storage.part_retry_policy.base_delay = 0
+        yield storage
+
+def test_interrupted_upload_resumes_from_checkpoint(storage):
+    data = os.urandom(3 * PART_SIZE + 1024)
+    saved = []
+    checkpoint = UploadCheckpoint(on_save=saved.append)
+
+    with pytest.raises(Exception):
+        asyncio.run(storage.upload_stream(FailingStream(data, 2 * PART_SIZE), 'backups/1.tar', checkpoint))
+    assert checkpoint.state['upload_id']
+    assert checkpoint.offset in (PART_SIZE, 2 * PART_SIZE)
+    assert saved[-1] == checkpoint.state
+
+    # Otro proceso continúa desde el estado guardado
+    resumed = UploadCheckpoint(saved[-1])
+    assert asyncio.run(storage.resume_upload(resumed))
+    stream = io.BytesIO(data[resumed.offset:])
+    asyncio.run(storage.upload_stream(stream, 'backups/1.tar', resumed))
+
+    body = storage.s3_client.get_object(Bucket='backups', Key='backups/1.tar')['Body'].read()
+    assert body == data
+    uploads = storage.s3_client.list_multipart_uploads(Bucket='backups').get('Uploads', [])
+    assert uploads == []
+
+def test_aborted_upload_cannot_resume(storage):
+    data = os.urandom(2 * PART_SIZE + 1024)
+    checkpoint = UploadCheckpoint()
+    with pytest.raises(Exception):
+        asyncio.run(storage.upload_stream(FailingStream(data, PART_SIZE), 'backups/2.tar', checkpoint))
+
+    asyncio.run(storage.abort_upload(checkpoint.state))
+    assert not asyncio.run(storage.resume_upload(UploadCheckpoint(checkpoint.state)))
+
+def test_resume_rejects_different_part_size(storage):
+    data = os.urandom(2 * PART_SIZE + 1024)
+    checkpoint = UploadCheckpoint()
+    with pytest.raises(Exception):
+        asyncio.run(storage.upload_stream(FailingStream(data, PART_SIZE), 'backups/3.tar', checkpoint))
+
+    storage.part_size *= 2
+    assert not asyncio.run(storage.resume_upload(UploadCheckpoint(checkpoint.state)))
+
+def test_only_transient_errors_are_retried(storage):
+    calls = []
+
+    def failing(code, status):
+        calls.append(code)
+        raise ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'UploadPart')
+
+    with pytest.raises(ClientError):
+        asyncio.run(storage._with_retries(partial(failing, 'AccessDenied', 403)))
+    assert calls == ['AccessDenied']
+
+    calls.clear()
+    with pytest.raises(ClientError):
+        asyncio.run(storage._with_retries(partial(failing, 'SlowDown', 503)))
+    assert len(calls) == storage.max_part_retries + 1
@@ -0,0 +1,67 @@
+from services.schedule import CronSchedule, next_run, parse_schedule, schedule_offset
+from datetime import datetime, timedelta
+import pytest
+
+@pytest.mark.parametrize('expression, after, expected', [
+    ('*/15 * * * *', datetime(2025, 3, 10, 8, 7, 30), datetime(2025, 3, 10, 8, 15)),
+    ('0 * * * *', datetime(2025, 3, 10, 8, 0), datetime(2025, 3, 10, 9, 0)),
+    ('30 2 * * *', datetime(2025, 3, 10, 23, 59), datetime(2025, 3, 11, 2, 30)),
+    # Lunes a viernes a las 9; el 15 de marzo de 2025 es sábado
+    ('0 9 * * mon-fri', datetime(2025, 3, 14, 10, 0), datetime(2025, 3, 17, 9, 0)),
+    # 0 y 7 son domingo
+    ('0 0 * * 7', datetime(2025, 3, 10), datetime(2025, 3, 16)),
+    ('0 0 1 jan,jul *', datetime(2025, 3, 10), datetime(2025, 7, 1)),
+    ('0 0 31 * *', datetime(2025, 4, 1), datetime(2025, 5, 31)),
+    ('0 0 29 2 *', datetime(2025, 3, 1), datetime(2028, 2, 29)),
+    # Con día del mes y de la semana restringidos basta con uno de ellos
+    ('0 0 13 * fri', datetime(2025, 3, 10), datetime(2025, 3, 13)),
+    ('0 0 13 * fri', datetime(2025, 3, 13), datetime(2025, 3, 14)),
+    ('0 8-18/4 * * *', datetime(2025, 3, 10, 12, 0), datetime(2025, 3, 10, 16, 0)),
+    ('5/20 * * * *', datetime(2025, 3, 10, 8, 26), datetime(2025, 3, 10, 8, 45)),
+    ('59 23 31 12 *', datetime(2025, 12, 31, 23, 59), datetime(2026, 12, 31, 23, 59)),
+])
+def test_next_after(expression, after, expected):
+    assert CronSchedule(expression).next_after(after) == expected
+
+@pytest.mark.parametrize('expression', [
+    '* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '*/0 * * * *', '5-1 * * * *', '* * * foo *'
+])
+def test_invalid_expressions(expression):
+    with pytest.raises(ValueError):
+        CronSchedule(expression)
+
+def test_impossible_date_has_no_runs():
+    with pytest.raises(ValueError):
+        CronSchedule('0 0 30 2 *').next_after(datetime(2025, 1, 1))
+
+def test_parse_schedule_aliases():
+    assert parse_schedule('manual') is None
+    assert parse_schedule(None) is None
+    assert parse_schedule('@daily').expression == '0 0 * * *'
+    assert parse_schedule('Weekly').expression == '0 0 * * 0'
+
+def test_schedule_offset_is_stable_and_within_window():
+    offsets = [schedule_offset(key, 1800) for key in range(1000)]
+    assert offsets == [schedule_offset(key, 1800) for key in range(1000)]
+    assert all(0 <= offset < 1800 for offset in offsets)
+    # Los repositorios se reparten por toda la ventana
+    assert len({offset // 180 for offset in offsets}) == 10
+    assert schedule_offset(1, 0) == 0
+
+def test_next_run_applies_offset():
+    after = datetime(2025, 3, 10, 12, 0)
+    offset = timedelta(seconds=schedule_offset(42, 3600))
+    run = next_run('hourly', after, 42, 3600)
+    assert run > after
+    assert run - offset == CronSchedule('0 * * * *').next_after(after - offset)
+    # Ejecuciones sucesivas separadas exactamente por el periodo
+    assert next_run('hourly', run, 42, 3600) == run + timedelta(hours=1)
+
+def test_next_run_before_own_slot_in_same_period():
+    # Con el desplazamiento la ejecución de la hora actual puede no haber llegado
+    offset = timedelta(seconds=schedule_offset(7, 3600))
+    after = datetime(2025, 3, 10, 12, 0) + offset - timedelta(seconds=1)
+    assert next_run('hourly', after, 7, 3600) == datetime(2025, 3, 10, 12, 0) + offset
+
+def test_next_run_manual_schedule():
+    assert next_run('manual', datetime(2025, 3, 10), 1, 3600) is None
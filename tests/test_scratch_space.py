@@ -0,0 +1,44 @@
+from models import db, Backup, Repository
+from services.scratch_space import ScratchSpace
+from datetime import datetime, timedelta
+import pytest
+
+HOST = 'worker-1:'
+
+@pytest.fixture
+def scratch(app, tmp_path):
+    return ScratchSpace(str(tmp_path), {'min_free_mb': 0}, HOST)
+
+def lease(user, owner, reserved, expires_in=60):
+    repository = Repository(user_id=user.id, url='https://github.com/alice/repo', storage_type='s3')
+    db.session.add(repository)
+    db.session.flush()
+    backup = Backup(
+        repository_id=repository.id, status='cloning', lease_owner=owner, scratch_reserved=reserved,
+        lease_expires_at=datetime.utcnow() + timedelta(seconds=expires_in)
+    )
+    db.session.add(backup)
+    db.session.commit()
+    return backup
+
+def test_idle_host_is_not_busy(scratch, user):
+    lease(user, 'worker-2:1:abc', 10 ** 9)
+    # Una lease caducada es de un proceso muerto
+    lease(user, f'{HOST}2:abc', 10 ** 9, expires_in=-60)
+    assert not scratch.busy
+
+def test_counts_reservations_of_other_processes_on_host(scratch, user):
+    before = scratch.available()
+    lease(user, f'{HOST}2:abc', 10 ** 9)
+    assert scratch.busy
+    assert before - scratch.available() == pytest.approx(10 ** 9, abs=10 ** 7)
+
+def test_own_reservations_count_what_is_left(scratch, user):
+    backup = lease(user, f'{HOST}1:abc', 10 ** 9)
+    # Desde otro proceso solo se conoce la reserva completa
+    other_process = scratch.available()
+    scratch.register(backup.id, 10 ** 9)
+    scratch._record(backup.id, 4 * 10 ** 8)
+    # El proceso que lo procesa descuenta solo lo que le falta por usar (la
+    # reserva no se cuenta dos veces)
+    assert scratch.available() - other_process == pytest.approx(4 * 10 ** 8, abs=10 ** 7)